@@ -0,0 +1,74 @@
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+"""streaming parser of changelogs as handed out by libgfchangelog
+
+Every line of such a changelog is a record of one of the forms
+
+  E <GFID> <OP> <FIELD>...    entry operation
+  D <GFID>                    data modification
+  M <GFID> <OP> [<FIELD>...]  metadata modification
+
+Records are produced one by one, so memory usage does not depend
+on the size of the changelog.
+
+This module is self-contained (it's shipped with glusterfind, too),
+so don't make it depend on other gsyncd modules.
+"""
+
+TYPE_ENTRY = 'E'
+TYPE_DATA = 'D'
+TYPE_META = 'M'
+
+
+class ChangelogRecord(object):
+
+    """one record of a changelog
+
+    - .type: record type, one of TYPE_{ENTRY,DATA,META}
+    - .gfid: GFID the record refers to
+    - .op: operation (eg. CREATE, RENAME, SETATTR), None for data
+    - .fields: tuple of the operation specific fields following .op
+      (these are left escaped, as found in the changelog)
+    """
+
+    __slots__ = ('type', 'gfid', 'op', 'fields')
+
+    def __init__(self, ty, gfid, op=None, fields=()):
+        self.type = ty
+        self.gfid = gfid
+        self.op = op
+        self.fields = fields
+
+    def __repr__(self):
+        ec = [self.type, self.gfid]
+        if self.op:
+            ec.append(self.op)
+        return ' '.join(ec + list(self.fields))
+
+
+def parse_records(lines):
+    """generate ChangelogRecord objects from an iterable of lines"""
+    for line in lines:
+        ec = line.strip().split(' ')
+        if len(ec) < 2:
+            # empty or truncated line
+            continue
+        if len(ec) == 2:
+            yield ChangelogRecord(ec[0], ec[1])
+        else:
+            yield ChangelogRecord(ec[0], ec[1], ec[2], tuple(ec[3:]))
+
+
+def parse_changelog(path):
+    """generate ChangelogRecord objects from the changelog at @path"""
+    with open(path) as f:
+        for rec in parse_records(f):
+            yield rec
@@ -0,0 +1,111 @@
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+"""directory reading which tells the type of entries
+
+readdir(3) hands out the type (d_type) and inode number of entries
+along with their names, which os.listdir() throws away, so that
+crawlers need a stat per entry to tell directories from the rest.
+scandir() keeps them.
+"""
+
+import os
+import sys
+import stat
+from errno import ENOENT
+from ctypes import CDLL, Structure, POINTER, get_errno, set_errno
+from ctypes import c_char, c_char_p, c_int64, c_uint64, c_ushort, c_ubyte
+from ctypes import c_void_p
+from ctypes.util import find_library
+
+DT_UNKNOWN = 0
+DT_FIFO = 1
+DT_CHR = 2
+DT_DIR = 4
+DT_BLK = 6
+DT_REG = 8
+DT_LNK = 10
+DT_SOCK = 12
+
+
+def iftodt(mode):
+    """the DT_* type of stat mode @mode"""
+    return stat.S_IFMT(mode) >> 12
+
+
+class Dirent64(Structure):
+    _fields_ = [('d_ino', c_uint64),
+                ('d_off', c_int64),
+                ('d_reclen', c_ushort),
+                ('d_type', c_ubyte),
+                ('d_name', c_char * 256)]
+
+
+try:
+    libc = CDLL(find_library("c"), use_errno=True)
+    libc.opendir.argtypes = [c_char_p]
+    libc.opendir.restype = c_void_p
+    libc.readdir64.argtypes = [c_void_p]
+    libc.readdir64.restype = POINTER(Dirent64)
+    libc.closedir.argtypes = [c_void_p]
+except (OSError, AttributeError):
+    libc = None
+
+
+def raise_oserr(path):
+    errn = get_errno()
+    raise OSError(errn, os.strerror(errn), path)
+
+
+def readdir(path):
+    """(name, type, inode) of entries of @path, as readdir(3) tells"""
+    if not libc:
+        return [(name, DT_UNKNOWN, 0) for name in os.listdir(path)]
+    dirp = libc.opendir(path)
+    if not dirp:
+        raise_oserr(path)
+    ents = []
+    try:
+        while True:
+            set_errno(0)
+            de = libc.readdir64(dirp)
+            if not de:
+                if get_errno():
+                    raise_oserr(path)
+                break
+            de = de.contents
+            if de.d_name in ('.', '..'):
+                continue
+            ents.append((de.d_name, de.d_type, de.d_ino))
+    finally:
+        libc.closedir(dirp)
+    return ents
+
+
+def scandir(path):
+    """list of (name, type, inode) of the entries of directory @path
+
+    The type is one of the DT_* constants. Only entries the file
+    system does not tell the type of are lstat()-ed, those vanishing
+    meanwhile are left out.
+    """
+    ents = []
+    for name, dtype, ino in readdir(path):
+        if dtype == DT_UNKNOWN:
+            try:
+                st = os.lstat(os.path.join(path, name))
+            except OSError:
+                if sys.exc_info()[1].errno == ENOENT:
+                    continue
+                raise
+            dtype = iftodt(st.st_mode)
+            ino = st.st_ino
+        ents.append((name, dtype, ino))
+    return ents
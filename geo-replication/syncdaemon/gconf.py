@@ -16,10 +16,13 @@ class GConf(object):
 
     ssh_ctl_dir = None
     ssh_ctl_args = None
+    ssh_ctl_args_tar = None
     cpid = None
     pid_file_owned = False
     log_exit = False
     permanent_handles = []
     log_metadata = {}
+    brick_status = None
+    profile_dir = None
 
 gconf = GConf()
@@ -248,13 +248,60 @@ def main_i():
         '--local-path', metavar='PATH', help=SUPPRESS_HELP, default='')
     op.add_option('-s', '--ssh-command', metavar='CMD', default='ssh')
     op.add_option('--ssh-command-tar', metavar='CMD', default='ssh')
+    # seconds an idle ssh master connection of tar+ssh is kept around
+    op.add_option('--ssh-ctl-persist', metavar='SEC', type=int, default=60)
     op.add_option('--rsync-command', metavar='CMD', default='rsync')
     op.add_option('--rsync-options', metavar='OPTS', default='')
     op.add_option('--rsync-ssh-options', metavar='OPTS', default='--compress')
     op.add_option('--timeout', metavar='SEC', type=int, default=120)
+    # pickle or compact: encoding of bulky RPCs (entry_ops, meta_ops)
+    op.add_option('--repce-codec', metavar='CODEC', type=str,
+                  default='pickle')
+    # RPC messages of at least this many bytes are compressed (0: never)
+    op.add_option('--repce-compress-size', metavar='BYTES', type=int,
+                  default=0)
+    # slave stops reading requests if this many are pending (0: no limit)
+    op.add_option('--repce-queue-size', metavar='N', type=int, default=64)
+    # counters of the worker status are written out this often (0: always)
+    op.add_option('--status-flush-interval', metavar='SEC', type=float,
+                  default=5)
+    # rates and timings in the status are taken over this long
+    op.add_option('--metrics-window', metavar='SEC', type=float, default=60)
+    # monitor exports metrics of the workers in OpenMetrics text format
+    # to this file, or unix:<path> socket
+    op.add_option('--metrics-export', metavar='PATH', default='')
+    op.add_option('--metrics-export-interval', metavar='SEC', type=float,
+                  default=15)
+    # cProfile the crawl (per changelog batch), the transfers and the
+    # RePCe listeners into the working dir of the brick
+    op.add_option('--profile', default=False, action='store_true')
     op.add_option('--connection-timeout', metavar='SEC',
                   type=int, default=60, help=SUPPRESS_HELP)
     op.add_option('--sync-jobs', metavar='N', type=int, default=3)
+    # a sync job starts off once this many files are queued up, or
+    # when the first of them has been waiting for max-delay seconds
+    op.add_option('--sync-batch-min-files', metavar='N', type=int, default=1)
+    op.add_option('--sync-batch-max-delay', metavar='SEC', type=float,
+                  default=0.5)
+    # file sets of at least this many bytes (counting 64k per file) are
+    # spread over the sync jobs
+    op.add_option('--sync-split-size', metavar='BYTES', type=int,
+                  default=64 * 1024 * 1024)
+    # number of changelog batches allowed to be in flight, ie. entry and
+    # metadata ops of next batches run while data of the earlier drains
+    op.add_option('--batch-pipeline-depth', metavar='N', type=int, default=2)
+    # number of changelog batches (not sharing any GFID) started concurrently
+    op.add_option('--batch-workers', metavar='N', type=int, default=1)
+    # fold operations superseding each other within a changelog batch
+    op.add_option('--coalesce-changelogs', default=True, action='store_true')
+    # threads used to stat entries of a changelog ahead of entry_ops
+    op.add_option('--entry-stat-threads', metavar='N', type=int, default=4)
+    # threads scanning directories ahead of the hybrid crawl
+    op.add_option('--xsync-crawl-threads', metavar='N', type=int, default=4)
+    # resume an interrupted hybrid crawl from where it got to
+    op.add_option('--xsync-resume', default=True, action='store_true')
+    # threads applying independent entry and metadata operations on slave
+    op.add_option('--entry-op-threads', metavar='N', type=int, default=4)
     op.add_option('--replica-failover-interval', metavar='N',
                   type=int, default=1)
     op.add_option('--changelog-archive-format', metavar='N',
@@ -289,6 +336,14 @@ def main_i():
     op.add_option('--working-dir', metavar='DIR', type=str,
                   action='callback', callback=store_abs)
     op.add_option('--use-tarssh', default=False, action='store_true')
+    # rsync, tarssh or native (overrides use-tarssh if set)
+    op.add_option('--sync-engine', metavar='ENGINE', type=str)
+    # native engine: data chunk size, and whether to send only the
+    # chunks of files which differ from the slave copy
+    op.add_option('--native-chunk-size', metavar='BYTES', type=int,
+                  default=1024 * 1024)
+    op.add_option('--native-append-delta', default=False,
+                  action='store_true')
 
     op.add_option('-c', '--config-file', metavar='CONF',
                   type=str, action='callback', callback=store_local)
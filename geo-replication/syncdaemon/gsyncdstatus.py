@@ -11,11 +11,17 @@
 
 import fcntl
 import os
+import mmap
+import struct
 import tempfile
 import urllib
 import json
 import time
+import logging
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
+from threading import Lock, Thread
 
 DEFAULT_STATUS = "N/A"
 MONITOR_STATUS = ("Created", "Started", "Paused", "Stopped")
@@ -30,6 +36,50 @@ CRAWL_STATUS_VALUES = (DEFAULT_STATUS,
                        "History Crawl",
                        "Changelog Crawl")
 
+# status fields which are taken from the Metrics of the worker
+METRICS_FIELDS = ("changelogs_per_sec",
+                  "entries_per_sec",
+                  "bytes_per_sec",
+                  "changelog_parse_time",
+                  "entry_ops_time",
+                  "meta_ops_time",
+                  "data_time",
+                  "lag",
+                  "catchup_eta")
+
+
+# layout of the shared status region: a header carrying the monitor
+# status, followed by fixed size slots, one per brick
+REGION_FILE = "status.shm"
+REGION_MAGIC = "GSYNCSHM"
+REGION_VERSION = 2
+REGION_SLOTS = 64
+HEADER_FORMAT = "<8sIIQ32s"
+HEADER_SIZE = 64
+MONITOR_OFFSET = struct.calcsize("<8sII")
+SLOT_SIZE = 1024
+SLOT_FIELDS = (("slave_node", "256s"),
+               ("worker_status", "32s"),
+               ("crawl_status", "32s"),
+               ("checkpoint_completed", "8s"),
+               ("last_synced", "q"),
+               ("entry", "q"),
+               ("data", "q"),
+               ("meta", "q"),
+               ("failures", "q"),
+               ("checkpoint_time", "q"),
+               ("checkpoint_completion_time", "q"),
+               ("changelogs_per_sec", "d"),
+               ("entries_per_sec", "d"),
+               ("bytes_per_sec", "d"),
+               ("changelog_parse_time", "d"),
+               ("entry_ops_time", "d"),
+               ("meta_ops_time", "d"),
+               ("data_time", "d"),
+               ("lag", "d"),
+               ("catchup_eta", "d"))
+SLOT_FORMAT = "<Q512s" + "".join(f[1] for f in SLOT_FIELDS)
+
 
 def human_time(ts):
     try:
@@ -58,7 +108,16 @@ def get_default_values():
         "failures": 0,
         "checkpoint_completed": DEFAULT_STATUS,
         "checkpoint_time": 0,
-        "checkpoint_completion_time": 0}
+        "checkpoint_completion_time": 0,
+        "changelogs_per_sec": 0,
+        "entries_per_sec": 0,
+        "bytes_per_sec": 0,
+        "changelog_parse_time": 0,
+        "entry_ops_time": 0,
+        "meta_ops_time": 0,
+        "data_time": 0,
+        "lag": DEFAULT_STATUS,
+        "catchup_eta": DEFAULT_STATUS}
 
 
 class LockedOpen(object):
@@ -96,6 +155,333 @@ class LockedOpen(object):
         self.fileobj.close()
 
 
+def _to_field(fmt, value):
+    if fmt.endswith("s"):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        return str(value)
+    if fmt == "d":
+        # metrics which are not known (yet) are negative
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return -1.0
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _from_field(fmt, value):
+    if fmt.endswith("s"):
+        return value.rstrip("\0")
+    if fmt == "d" and value < 0:
+        return DEFAULT_STATUS
+    return value
+
+
+class Metrics(object):
+
+    """work done by a worker over the last @window seconds
+
+    Phases of the work are recorded along with their duration and
+    the amount of stuff they went through (changelogs parsed, entries
+    and metadata synced, bytes transferred), plus the stimes reached,
+    wherefrom the lag and the time to catch up are estimated.
+    """
+
+    PHASES = ("changelog_parse", "process_records", "entry_ops", "meta_ops",
+              "syncdata_wait", "data", "batch")
+
+    def __init__(self, window=60):
+        self.window = window
+        self.lock = Lock()
+        self.events = deque()
+        self.stimes = deque()
+        self.start = time.time()
+        # since the start: phase totals, counters and gauges
+        self.totals = {}
+        self.counters = {}
+        self.gauges = {}
+        # name -> function returning per method RPC call stats
+        self.sources = {}
+
+    def record(self, phase, amount=0, duration=0):
+        with self.lock:
+            self.events.append((time.time(), phase, amount, duration))
+            tot = self.totals.setdefault(phase, {"count": 0, "amount": 0,
+                                                 "time": 0.0})
+            tot["count"] += 1
+            tot["amount"] += amount
+            tot["time"] += duration
+
+    @contextmanager
+    def timer(self, phase, amount=0):
+        """record the time of the enclosed code as @phase"""
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.record(phase, amount, time.time() - t0)
+
+    def incr(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def add_gauge(self, gauge, delta):
+        with self.lock:
+            self.gauges[gauge] = self.gauges.get(gauge, 0) + delta
+
+    def set_synced(self, stime):
+        with self.lock:
+            self.stimes.append((time.time(), stime))
+
+    def _expire(self, now):
+        while self.events and self.events[0][0] < now - self.window:
+            self.events.popleft()
+        # keep the last stime before the window, as the base of progress
+        while len(self.stimes) > 1 and \
+                self.stimes[1][0] <= now - self.window:
+            self.stimes.popleft()
+
+    def snapshot(self):
+        """dict of the per phase totals and rates, lag and catch up time
+
+        Rates are per second over the window (or the time elapsed since
+        the start, if shorter). The time to catch up is None if the
+        stime does not advance faster than the clock. Phase totals,
+        counters, gauges and RPC call stats are the ones since start.
+        """
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            events = list(self.events)
+            stimes = list(self.stimes)
+            totals = dict((phase, dict(tot))
+                          for phase, tot in self.totals.items())
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        calls = {}
+        for name, source in self.sources.items():
+            calls[name] = source()
+        span = float(max(min(self.window, now - self.start), 1))
+        phases = dict((phase, {"count": 0, "amount": 0, "time": 0.0,
+                               "max": 0.0})
+                      for phase in self.PHASES)
+        for _, phase, amount, duration in events:
+            ph = phases.setdefault(phase, {"count": 0, "amount": 0,
+                                           "time": 0.0, "max": 0.0})
+            ph["count"] += 1
+            ph["amount"] += amount
+            ph["time"] += duration
+            ph["max"] = max(ph["max"], duration)
+        for ph in phases.values():
+            ph["rate"] = ph["amount"] / span
+            ph["busy"] = ph["time"] / span
+
+        lag = eta = None
+        if stimes:
+            lag = max(now - stimes[-1][1], 0)
+            (t0, st0), (t1, st1) = stimes[0], stimes[-1]
+            if t1 > t0:
+                progress = (st1 - st0) / (t1 - t0)
+                if progress > 1:
+                    eta = lag / (progress - 1)
+        return {"time": now, "window": span, "phases": phases,
+                "lag": lag, "catchup_eta": eta, "totals": totals,
+                "counters": counters, "gauges": gauges, "calls": calls}
+
+
+def metrics_summary(snap):
+    """the status fields of the Metrics snapshot @snap"""
+    phases = snap["phases"]
+
+    def known(value):
+        if value is None:
+            return DEFAULT_STATUS
+        return int(value)
+
+    return {
+        "changelogs_per_sec": round(phases["changelog_parse"]["rate"], 2),
+        "entries_per_sec": round(phases["entry_ops"]["rate"], 2),
+        "bytes_per_sec": round(phases["data"]["rate"], 2),
+        "changelog_parse_time": round(phases["changelog_parse"]["time"], 3),
+        "entry_ops_time": round(phases["entry_ops"]["time"], 3),
+        "meta_ops_time": round(phases["meta_ops"]["time"], 3),
+        "data_time": round(phases["data"]["time"], 3),
+        "lag": known(snap["lag"]),
+        "catchup_eta": known(snap["catchup_eta"])}
+
+
+class StatusRegion(object):
+
+    """mmap-ed status of the bricks of a session
+
+    Workers (and the monitor) write the status of their brick into
+    its slot, guarded by a sequence counter: it is odd while the slot
+    is being written. Readers do not take any lock, they copy the slot
+    and retry if the counter was odd or changed meanwhile. Writers
+    of a slot are serialized by a record lock on its byte range.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.slots = {}
+        self.fd = os.open(path, os.O_CREAT | os.O_RDWR)
+        size = HEADER_SIZE + REGION_SLOTS * SLOT_SIZE
+        self._lockf(fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            if os.fstat(self.fd).st_size != size:
+                os.ftruncate(self.fd, size)
+            self.map = mmap.mmap(self.fd, size, mmap.MAP_SHARED,
+                                 mmap.PROT_READ | mmap.PROT_WRITE)
+            magic, version, nslots, _, _ = struct.unpack_from(HEADER_FORMAT,
+                                                              self.map)
+            if (magic, version, nslots) != (REGION_MAGIC, REGION_VERSION,
+                                            REGION_SLOTS):
+                # left by a different layout (or brand new), start over
+                self.map[:] = "\0" * size
+                struct.pack_into(HEADER_FORMAT, self.map, 0, REGION_MAGIC,
+                                 REGION_VERSION, REGION_SLOTS, 0, "")
+        finally:
+            self._lockf(fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+    def _lockf(self, cmd, length, start):
+        fcntl.lockf(self.fd, cmd, length, start, os.SEEK_SET)
+
+    def _read(self, fmt, off):
+        """lock-free read of the seqlock-ed record at @off"""
+        for _ in range(1000):
+            seq = struct.unpack_from("<Q", self.map, off)[0]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            rec = struct.unpack_from(fmt, self.map, off)
+            if struct.unpack_from("<Q", self.map, off)[0] == seq:
+                return rec
+        return None
+
+    def _write(self, fmt, off, length, mkrec):
+        """write the record built by @mkrec from the current one at @off"""
+        with self.lock:
+            self._lockf(fcntl.LOCK_EX, length, off)
+            try:
+                rec = struct.unpack_from(fmt, self.map, off)
+                seq = rec[0]
+                struct.pack_into("<Q", self.map, off, seq + 1)
+                struct.pack_into(fmt, self.map, off, seq + 1,
+                                 *mkrec(rec[1:]))
+                struct.pack_into("<Q", self.map, off, seq + 2)
+            finally:
+                self._lockf(fcntl.LOCK_UN, length, off)
+
+    def get_monitor_status(self):
+        rec = self._read("<Q32s", MONITOR_OFFSET)
+        if rec:
+            return rec[1].rstrip("\0")
+
+    def set_monitor_status(self, status):
+        self._write("<Q32s", MONITOR_OFFSET, struct.calcsize("<Q32s"),
+                    lambda rec: [status])
+
+    def _slot_offset(self, idx):
+        return HEADER_SIZE + idx * SLOT_SIZE
+
+    def _slot_brick(self, idx):
+        off = self._slot_offset(idx) + 8
+        return struct.unpack_from("512s", self.map, off)[0].rstrip("\0")
+
+    def find(self, brick):
+        """index of the slot of @brick, or None"""
+        idx = self.slots.get(brick)
+        if idx is None:
+            for i in range(REGION_SLOTS):
+                if self._slot_brick(i) == brick:
+                    idx = self.slots[brick] = i
+                    break
+        return idx
+
+    def claim(self, brick, initial):
+        """index of the slot of @brick, set up with @initial if new"""
+        idx = self.find(brick)
+        if idx is not None:
+            return idx
+        self._lockf(fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            idx = self.find(brick)
+            if idx is not None:
+                return idx
+            for i in range(REGION_SLOTS):
+                if not self._slot_brick(i):
+                    self._write(SLOT_FORMAT, self._slot_offset(i), SLOT_SIZE,
+                                lambda rec: self._pack(brick, initial()))
+                    self.slots[brick] = i
+                    return i
+        finally:
+            self._lockf(fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+    def _pack(self, brick, data):
+        return [brick] + [_to_field(fmt, data.get(key))
+                          for key, fmt in SLOT_FIELDS]
+
+    def _unpack(self, rec):
+        return dict((key, _from_field(fmt, val))
+                    for (key, fmt), val in zip(SLOT_FIELDS, rec[2:]))
+
+    def update(self, brick, mergerfunc, initial):
+        """apply @mergerfunc to the slot of @brick
+
+        Returns False if the region has no room for the brick.
+        """
+        idx = self.claim(brick, initial)
+        if idx is None:
+            return False
+
+        def mkrec(rec):
+            return self._pack(brick, mergerfunc(self._unpack((0,) + rec)))
+        self._write(SLOT_FORMAT, self._slot_offset(idx), SLOT_SIZE, mkrec)
+        return True
+
+    def get(self, brick):
+        """status data of @brick, None if not (reliably) there"""
+        idx = self.find(brick)
+        if idx is None:
+            return None
+        rec = self._read(SLOT_FORMAT, self._slot_offset(idx))
+        if rec and rec[1].rstrip("\0") == brick:
+            return self._unpack(rec)
+
+    def get_all(self):
+        """status data of all the bricks, in one pass over the region"""
+        bricks = {}
+        for i in range(REGION_SLOTS):
+            rec = self._read(SLOT_FORMAT, self._slot_offset(i))
+            if rec and rec[1].rstrip("\0"):
+                bricks[rec[1].rstrip("\0")] = self._unpack(rec)
+        return bricks
+
+
+_regions = {}
+_regions_lock = Lock()
+
+
+def status_region(work_dir):
+    """the StatusRegion of the session in @work_dir
+
+    Opened once per process (record locks are per process). None if
+    it cannot be set up, the status files are the only source then.
+    """
+    path = os.path.join(os.path.abspath(work_dir), REGION_FILE)
+    with _regions_lock:
+        if path not in _regions:
+            try:
+                _regions[path] = StatusRegion(path)
+            except (EnvironmentError, mmap.error):
+                _regions[path] = None
+        return _regions[path]
+
+
 def set_monitor_status(status_file, status):
     fd = os.open(status_file, os.O_CREAT | os.O_RDWR)
     os.close(fd)
@@ -111,14 +497,22 @@ def set_monitor_status(status_file, status):
         os.fsync(dirfd)
         os.close(dirfd)
 
+    region = status_region(os.path.dirname(status_file))
+    if region:
+        region.set_monitor_status(status)
+
 
 class GeorepStatus(object):
-    def __init__(self, monitor_status_file, brick):
+    def __init__(self, monitor_status_file, brick, flush_interval=0,
+                 metrics_window=60):
         self.work_dir = os.path.dirname(monitor_status_file)
         self.monitor_status_file = monitor_status_file
         self.filename = os.path.join(self.work_dir,
                                      "brick_%s.status"
                                      % urllib.quote_plus(brick))
+        self.detail_file = os.path.join(self.work_dir,
+                                        "brick_%s.metrics"
+                                        % urllib.quote_plus(brick))
 
         fd = os.open(self.filename, os.O_CREAT | os.O_RDWR)
         os.close(fd)
@@ -126,20 +520,94 @@ class GeorepStatus(object):
         os.close(fd)
         self.brick = brick
         self.default_values = get_default_values()
+        # updates not yet written to the status file
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.pending_lock = Lock()
+        self.flush_lock = Lock()
+        self.flusher = None
+        # checkpoint and whether it was reached, as last set
+        self.checkpoint_state = None
+        self.region = status_region(self.work_dir)
+        self.metrics = Metrics(metrics_window)
+        # metrics snapshot to be written to the detail file
+        self.detail = None
+
+    def _update(self, mergerfunc, defer=False):
+        """apply @mergerfunc to the status data
+
+        If a flush interval is set, @defer-red updates are kept in
+        memory, and written out together with the next undeferred
+        one, or by the flusher thread within the flush interval.
+        The shared status region is updated right away.
+        """
+        if self.region:
+            self.region.update(self.brick, mergerfunc, self._load)
+        with self.pending_lock:
+            self.pending.append(mergerfunc)
+            if defer and self.flush_interval > 0:
+                if not self.flusher:
+                    self.flusher = Thread(target=self._flusher)
+                    self.flusher.setDaemon(True)
+                    self.flusher.start()
+                return
+        self.flush()
+
+    def _flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("failed to flush status of %s" %
+                                  self.brick)
+
+    def flush(self):
+        """write pending updates to the status file in one go"""
+        with self.flush_lock:
+            with self.pending_lock:
+                mergers, self.pending = self.pending, []
+                detail, self.detail = self.detail, None
+            if detail:
+                self._write_detail(detail)
+            if not mergers:
+                return
+            self._write(mergers)
+
+    def _write_detail(self, detail):
+        with tempfile.NamedTemporaryFile(
+                'w', dir=os.path.dirname(self.detail_file),
+                delete=False) as tf:
+            json.dump(detail, tf)
+            tempname = tf.name
+        os.rename(tempname, self.detail_file)
+
+    def _load(self):
+        data = get_default_values()
+        with open(self.filename) as f:
+            try:
+                data.update(json.load(f))
+            except ValueError:
+                pass
+        with self.pending_lock:
+            for merger in self.pending:
+                data = merger(data)
+        return data
 
-    def _update(self, mergerfunc):
+    def _write(self, mergers):
         with LockedOpen(self.filename, 'r+') as f:
             try:
                 data = json.load(f)
             except ValueError:
                 data = self.default_values
 
-            data = mergerfunc(data)
+            for merger in mergers:
+                data = merger(data)
             with tempfile.NamedTemporaryFile(
                     'w',
                     dir=os.path.dirname(self.filename),
                     delete=False) as tf:
-                tf.write(data)
+                tf.write(json.dumps(data))
                 tempname = tf.name
 
             os.rename(tempname, self.filename)
@@ -155,14 +623,17 @@ class GeorepStatus(object):
             data["entry"] = 0
             data["data"] = 0
             data["meta"] = 0
-            return json.dumps(data)
+            defaults = get_default_values()
+            for key in METRICS_FIELDS:
+                data[key] = defaults[key]
+            return data
 
         self._update(merger)
 
     def set_field(self, key, value):
         def merger(data):
             data[key] = value
-            return json.dumps(data)
+            return data
 
         self._update(merger)
 
@@ -185,9 +656,31 @@ class GeorepStatus(object):
                     data["checkpoint_time"] = checkpoint_time
                     data["checkpoint_completion_time"] = int(time.time())
                     data["checkpoint_completed"] = "Yes"
-            return json.dumps(data)
+            return data
 
-        self._update(merger)
+        # changes of the checkpoint (completion) go out right away
+        state = (checkpoint_time,
+                 checkpoint_time > 0 and checkpoint_time <= value[0])
+        defer = state == self.checkpoint_state
+        self.checkpoint_state = state
+        self._update(merger, defer=defer)
+
+    def publish_metrics(self):
+        """put the current metrics to the status
+
+        The whole snapshot goes to the detail file.
+        """
+        snap = self.metrics.snapshot()
+        summary = metrics_summary(snap)
+
+        def merger(data):
+            data.update(summary)
+            return data
+
+        with self.pending_lock:
+            self.detail = snap
+        self._update(merger, defer=True)
+        return summary
 
     def set_worker_status(self, status):
         self.set_field("worker_status", status)
@@ -198,25 +691,25 @@ class GeorepStatus(object):
     def set_slave_node(self, slave_node):
         def merger(data):
             data["slave_node"] = slave_node
-            return json.dumps(data)
+            return data
 
         self._update(merger)
 
     def inc_value(self, key, value):
         def merger(data):
             data[key] = data.get(key, 0) + value
-            return json.dumps(data)
+            return data
 
-        self._update(merger)
+        self._update(merger, defer=True)
 
     def dec_value(self, key, value):
         def merger(data):
             data[key] = data.get(key, 0) - value
             if data[key] < 0:
                 data[key] = 0
-            return json.dumps(data)
+            return data
 
-        self._update(merger)
+        self._update(merger, defer=True)
 
     def set_active(self):
         self.set_field("worker_status", "Active")
@@ -225,11 +718,32 @@ class GeorepStatus(object):
         self.set_field("worker_status", "Passive")
 
     def get_monitor_status(self):
+        if self.region:
+            data = self.region.get_monitor_status()
+            if data:
+                return data
         data = ""
         with open(self.monitor_status_file, "r") as f:
             data = f.read().strip()
         return data
 
+    def get_raw_status(self):
+        """status data as stored, with no adjustments for display"""
+        data = None
+        if self.region:
+            data = self.region.get(self.brick)
+        if data is None:
+            data = self._load()
+        return data
+
+    def get_detail(self):
+        """the metrics snapshot last written to the detail file"""
+        try:
+            with open(self.detail_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
     def get_status(self, checkpoint_time=0):
         """
         Monitor Status --->        Created    Started  Paused      Stopped
@@ -246,12 +760,7 @@ class GeorepStatus(object):
         checkpoint_time            N/A        VALUE    VALUE       VALUE
         checkpoint_completed_time  N/A        VALUE    VALUE       VALUE
         """
-        data = self.default_values
-        with open(self.filename) as f:
-            try:
-                data.update(json.load(f))
-            except ValueError:
-                pass
+        data = self.get_raw_status()
         monitor_status = self.get_monitor_status()
 
         if monitor_status in ["Created", "Paused", "Stopped"]:
@@ -306,6 +815,8 @@ class GeorepStatus(object):
             data["checkpoint_completed_time"] = DEFAULT_STATUS
             data["checkpoint_time_utc"] = DEFAULT_STATUS
             data["checkpoint_completion_time_utc"] = DEFAULT_STATUS
+            for key in METRICS_FIELDS:
+                data[key] = DEFAULT_STATUS
 
         if data["worker_status"] not in ["Active", "Passive"]:
             data["slave_node"] = DEFAULT_STATUS
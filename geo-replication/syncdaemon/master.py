@@ -18,14 +18,23 @@ import fcntl
 import string
 import errno
 import tarfile
+import heapq
+try:
+    import cPickle as pickle
+except ImportError:
+    # py 3
+    import pickle
 from errno import ENOENT, ENODATA, EEXIST, EACCES, EAGAIN
-from threading import Condition, Lock
+from threading import Condition, Lock, local, current_thread
 from datetime import datetime
 from gconf import gconf
 from syncdutils import Thread, GsyncdError, boolify, escape
-from syncdutils import unescape, gauxpfx, md5hex, selfkill
-from syncdutils import lstat, errno_wrap
+from syncdutils import unescape, gauxpfx, md5hex, selfkill, entry2pb
+from syncdutils import lstat, errno_wrap, parallel_map, Prefetcher, Profile
 from syncdutils import NoPurgeTimeAvailable, PartialHistoryAvailable
+from changelogparser import parse_changelog, ChangelogRecord
+from changelogparser import TYPE_ENTRY, TYPE_DATA, TYPE_META
+from dirscan import DT_DIR, DT_REG, DT_LNK
 
 URXTIME = (-1, 0)
 
@@ -45,6 +54,11 @@ CHANGELOG_ROLLOVER_TIME = 15
 # that batch since stime will get updated after each batch.
 MAX_CHANGELOG_BATCH_SIZE = 727040
 
+# Size a file is accounted with on top of its actual size when
+# distributing files over sync jobs, for the per file cost of the
+# transfer (stat, open, protocol exchange)
+SYNC_FILE_OVERHEAD = 65536
+
 # Utility functions to help us to get to closer proximity
 # of the DRY principle (no, don't look for elevated or
 # perspectivistic things here)
@@ -69,6 +83,33 @@ def _volinfo_hook_relax_foreign(self):
     return volinfo_sys
 
 
+def _thread_local_attr(name, default):
+    """instance attribute which has a separate value per thread
+
+    A thread which did not set it sees a fresh @default() value.
+    """
+    def getter(self):
+        try:
+            return getattr(self.tls, name)
+        except AttributeError:
+            setattr(self.tls, name, default())
+            return getattr(self.tls, name)
+
+    def setter(self, value):
+        setattr(self.tls, name, value)
+    return property(getter, setter)
+
+
+def sync_engine():
+    """name of the sync engine to use: rsync, tarssh or native"""
+    engine = gconf.sync_engine
+    if not engine:
+        engine = boolify(gconf.use_tarssh) and 'tarssh' or 'rsync'
+    if engine not in ('rsync', 'tarssh', 'native'):
+        raise GsyncdError("unknown sync engine %s" % engine)
+    return engine
+
+
 # The API!
 
 def gmaster_builder(excrawl=None):
@@ -87,7 +128,9 @@ def gmaster_builder(excrawl=None):
         gconf.use_rsync_xattrs) and SendmarkRsyncMixin or SendmarkNormalMixin
     purgemixin = boolify(
         gconf.ignore_deletes) and PurgeNoopMixin or PurgeNormalMixin
-    syncengine = boolify(gconf.use_tarssh) and TarSSHEngine or RsyncEngine
+    syncengine = {'rsync': RsyncEngine,
+                  'tarssh': TarSSHEngine,
+                  'native': NativeEngine}[sync_engine()]
 
     class _GMaster(crawlmixin, modemixin, sendmarkmixin,
                    purgemixin, syncengine):
@@ -133,11 +176,13 @@ class NormalMixin(object):
         if not 'default_xtime' in opts:
             opts['default_xtime'] = URXTIME
 
-    def xtime_low(self, rsc, path, **opts):
+    def xtime_low(self, rsc, path, stime=None, **opts):
         if rsc == self.master:
             xt = rsc.server.xtime(path, self.uuid)
         else:
-            xt = rsc.server.stime(path, self.uuid)
+            xt = stime
+            if xt is None:
+                xt = rsc.server.stime(path, self.uuid)
             if isinstance(xt, int) and xt == ENODATA:
                 xt = rsc.server.xtime(path, self.uuid)
                 if not isinstance(xt, int):
@@ -247,26 +292,10 @@ class TarSSHEngine(object):
         logging.debug('files: %s' % (files))
         self.current_files_skipped_count = 0
         del self.skipped_gfid_list[:]
-        for f in files:
-            pb = self.syncer.add(f)
-
-            def regjob(se, xte, pb):
-                rv = pb.wait()
-                if rv[0]:
-                    logging.debug('synced ' + se)
-                    return True
-                else:
-                    # stat check for file presence
-                    st = lstat(se)
-                    if isinstance(st, int):
-                        # file got unlinked in the interim
-                        self.unlinked_gfids.append(se)
-                        return True
-
-                    se_list = se.split('/')
-                    self.current_files_skipped_count += 1
-                    self.skipped_gfid_list.append(se_list[1])
-            self.add_job(self.FLAT_DIR_HIERARCHY, 'reg', regjob, f, None, pb)
+        if files:
+            boxes = self.syncer.add(files)
+            self.add_job(self.FLAT_DIR_HIERARCHY, 'reg', self.syncdata_job,
+                         boxes)
 
     def syncdata_wait(self):
         if self.wait(self.FLAT_DIR_HIERARCHY, None):
@@ -285,27 +314,35 @@ class RsyncEngine(object):
         logging.debug('files: %s' % (files))
         self.current_files_skipped_count = 0
         del self.skipped_gfid_list[:]
-        for f in files:
-            logging.debug('candidate for syncing %s' % f)
-            pb = self.syncer.add(f)
-
-            def regjob(se, xte, pb):
-                rv = pb.wait()
-                if rv[0]:
-                    logging.debug('synced ' + se)
-                    return True
-                else:
-                    # stat to check if the file exist
-                    st = lstat(se)
-                    if isinstance(st, int):
-                        # file got unlinked in the interim
-                        self.unlinked_gfids.append(se)
-                        return True
+        if files:
+            boxes = self.syncer.add(files)
+            self.add_job(self.FLAT_DIR_HIERARCHY, 'reg', self.syncdata_job,
+                         boxes)
+
+    def syncdata_wait(self):
+        if self.wait(self.FLAT_DIR_HIERARCHY, None):
+            return True
 
-                    se_list = se.split('/')
-                    self.current_files_skipped_count += 1
-                    self.skipped_gfid_list.append(se_list[1])
-            self.add_job(self.FLAT_DIR_HIERARCHY, 'reg', regjob, f, None, pb)
+    def syncdata(self, files):
+        self.a_syncdata(files)
+        self.syncdata_wait()
+
+
+class NativeEngine(object):
+
+    """Sync engine that sends file data through the gsyncd
+       connection, written by the slave gsyncd itself.
+       Does not sync xattrs and ACLs.
+    """
+
+    def a_syncdata(self, files):
+        logging.debug('files: %s' % (files))
+        self.current_files_skipped_count = 0
+        del self.skipped_gfid_list[:]
+        if files:
+            boxes = self.syncer.add(files)
+            self.add_job(self.FLAT_DIR_HIERARCHY, 'reg', self.syncdata_job,
+                         boxes)
 
     def syncdata_wait(self):
         if self.wait(self.FLAT_DIR_HIERARCHY, None):
@@ -323,6 +360,15 @@ class GMasterCommon(object):
     KFGN = 0
     KNAT = 1
 
+    # bookkeeping of changelog processing is per thread, so that
+    # independent batches can be started by concurrent workers
+    jobtab = _thread_local_attr('jobtab', dict)
+    unlinked_gfids = _thread_local_attr('unlinked_gfids', list)
+    files_in_batch = _thread_local_attr('files_in_batch', int)
+    skipped_gfid_list = _thread_local_attr('skipped_gfid_list', list)
+    current_files_skipped_count = _thread_local_attr(
+        'current_files_skipped_count', int)
+
     def get_sys_volinfo(self):
         """query volume marks on fs root
 
@@ -364,6 +410,20 @@ class GMasterCommon(object):
         self.make_xtime_opts(rsc == self.master, opts)
         return self.xtime_low(rsc, path, **opts)
 
+    def slave_xtimes(self, paths):
+        """xtime(path, self.slave) for each of @paths
+
+        The stimes are fetched from the slave in one call, if it has
+        the bulk call (ie. it speaks the framed RePCe protocol).
+        Return a dict mapping the paths to their xtimes.
+        """
+        if len(paths) > 1 and getattr(self.slave.server, 'framed', False):
+            stimes = self.slave.server.stimes(paths, self.uuid)
+        else:
+            stimes = [None] * len(paths)
+        return dict((path, self.xtime(path, self.slave, stime=st))
+                    for path, st in zip(paths, stimes))
+
     def get_initial_crawl_data(self):
         # while persisting only 'files_syncd' is non-zero, rest of
         # the stats are nulls. lets keep it that way in case they
@@ -396,10 +456,16 @@ class GMasterCommon(object):
     def __init__(self, master, slave):
         self.master = master
         self.slave = slave
+        self.tls = local()
         self.jobtab = {}
-        if boolify(gconf.use_tarssh):
+        engine = sync_engine()
+        if engine == 'tarssh':
             logging.info("using 'tar over ssh' as the sync engine")
             self.syncer = Syncer(slave, self.slave.tarssh, [2])
+        elif engine == 'native':
+            logging.info("using the native sync engine")
+            # some files failed, like a partial transfer of rsync
+            self.syncer = Syncer(slave, self.slave.native, [1])
         else:
             logging.info("using 'rsync' as the sync engine")
             # partial transfer (cf. rsync(1)), that's normal
@@ -415,6 +481,8 @@ class GMasterCommon(object):
         # 0.
         self.crawls = 0
         self.turns = 0
+        # batches are started by concurrent workers
+        self.turns_lock = Lock()
         self.total_turns = int(gconf.turns)
         self.crawl_start = datetime.now()
         self.lastreport = {'crawls': 0, 'turns': 0, 'time': 0}
@@ -542,6 +610,8 @@ class GMasterCommon(object):
                 self.lastreport.update(crawls=self.crawls,
                                        turns=self.turns,
                                        time=self.start)
+                self.log_slave_stats()
+                self.log_metrics()
             t1 = time.time()
             if int(t1 - t0) >= int(gconf.replica_failover_interval):
                 crawl = self.should_crawl()
@@ -577,6 +647,7 @@ class GMasterCommon(object):
                 continue
 
             self.status.set_active()
+            self.status.publish_metrics()
             self.crawl()
 
             if oneshot:
@@ -617,6 +688,30 @@ class GMasterCommon(object):
             self.jobtab[path] = []
         self.jobtab[path].append((label, a, lambda: job(*a, **kw)))
 
+    def syncdata_job(self, boxes):
+        """collect the outcome of transfers as returned by Syncer.add()
+
+        The whole set shares one job, files of a failed transfer
+        which vanished in the interim are not taken as failures.
+        """
+        succeed = True
+        for pb, files in boxes:
+            rv = pb.wait()
+            if rv[0]:
+                logging.debug('synced %d files' % len(files))
+                continue
+            for se in files:
+                # stat check for file presence
+                st = lstat(se)
+                if isinstance(st, int):
+                    # file got unlinked in the interim
+                    self.unlinked_gfids.append(se)
+                    continue
+                succeed = False
+                self.current_files_skipped_count += 1
+                self.skipped_gfid_list.append(se.split('/')[1])
+        return succeed
+
     def add_failjob(self, path, label):
         """invoke .add_job with a job that does nothing just fails"""
         logging.debug('salvaged: ' + label)
@@ -659,23 +754,152 @@ class XCrawlMetadata(object):
         self.st_mtime = float(st_mtime)
 
 
+class ChangelogBatch(object):
+
+    """a batch of changelogs along with its in-flight sync state"""
+
+    def __init__(self, changes, done=1):
+        self.changes = changes
+        self.done = done
+        self.tries = 0
+        self.files_in_batch = 0
+        self.unlinked_gfids = []
+        self.jobs = []
+        self.started = time.time()
+        self.profile = Profile("batch")
+
+
+def coalesce_records(records):
+    """fold redundant changelog records of a batch
+
+    Records are taken per GFID, in changelog order:
+
+    - a regular file, device or symlink created and unlinked within
+      the batch leaves no trace (unless hardlinked or renamed, as
+      a rename might have replaced an existing entry)
+    - successive renames of a GFID are merged into one (or dropped,
+      if it ends up at its old name), provided the intermediate name
+      was freed within the batch before the GFID was renamed to it,
+      so no entry of the slave gets replaced there, and that no other
+      entry record in between refers to any of the names (or removes
+      one of the parents) involved
+    - of repeated DATA or METADATA records of a GFID only the last
+      is kept
+    - DATA records are dropped when followed by an unlink of the GFID,
+      if it was created within the batch and has no other links
+
+    Surviving records keep their relative order; a merged rename
+    takes the place of the last rename of the chain.
+
+    Return the list of surviving records.
+    """
+    records = list(records)
+    dropped = set()
+    # GFID -> index of the creation of a file within the batch
+    created = {}
+    # GFIDs created within the batch (and not hardlinked since)
+    born = set()
+    linked = set()
+    # GFID -> index of its last rename
+    renames = {}
+    # GFID -> {op: index of the last DATA/METADATA record}
+    pending = {}
+    # entry name -> index of the last entry record referring to it
+    names = {}
+    # GFID -> index of its RMDIR
+    rmdirs = {}
+    # entry name -> whether it is known to be free at this point
+    free = {}
+    # rename index -> whether its destination was free
+    free_dst = {}
+
+    def entry_names(rec):
+        if rec.op == 'RENAME':
+            return rec.fields[-2:]
+        if rec.op in ['UNLINK', 'RMDIR']:
+            # a deleted path may follow the entry
+            return rec.fields[:1]
+        return rec.fields[-1:]
+
+    def drop_pending(gfid, ops=None):
+        ixs = pending.get(gfid, {})
+        for op in list(ixs) if ops is None else ops:
+            if op in ixs:
+                dropped.add(ixs.pop(op))
+
+    for i, rec in enumerate(records):
+        gfid = rec.gfid
+        if rec.type in [TYPE_DATA, TYPE_META]:
+            op = rec.op or 'DATA'
+            drop_pending(gfid, [op])
+            pending.setdefault(gfid, {})[op] = i
+            continue
+        if rec.type != TYPE_ENTRY:
+            continue
+
+        ens = entry_names(rec)
+        if rec.op in ['CREATE', 'MKNOD', 'SYMLINK']:
+            created[gfid] = i
+            born.add(gfid)
+        elif rec.op == 'LINK':
+            linked.add(gfid)
+            created.pop(gfid, None)
+            born.discard(gfid)
+        elif rec.op == 'RENAME':
+            created.pop(gfid, None)
+            free_dst[i] = free.get(ens[1], False)
+            j = renames.get(gfid)
+            if j is not None and gfid not in linked:
+                src = records[j].fields[-2]
+                via, dst = ens
+                if via == records[j].fields[-1] and free_dst[j] and \
+                   all(names.get(en, -1) <= j for en in (src, via, dst)) and \
+                   all(rmdirs.get(entry2pb(unescape(en))[0], -1) <= j
+                       for en in (src, via)):
+                    dropped.add(j)
+                    ens = (src, dst)
+                    rec = ChangelogRecord(rec.type, gfid, rec.op,
+                                          rec.fields[:-2] + ens)
+                    records[i] = rec
+            renames[gfid] = i
+            if ens[0] == ens[1]:
+                # renamed back and forth
+                dropped.add(i)
+                del renames[gfid]
+        elif rec.op in ['UNLINK', 'RMDIR']:
+            renames.pop(gfid, None)
+            if rec.op == 'RMDIR':
+                drop_pending(gfid, ['DATA', 'SETXATTR'])
+                rmdirs[gfid] = i
+            elif gfid in born:
+                drop_pending(gfid, ['DATA', 'SETXATTR'])
+                if gfid in created:
+                    dropped.add(created.pop(gfid))
+                    dropped.add(i)
+                    drop_pending(gfid)
+
+        for en in ens:
+            names[en] = i
+        if rec.op in ['UNLINK', 'RMDIR']:
+            free[ens[0]] = True
+        elif rec.op == 'RENAME':
+            free[ens[0]] = True
+            free[ens[1]] = False
+        else:
+            for en in ens:
+                free[en] = False
+
+    return [rec for i, rec in enumerate(records) if i not in dropped]
+
+
 class GMasterChangelogMixin(GMasterCommon):
 
     """ changelog based change detection and syncing """
 
-    # index for change type and entry
-    IDX_START = 0
-    IDX_END = 2
-    UNLINK_ENTRY = 2
-
-    POS_GFID = 0
-    POS_TYPE = 1
+    # index of the entry within the fields of a changelog record
+    UNLINK_ENTRY = 0
     POS_ENTRY1 = -1
 
-    TYPE_META = "M "
-    TYPE_GFID = "D "
-    TYPE_ENTRY = "E "
-
     # flat directory hierarchy for gfid based access
     FLAT_DIR_HIERARCHY = '.'
 
@@ -742,38 +966,59 @@ class GMasterChangelogMixin(GMasterCommon):
             purge_time = None
         return purge_time
 
-    def process_change(self, change, done, retry):
+    def prefetch_entry_stats(self, records):
+        """lstat() the GFIDs of entries in @records which need stat data
+
+        This is done for all of them in one go, deduplicated and spread
+        over a few threads, instead of one by one against the aux mount.
+        Symlink targets are read the same way.
+
+        Return a pair of dicts, one mapping aux GFID paths to lstat()
+        results, one mapping symlink entries to readlink() results
+        (errno on ENOENT, as usual).
+        """
+        pfx = gauxpfx()
+        gfids = set()
+        symlinks = set()
+        for rec in records:
+            if rec.type != TYPE_ENTRY or \
+               rec.op in ['UNLINK', 'RMDIR', 'CREATE', 'MKDIR', 'MKNOD']:
+                continue
+            gfids.add(os.path.join(pfx, rec.gfid))
+            if rec.op == 'SYMLINK':
+                en = rec.fields[self.POS_ENTRY1]
+                symlinks.add(unescape(os.path.join(pfx, en)))
+
+        nthreads = int(gconf.entry_stat_threads)
+        stats = parallel_map(lstat, gfids, nthreads)
+        links = parallel_map(
+            lambda en: errno_wrap(os.readlink, [en], [ENOENT]),
+            symlinks, nthreads)
+        return stats, links
+
+    def process_records(self, records):
         pfx = gauxpfx()
-        clist = []
         entries = []
         meta_gfid = set()
         datas = set()
 
         # basic crawl stats: files and bytes
         files_pending = {'count': 0, 'purge': 0, 'bytes': 0, 'files': []}
-        try:
-            f = open(change, "r")
-            clist = f.readlines()
-            f.close()
-        except IOError:
-            raise
 
         def edct(op, **ed):
-            dct = {}
-            dct['op'] = op
-            for k in ed:
-                if k == 'stat':
-                    st = ed[k]
-                    dst = dct['stat'] = {}
-                    if st:
-                        dst['uid'] = st.st_uid
-                        dst['gid'] = st.st_gid
-                        dst['mode'] = st.st_mode
-                        dst['atime'] = st.st_atime
-                        dst['mtime'] = st.st_mtime
+            # the keyword dict itself is the entry, just amend it
+            ed['op'] = op
+            if 'stat' in ed:
+                st = ed['stat']
+                if st:
+                    ed['stat'] = {'uid': st.st_uid,
+                                  'gid': st.st_gid,
+                                  'mode': st.st_mode,
+                                  'atime': st.st_atime,
+                                  'mtime': st.st_mtime}
                 else:
-                    dct[k] = ed[k]
-            return dct
+                    ed['stat'] = {}
+            return ed
 
         # entry counts (not purges)
         def entry_update():
@@ -793,22 +1038,22 @@ class GMasterChangelogMixin(GMasterCommon):
 
             self.status.inc_value("failures", num_failures)
 
-        for e in clist:
-            e = e.strip()
-            et = e[self.IDX_START:self.IDX_END]   # entry type
-            ec = e[self.IDX_END:].split(' ')      # rest of the bits
+        stats, links = self.prefetch_entry_stats(records)
 
-            if et == self.TYPE_ENTRY:
+        for rec in records:
+            ec = rec.fields
+
+            if rec.type == TYPE_ENTRY:
                 # extract information according to the type of
                 # the entry operation. create(), mkdir() and mknod()
                 # have mode, uid, gid information in the changelog
                 # itself, so no need to stat()...
-                ty = ec[self.POS_TYPE]
+                ty = rec.op
 
                 # PARGFID/BNAME
                 en = unescape(os.path.join(pfx, ec[self.POS_ENTRY1]))
                 # GFID of the entry
-                gfid = ec[self.POS_GFID]
+                gfid = rec.gfid
 
                 if ty in ['UNLINK', 'RMDIR']:
                     # The index of PARGFID/BNAME for UNLINK, RMDIR
@@ -818,7 +1063,7 @@ class GMasterChangelogMixin(GMasterCommon):
 
                     # Remove from DATA list, so that rsync will
                     # not fail
-                    pt = os.path.join(pfx, ec[0])
+                    pt = os.path.join(pfx, gfid)
                     if pt in datas:
                         datas.remove(pt)
 
@@ -829,11 +1074,11 @@ class GMasterChangelogMixin(GMasterCommon):
                     entry_update()
                     # stat information present in the changelog itself
                     entries.append(edct(ty, gfid=gfid, entry=en,
-                                        mode=int(ec[2]),
-                                        uid=int(ec[3]), gid=int(ec[4])))
+                                        mode=int(ec[0]),
+                                        uid=int(ec[1]), gid=int(ec[2])))
                 elif ty == "RENAME":
                     go = os.path.join(pfx, gfid)
-                    st = lstat(go)
+                    st = stats[go]
                     if isinstance(st, int):
                         st = {}
 
@@ -844,7 +1089,7 @@ class GMasterChangelogMixin(GMasterCommon):
                 else:
                     # stat() to get mode and other information
                     go = os.path.join(pfx, gfid)
-                    st = lstat(go)
+                    st = stats[go]
                     if isinstance(st, int):
                         logging.debug('file %s got purged in the interim' % go)
                         continue
@@ -853,7 +1098,7 @@ class GMasterChangelogMixin(GMasterCommon):
                         entry_update()
                         entries.append(edct(ty, stat=st, entry=en, gfid=gfid))
                     elif ty == 'SYMLINK':
-                        rl = errno_wrap(os.readlink, [en], [ENOENT])
+                        rl = links[en]
                         if isinstance(rl, int):
                             continue
                         entry_update()
@@ -861,36 +1106,37 @@ class GMasterChangelogMixin(GMasterCommon):
                             edct(ty, stat=st, entry=en, gfid=gfid, link=rl))
                     else:
                         logging.warn('ignoring %s [op %s]' % (gfid, ty))
-            elif et == self.TYPE_GFID:
+            elif rec.type == TYPE_DATA:
                 # If self.unlinked_gfids is available, then that means it is
                 # retrying the changelog second time. Do not add the GFID's
                 # to rsync job if failed previously but unlinked in master
-                if self.unlinked_gfids and \
-                   os.path.join(pfx, ec[0]) in self.unlinked_gfids:
+                go = os.path.join(pfx, rec.gfid)
+                if self.unlinked_gfids and go in self.unlinked_gfids:
                     logging.debug("ignoring data, since file purged interim")
                 else:
-                    datas.add(os.path.join(pfx, ec[0]))
-            elif et == self.TYPE_META:
-                if ec[1] == 'SETATTR':  # only setattr's for now...
+                    datas.add(go)
+            elif rec.type == TYPE_META:
+                if rec.op == 'SETATTR':  # only setattr's for now...
                     if len(ec) == 5:
                         # In xsync crawl, we already have stat data
                         # avoid doing stat again
-                        meta_gfid.add((os.path.join(pfx, ec[0]),
-                                       XCrawlMetadata(st_uid=ec[2],
-                                                      st_gid=ec[3],
-                                                      st_mode=ec[4],
-                                                      st_atime=ec[5],
-                                                      st_mtime=ec[6])))
+                        meta_gfid.add((os.path.join(pfx, rec.gfid),
+                                       XCrawlMetadata(st_uid=ec[0],
+                                                      st_gid=ec[1],
+                                                      st_mode=ec[2],
+                                                      st_atime=ec[3],
+                                                      st_mtime=ec[4])))
                     else:
-                        meta_gfid.add((os.path.join(pfx, ec[0]), ))
-                elif ec[1] == 'SETXATTR':
+                        meta_gfid.add((os.path.join(pfx, rec.gfid), ))
+                elif rec.op == 'SETXATTR':
                     # To sync xattr/acls use rsync/tar, --xattrs and --acls
                     # switch to rsync and tar
-                    if not boolify(gconf.use_tarssh) and \
-                       (boolify(gconf.sync_xattrs) or boolify(gconf.sync_acls)):
-                        datas.add(os.path.join(pfx, ec[0]))
+                    xattrs = boolify(gconf.sync_xattrs) or \
+                        boolify(gconf.sync_acls)
+                    if sync_engine() == 'rsync' and xattrs:
+                        datas.add(os.path.join(pfx, rec.gfid))
             else:
-                logging.warn('got invalid changelog type: %s' % (et))
+                logging.warn('got invalid changelog type: %s' % (rec.type))
         logging.debug('entries: %s' % repr(entries))
 
         # Increment counters for Status
@@ -898,141 +1144,206 @@ class GMasterChangelogMixin(GMasterCommon):
         self.files_in_batch += len(datas)
         self.status.inc_value("data", len(datas))
 
-        # sync namespace
-        if entries:
-            failures = self.slave.server.entry_ops(entries)
-            log_failures(failures, 'gfid', gauxpfx(), 'ENTRY')
-            self.status.dec_value("entry", len(entries))
-
-        # sync metadata
+        # metadata of the entries as they are now
+        meta_entries = []
         if meta_gfid:
-            meta_entries = []
+            sts = parallel_map(lstat, [go[0] for go in meta_gfid
+                                       if len(go) == 1],
+                               int(gconf.entry_stat_threads))
             for go in meta_gfid:
                 if len(go) > 1:
                     st = go[1]
                 else:
-                    st = lstat(go[0])
+                    st = sts[go[0]]
                 if isinstance(st, int):
                     logging.debug('file %s got purged in the interim' % go[0])
                     continue
                 meta_entries.append(edct('META', go=go[0], stat=st))
-            if meta_entries:
-                self.status.inc_value("meta", len(entries))
-                failures = self.slave.server.meta_ops(meta_entries)
-                log_failures(failures, 'go', '', 'META')
-                self.status.dec_value("meta", len(entries))
+
+        # sync namespace and metadata: the calls go out together and
+        # are served in order, saving a round trip
+        calls = []
+        if entries:
+            calls.append(('entry_ops', (entries,)))
+        if meta_entries:
+            self.status.inc_value("meta", len(entries))
+            calls.append(('meta_ops', (meta_entries,)))
+        t0 = time.time()
+        jobs = self.slave.server.futures(calls)
+        if entries:
+            failures = jobs.pop(0).get()
+            t1 = time.time()
+            self.status.metrics.record("entry_ops", len(entries), t1 - t0)
+            t0 = t1
+            log_failures(failures, 'gfid', gauxpfx(), 'ENTRY')
+            self.status.dec_value("entry", len(entries))
+        if meta_entries:
+            failures = jobs.pop(0).get()
+            self.status.metrics.record("meta_ops", len(meta_entries),
+                                       time.time() - t0)
+            log_failures(failures, 'go', '', 'META')
+            self.status.dec_value("meta", len(entries))
 
         # sync data
         if datas:
             self.a_syncdata(datas)
 
-    def process(self, changes, done=1):
-        tries = 0
-        retry = False
-        self.unlinked_gfids = []
-        self.files_in_batch = 0
-
-        while True:
-            self.skipped_gfid_list = []
-            self.current_files_skipped_count = 0
+    def process_batch_start(self, batch, retry=False):
+        """perform entry and metadata operations of @batch
 
-            # first, fire all changelog transfers in parallel. entry and
-            # metadata are performed synchronously, therefore in serial.
-            # However at the end of each changelog, data is synchronized
-            # with syncdata_async() - which means it is serial w.r.t
-            # entries/metadata of that changelog but happens in parallel
-            # with data of other changelogs.
+        Data transfers of the batch are fired off but not waited for,
+        the jobs are stashed in the batch and reaped by
+        .process_batch_wait().
+        """
+        with batch.profile:
+            self.unlinked_gfids = batch.unlinked_gfids
+            self.files_in_batch = 0
 
-            for change in changes:
+            # records of all the changelogs of the batch are taken in one
+            # go, so that operations cancelling or superseding each other
+            # can be folded before hitting the slave. Entry and metadata
+            # are performed synchronously, therefore in serial. Data is
+            # then synchronized with syncdata_async() - which means it is
+            # serial w.r.t entries/metadata of the batch but happens in
+            # parallel with data of other batches.
+            records = []
+            t0 = time.time()
+            for change in batch.changes:
                 logging.debug('processing change %s' % change)
-                self.process_change(change, done, retry)
+                records.extend(parse_changelog(change))
                 if not retry:
                     # number of changelogs processed in the batch
-                    self.turns += 1
-
-            # Now we wait for all the data transfers fired off in the above
-            # step to complete. Note that this is not ideal either. Ideally
-            # we want to trigger the entry/meta-data transfer of the next
-            # batch while waiting for the data transfer of the current batch
-            # to finish.
-
-            # Note that the reason to wait for the data transfer (vs doing it
-            # completely in the background and call the changelog_done()
-            # asynchronously) is because this waiting acts as a "backpressure"
-            # and prevents a spiraling increase of wait stubs from consuming
-            # unbounded memory and resources.
-
-            # update the slave's time with the timestamp of the _last_
-            # changelog file time suffix. Since, the changelog prefix time
-            # is the time when the changelog was rolled over, introduce a
-            # tolerance of 1 second to counter the small delta b/w the
-            # marker update and gettimeofday().
-            # NOTE: this is only for changelog mode, not xsync.
-
-            # @change is the last changelog (therefore max time for this batch)
-            if self.syncdata_wait():
-                self.unlinked_gfids = []
-                if done:
-                    xtl = (int(change.split('.')[-1]) - 1, 0)
-                    self.upd_stime(xtl)
-                    chkpt_time = gconf.configinterface.get_realtime(
-                        "checkpoint")
-                    checkpoint_time = 0
-                    if chkpt_time is not None:
-                        checkpoint_time = int(chkpt_time)
-
-                    self.status.set_last_synced(xtl, checkpoint_time)
-                    map(self.changelog_done_func, changes)
-                    self.archive_and_purge_changelogs(changes)
-
-                # Reset Data counter after sync
-                self.status.dec_value("data", self.files_in_batch)
-                self.files_in_batch = 0
-                break
-
-            # We do not know which changelog transfer failed, retry everything.
-            retry = True
-            tries += 1
-            if tries == self.MAX_RETRIES:
-                logging.warn('changelogs %s could not be processed - '
-                             'moving on...' %
-                             ' '.join(map(os.path.basename, changes)))
-                self.status.inc_value("failures",
-                                      self.current_files_skipped_count)
-                logging.warn('SKIPPED GFID = %s' %
-                             ','.join(self.skipped_gfid_list))
-
-                # Reset data counter on failure
-                self.status.dec_value("data", self.files_in_batch)
-                self.files_in_batch = 0
-
-                if done:
-                    xtl = (int(change.split('.')[-1]) - 1, 0)
-                    self.upd_stime(xtl)
-                    chkpt_time = gconf.configinterface.get_realtime(
-                        "checkpoint")
-                    checkpoint_time = 0
-                    if chkpt_time is not None:
-                        checkpoint_time = int(chkpt_time)
-
-                    self.status.set_last_synced(xtl, checkpoint_time)
-                    map(self.changelog_done_func, changes)
-                    self.archive_and_purge_changelogs(changes)
-                break
-            # it's either entry_ops() or Rsync that failed to do it's
-            # job. Mostly it's entry_ops() [which currently has a problem
-            # of failing to create an entry but failing to return an errno]
-            # Therefore we do not know if it's either Rsync or the freaking
-            # entry_ops() that failed... so we retry the _whole_ changelog
-            # again.
-            # TODO: remove entry retries when it's gets fixed.
-            logging.warn('incomplete sync, retrying changelogs: %s' %
-                         ' '.join(map(os.path.basename, changes)))
-
-            # Reset the Data counter before Retry
-            self.status.dec_value("data", self.files_in_batch)
+                    with self.turns_lock:
+                        self.turns += 1
+            if boolify(gconf.coalesce_changelogs):
+                nrecs = len(records)
+                records = coalesce_records(records)
+                logging.debug('coalesced %d changelog records into %d' %
+                              (nrecs, len(records)))
+            self.status.metrics.record("changelog_parse",
+                                       0 if retry else len(batch.changes),
+                                       time.time() - t0)
+            with self.status.metrics.timer("process_records"):
+                self.process_records(records)
+
+            batch.files_in_batch = self.files_in_batch
             self.files_in_batch = 0
-            time.sleep(0.5)
+            batch.jobs = self.jobtab.pop(self.FLAT_DIR_HIERARCHY, [])
+
+    def process_batch_done(self, batch):
+        """update stime and release the changelogs of @batch"""
+        # update the slave's time with the timestamp of the _last_
+        # changelog file time suffix. Since, the changelog prefix time
+        # is the time when the changelog was rolled over, introduce a
+        # tolerance of 1 second to counter the small delta b/w the
+        # marker update and gettimeofday().
+        # NOTE: this is only for changelog mode, not xsync.
+
+        # the last change is the max time for this batch
+        change = batch.changes[-1]
+        xtl = (int(change.split('.')[-1]) - 1, 0)
+        self.upd_stime(xtl)
+        chkpt_time = gconf.configinterface.get_realtime("checkpoint")
+        checkpoint_time = 0
+        if chkpt_time is not None:
+            checkpoint_time = int(chkpt_time)
+
+        self.status.set_last_synced(xtl, checkpoint_time)
+        self.status.metrics.set_synced(xtl[0])
+        self.status.publish_metrics()
+        map(self.changelog_done_func, batch.changes)
+        self.archive_and_purge_changelogs(batch.changes)
+
+    def process_batch_wait(self, batch, later=()):
+        """wait for the data transfers of @batch, retry it if needed
+
+        @later are the batches started after @batch and still in
+        flight, in order. Their entry operations were performed on top
+        of the ones of @batch, so they are redone after a retry of it.
+
+        Note that the reason to wait for the data transfer (vs doing it
+        completely in the background and call the changelog_done()
+        asynchronously) is because this waiting acts as a "backpressure"
+        and prevents a spiraling increase of wait stubs from consuming
+        unbounded memory and resources.
+        """
+        with batch.profile:
+            while True:
+                self.unlinked_gfids = batch.unlinked_gfids
+                self.skipped_gfid_list = []
+                self.current_files_skipped_count = 0
+
+                self.jobtab[self.FLAT_DIR_HIERARCHY] = batch.jobs
+                batch.jobs = []
+                with self.status.metrics.timer("syncdata_wait"):
+                    synced = self.syncdata_wait()
+                if synced:
+                    self.unlinked_gfids = []
+                    self.status.metrics.record("batch", len(batch.changes),
+                                               time.time() - batch.started)
+                    if batch.done:
+                        self.process_batch_done(batch)
+
+                    # Reset Data counter after sync
+                    self.status.dec_value("data", batch.files_in_batch)
+                    batch.files_in_batch = 0
+                    break
+
+                # We do not know which changelog transfer failed,
+                # retry everything.
+                batch.tries += 1
+                if batch.tries == self.MAX_RETRIES:
+                    logging.warn('changelogs %s could not be processed - '
+                                 'moving on...' %
+                                 ' '.join(map(os.path.basename,
+                                              batch.changes)))
+                    self.status.inc_value("failures",
+                                          self.current_files_skipped_count)
+                    logging.warn('SKIPPED GFID = %s' %
+                                 ','.join(self.skipped_gfid_list))
+
+                    # Reset data counter on failure
+                    self.status.dec_value("data", batch.files_in_batch)
+                    batch.files_in_batch = 0
+                    self.status.metrics.record("batch", len(batch.changes),
+                                               time.time() - batch.started)
+                    self.status.metrics.incr("batches_skipped")
+
+                    if batch.done:
+                        self.process_batch_done(batch)
+                    break
+                # it's either entry_ops() or Rsync that failed to do it's
+                # job. Mostly it's entry_ops() [which currently has a problem
+                # of failing to create an entry but failing to return an errno]
+                # Therefore we do not know if it's either Rsync or the freaking
+                # entry_ops() that failed... so we retry the _whole_ changelog
+                # again.
+                # TODO: remove entry retries when it's gets fixed.
+                logging.warn('incomplete sync, retrying changelogs: %s' %
+                             ' '.join(map(os.path.basename, batch.changes)))
+
+                # Reset the Data counter before Retry
+                self.status.dec_value("data", batch.files_in_batch)
+                batch.files_in_batch = 0
+                # settle the transfers of the later batches, they are
+                # redone after this one
+                for lb in later:
+                    self.unlinked_gfids = lb.unlinked_gfids
+                    self.jobtab[self.FLAT_DIR_HIERARCHY] = lb.jobs
+                    lb.jobs = []
+                    self.syncdata_wait()
+                    self.status.dec_value("data", lb.files_in_batch)
+                    lb.files_in_batch = 0
+                time.sleep(0.5)
+                self.process_batch_start(batch, retry=True)
+                for lb in later:
+                    self.process_batch_start(lb, retry=True)
+        batch.profile.dump(os.path.basename(batch.changes[-1]))
+
+    def process(self, changes, done=1):
+        batch = ChangelogBatch(changes, done)
+        self.process_batch_start(batch)
+        self.process_batch_wait(batch)
 
     def upd_stime(self, stime, path=None):
         if not path:
@@ -1040,6 +1351,46 @@ class GMasterChangelogMixin(GMasterCommon):
         if not stime == URXTIME:
             self.sendmark(path, stime)
 
+    def log_slave_stats(self):
+        """log the RPC queue and the most time consuming calls of
+        the slave"""
+        if not hasattr(self.slave.server, '__stats__'):
+            return
+        stats = self.slave.server.__stats__()
+        if not stats:
+            return
+        busiest = sorted(stats['methods'].items(),
+                         key=lambda ms: ms[1]['time'], reverse=True)[:3]
+        logging.info("slave queue: %d (max %d), replies: %d, busiest: %s" %
+                     (stats['queue']['size'], stats['queue']['max'],
+                      stats['replies'],
+                      ", ".join("%s %d calls %.3fs (max %.3fs)" %
+                                (meth, ms['calls'], ms['time'], ms['max'])
+                                for meth, ms in busiest)))
+
+    def log_metrics(self):
+        """log the rates and phase timings of the last minute or so"""
+        m = self.status.publish_metrics()
+        logging.info("%.2f changelogs/s, %.2f entries/s, %d bytes/s, "
+                     "time spent in parsing: %.3fs, entry ops: %.3fs, "
+                     "meta ops: %.3fs, data: %.3fs, lag: %s, catch up in: %s" %
+                     (m['changelogs_per_sec'], m['entries_per_sec'],
+                      m['bytes_per_sec'], m['changelog_parse_time'],
+                      m['entry_ops_time'], m['meta_ops_time'],
+                      m['data_time'], m['lag'], m['catchup_eta']))
+        calls = self.changelog_agent_stats()
+        if calls:
+            logging.info("changelog agent calls: %s" %
+                         ", ".join("%s %d calls %.3fs (max %.3fs)" %
+                                   (meth, ms['calls'], ms['time'], ms['max'])
+                                   for meth, ms in sorted(calls.items())))
+
+    def changelog_agent_stats(self):
+        agent = getattr(self, 'changelog_agent', None)
+        if not agent or not hasattr(agent, 'call_stats'):
+            return None
+        return agent.call_stats()
+
     def update_worker_remote_node(self):
         node = sys.argv[-1]
         node_data = node.split("@")
@@ -1065,9 +1416,74 @@ class GMasterChangelogMixin(GMasterCommon):
                 else:
                     changelogs_batches[-1].append(c)
 
-        for batch in changelogs_batches:
-            logging.debug('processing changes %s' % repr(batch))
-            self.process(batch)
+        # Batches are pipelined: while the data transfers of a batch
+        # drain, entry and metadata operations of the following ones
+        # (up to the pipeline depth) are already performed. Batches
+        # are completed in order, so stime advances only after all
+        # the earlier batches are synced. A batch retried redoes the
+        # ones in flight after it, to keep entry operations in order.
+        #
+        # With multiple batch workers, consecutive batches which do
+        # not touch a common GFID (including parent directories) are
+        # started concurrently, a batch conflicting with one of them
+        # is held back until they are all started.
+        workers = max(1, int(gconf.batch_workers))
+        depth = max(1, int(gconf.batch_pipeline_depth), workers)
+        inflight = []
+        wave = []
+        wave_gfids = set()
+
+        def run_wave():
+            if len(wave) == 1:
+                self.process_batch_start(wave[0])
+            else:
+                threads = [Thread(target=self.process_batch_start,
+                                  args=(batch,)) for batch in wave]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            inflight.extend(wave)
+            while len(inflight) >= depth:
+                self.process_batch_wait(inflight.pop(0), inflight)
+            del wave[:]
+            wave_gfids.clear()
+
+        for changes in changelogs_batches:
+            logging.debug('processing changes %s' % repr(changes))
+            batch = ChangelogBatch(changes)
+            if workers > 1:
+                gfids = self.batch_gfids(changes)
+                if wave and (len(wave) == workers or gfids & wave_gfids):
+                    run_wave()
+                wave_gfids.update(gfids)
+            wave.append(batch)
+            if workers == 1:
+                run_wave()
+
+        if wave:
+            run_wave()
+        while inflight:
+            self.process_batch_wait(inflight.pop(0), inflight)
+
+    def batch_gfids(self, changes):
+        """set of GFIDs touched by @changes, parent GFIDs included"""
+        gfids = set()
+        for change in changes:
+            for rec in parse_changelog(change):
+                gfids.add(rec.gfid)
+                if rec.type != TYPE_ENTRY:
+                    continue
+                if rec.op in ['UNLINK', 'RMDIR']:
+                    # a deleted path may follow the entry
+                    ens = rec.fields[self.UNLINK_ENTRY:self.UNLINK_ENTRY + 1]
+                elif rec.op == 'RENAME':
+                    ens = rec.fields[self.POS_ENTRY1 - 1:]
+                else:
+                    ens = rec.fields[self.POS_ENTRY1:]
+                for en in ens:
+                    gfids.add(entry2pb(unescape(en))[0])
+        return gfids
 
     def crawl(self):
         self.status.set_worker_crawl_status("Changelog Crawl")
@@ -1188,13 +1604,14 @@ class GMasterXsyncMixin(GMasterChangelogMixin):
     This crawl needs to be xtime based (as of now
     it's not. this is because we generate CHANGELOG
     file during each crawl which is then processed
-    by process_change()).
+    by process_records()).
     For now it's used as a one-shot initial sync
     mechanism and only syncs directories, regular
     files, hardlinks and symlinks.
     """
 
     XSYNC_MAX_ENTRIES = 1 << 13
+    xscanner = None
 
     def register(self, register_time=None, changelog_agent=None, status=None):
         self.status = status
@@ -1235,6 +1652,8 @@ class GMasterXsyncMixin(GMasterChangelogMixin):
                 if item[0] == 'finale':
                     logging.info('finished hybrid crawl syncing, stime: %s'
                                  % repr(self.get_purge_time()))
+                    errno_wrap(os.unlink, [self.xcrawl_ckpt_file()],
+                               [ENOENT])
                     break
                 elif item[0] == 'xsync':
                     logging.info('processing xsync changelog %s' % (item[1]))
@@ -1243,6 +1662,8 @@ class GMasterXsyncMixin(GMasterChangelogMixin):
                 elif item[0] == 'stime':
                     logging.debug('setting slave time: %s' % repr(item[1]))
                     self.upd_stime(item[1][1], item[1][0])
+                elif item[0] == 'checkpoint':
+                    self.xcrawl_checkpoint(item[1])
                 else:
                     logging.warn('unknown tuple in comlist (%s)' % repr(item))
             except IndexError:
@@ -1291,7 +1712,7 @@ class GMasterXsyncMixin(GMasterChangelogMixin):
         if last:
             self.put('finale', None)
 
-    def sync_done(self, stime=[], last=False):
+    def sync_done(self, stime=[], last=False, ckpt=None):
         self.sync_xsync(last)
         if stime:
             # Send last as True only for last stime entry
@@ -1300,6 +1721,9 @@ class GMasterXsyncMixin(GMasterChangelogMixin):
 
             if stime and stime[-1]:
                 self.sync_stime(stime[-1], last)
+        if ckpt:
+            # to be saved once the above is processed
+            self.put('checkpoint', ckpt)
 
     def is_sticky(self, path, mo):
         """check for DHTs linkto sticky bit file"""
@@ -1308,27 +1732,24 @@ class GMasterXsyncMixin(GMasterChangelogMixin):
             sticky = self.master.server.linkto_check(path)
         return sticky
 
-    def Xcrawl(self, path='.', xtr_root=None):
-        """
-        generate a CHANGELOG file consumable by process_change.
-
-        slave's xtime (stime) is _cached_ for comparisons across
-        the filesystem tree, but set after directory synchronization.
+    def xcrawl_scan(self, path, xtr_root, after=None, xtr=None):
+        """find the entries of directory @path to be synced
+
+        Return the xtime and the GFID of @path, and a list of
+        (bname, path, xtime, stat, gfid, slave xtime) of the entries
+        in order of their names, or None if @path is in sync. If
+        @after is given, only entries with names past it are taken.
+        @xtr is the xtime of @path on the slave, if known already.
+        The slave xtimes of the subdirectories to be synced are
+        fetched together (it is None for other entries), and the
+        subdirectories are handed over to the scanner, if there is
+        one.
         """
-        if path == '.':
-            self.crawls += 1
-        if not xtr_root:
-            # get the root stime and use it for all comparisons
-            xtr_root = self.xtime('.', self.slave)
-            if isinstance(xtr_root, int):
-                if xtr_root != ENOENT:
-                    logging.warn("slave cluster not returning the "
-                                 "correct xtime for root (%d)" % xtr_root)
-                xtr_root = self.minus_infinity
         xtl = self.xtime(path)
         if isinstance(xtl, int):
             logging.warn("master cluster's xtime not found")
-        xtr = self.xtime(path, self.slave)
+        if xtr is None:
+            xtr = self.xtime(path, self.slave)
         if isinstance(xtr, int):
             if xtr != ENOENT:
                 logging.warn("slave cluster not returning the "
@@ -1336,15 +1757,18 @@ class GMasterXsyncMixin(GMasterChangelogMixin):
             xtr = self.minus_infinity
         xtr = max(xtr, xtr_root)
         if not self.need_sync(path, xtl, xtr):
-            if path == '.':
-                self.sync_done([(path, xtl)], True)
-            return
+            return (xtl, None, None)
         self.xtime_reversion_hook(path, xtl, xtr)
         logging.debug("entering " + path)
-        dem = self.master.server.entries(path)
+        # only directories, regular files and symlinks are synced,
+        # leave the rest out right away
+        dem = sorted(de[0] for de in self.master.server.dentries(path)
+                     if de[1] in (DT_DIR, DT_REG, DT_LNK) and
+                     (after is None or de[0] > after))
         pargfid = self.master.server.gfid(path)
         if isinstance(pargfid, int):
             logging.warn('skipping directory %s' % (path))
+        items = []
         for e in dem:
             bname = e
             e = os.path.join(path, e)
@@ -1366,13 +1790,95 @@ class GMasterXsyncMixin(GMasterChangelogMixin):
             if isinstance(gfid, int):
                 logging.warn('skipping entry %s..' % e)
                 continue
+            items.append((bname, e, xte, st, gfid))
+        xtrs = self.slave_xtimes([it[1] for it in items
+                                  if stat.S_ISDIR(it[3].st_mode)])
+        items = [it + (xtrs.get(it[1]),) for it in items]
+        if self.xscanner:
+            self.xscanner.push([(it[1], it[5]) for it in reversed(items)
+                                if stat.S_ISDIR(it[3].st_mode)])
+        return (xtl, pargfid, items)
+
+    def Xcrawl(self, path='.', xtr_root=None):
+        """
+        generate a CHANGELOG file consumable by process_records.
+
+        slave's xtime (stime) is _cached_ for comparisons across
+        the filesystem tree, but set after directory synchronization.
+
+        Directories are scanned ahead by --xsync-crawl-threads
+        threads, while the changelog is written here, in the same
+        order as a plain depth first walk would do.
+        """
+        self.crawls += 1
+        if not xtr_root:
+            # get the root stime and use it for all comparisons
+            xtr_root = self.xtime('.', self.slave)
+            if isinstance(xtr_root, int):
+                if xtr_root != ENOENT:
+                    logging.warn("slave cluster not returning the "
+                                 "correct xtime for root (%d)" % xtr_root)
+                xtr_root = self.minus_infinity
+        nthreads = int(gconf.xsync_crawl_threads)
+        if nthreads > 1:
+            self.xscanner = Prefetcher(
+                lambda key: self.xcrawl_scan(key[0], xtr_root, xtr=key[1]),
+                nthreads, 4 * nthreads, 64 * nthreads)
+        try:
+            self.xcrawl_walk(path, xtr_root)
+        finally:
+            if self.xscanner:
+                self.xscanner.close()
+                self.xscanner = None
+
+    def xcrawl_stime(self, path, xte):
+        stime_to_update = xte
+        # Live Changelog Start time indicates that from that time
+        # onwards Live changelogs are available. If we update stime
+        # greater than live_changelog_start time then Geo-rep will
+        # skip those changelogs as already processed. But Xsync
+        # actually failed to sync the deletes and Renames. Update
+        # stime as min(Live_changelogs_time, Actual_stime) When it
+        # switches to Changelog mode, it syncs Deletes and Renames.
+        if self.live_changelog_start_time:
+            stime_to_update = min(self.live_changelog_start_time, xte)
+        self.stimes.append((path, stime_to_update))
+
+    def xcrawl_walk(self, path, xtr_root):
+        """walk the tree under @path depth first, writing the changelog
+
+        The directories being walked are kept on a stack, each as
+        [path, xtime, gfid, entries, position, last name done]. Along
+        with each changelog, the stack is checkpointed, so that an
+        interrupted crawl can be resumed (cf. xcrawl_resume()).
+        """
+        stack = self.xcrawl_resume(path, xtr_root)
+        if not stack:
+            xtl, pargfid, items = self.xcrawl_scan(path, xtr_root)
+            if items is None:
+                self.sync_done([(path, xtl)], True)
+                return
+            stack = [[path, xtl, pargfid, items, 0, None]]
+        while stack:
+            fr = stack[-1]
+            pargfid, items, n = fr[2:5]
+            if n == len(items):
+                stack.pop()
+                self.xcrawl_stime(fr[0], fr[1])
+                continue
+            fr[4] = n + 1
+            bname, e, xte, st, gfid, xtr = items[n]
             mo = st.st_mode
             self.counter += 1 if ((stat.S_ISDIR(mo) or
                                    stat.S_ISLNK(mo) or
                                    stat.S_ISREG(mo))) else 0
             if self.counter == self.XSYNC_MAX_ENTRIES:
-                self.sync_done(self.stimes, False)
+                self.sync_done(self.stimes, False,
+                               {'xtr_root': xtr_root,
+                                'frames': [(f[0], f[1], f[5])
+                                           for f in stack]})
                 self.stimes = []
+            fr[5] = bname
             if stat.S_ISDIR(mo):
                 self.write_entry_change("E", [gfid, 'MKDIR', str(mo), str(
                     st.st_uid), str(st.st_gid), escape(os.path.join(pargfid,
@@ -1381,18 +1887,14 @@ class GMasterXsyncMixin(GMasterChangelogMixin):
                                               str(st.st_gid), str(st.st_mode),
                                               str(st.st_atime),
                                               str(st.st_mtime)])
-                self.Xcrawl(e, xtr_root)
-                stime_to_update = xte
-                # Live Changelog Start time indicates that from that time
-                # onwards Live changelogs are available. If we update stime
-                # greater than live_changelog_start time then Geo-rep will
-                # skip those changelogs as already processed. But Xsync
-                # actually failed to sync the deletes and Renames. Update
-                # stime as min(Live_changelogs_time, Actual_stime) When it
-                # switches to Changelog mode, it syncs Deletes and Renames.
-                if self.live_changelog_start_time:
-                    stime_to_update = min(self.live_changelog_start_time, xte)
-                self.stimes.append((e, stime_to_update))
+                if self.xscanner:
+                    scan = self.xscanner.get((e, xtr))
+                else:
+                    scan = self.xcrawl_scan(e, xtr_root, xtr=xtr)
+                if scan[2] is None:
+                    self.xcrawl_stime(e, xte)
+                else:
+                    stack.append([e, xte, scan[1], scan[2], 0, None])
             elif stat.S_ISLNK(mo):
                 self.write_entry_change(
                     "E", [gfid, 'SYMLINK', escape(os.path.join(pargfid,
@@ -1415,12 +1917,52 @@ class GMasterXsyncMixin(GMasterChangelogMixin):
                         "E", [gfid, 'LINK', escape(os.path.join(pargfid,
                                                                 bname))])
                 self.write_entry_change("D", [gfid])
-        if path == '.':
-            stime_to_update = xtl
-            if self.live_changelog_start_time:
-                stime_to_update = min(self.live_changelog_start_time, xtl)
-            self.stimes.append((path, stime_to_update))
-            self.sync_done(self.stimes, True)
+        self.sync_done(self.stimes, True)
+
+    def xcrawl_ckpt_file(self):
+        return os.path.join(self.tempdir, 'XSYNC-CHECKPOINT')
+
+    def xcrawl_checkpoint(self, ckpt):
+        """save @ckpt, which is consistent with the changelogs and
+        stimes processed so far"""
+        fname = self.xcrawl_ckpt_file()
+        with open(fname + '.tmp', 'wb') as f:
+            pickle.dump(ckpt, f, -1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(fname + '.tmp', fname)
+
+    def xcrawl_resume(self, path, xtr_root):
+        """rebuild the stack of an interrupted crawl from its checkpoint
+
+        The checkpoint is taken only if the stime of the root is
+        the same as when it was saved, ie. no other crawl finished
+        meanwhile. Entries up to the last one done are skipped in
+        each directory, the one in progress being the next directory
+        on the stack. Return None if there is nothing to resume.
+        """
+        if not boolify(gconf.xsync_resume):
+            return None
+        try:
+            with open(self.xcrawl_ckpt_file(), 'rb') as f:
+                ckpt = pickle.load(f)
+        except (IOError, EOFError, pickle.PickleError):
+            return None
+        if ckpt['xtr_root'] != xtr_root or ckpt['frames'][0][0] != path:
+            logging.info('hybrid crawl checkpoint is stale, starting over')
+            return None
+        stack = []
+        try:
+            for fpath, xte, after in ckpt['frames']:
+                xtl, pargfid, items = self.xcrawl_scan(fpath, xtr_root, after)
+                stack.append([fpath, xte, pargfid, items or [], 0, after])
+        except OSError:
+            logging.info('hybrid crawl checkpoint is out of date (%s), '
+                         'starting over' % sys.exc_info()[1])
+            return None
+        logging.info('resuming hybrid crawl in %s after %s' %
+                     (stack[-1][0], repr(stack[-1][5])))
+        return stack
 
 
 class BoxClosedErr(Exception):
@@ -1458,11 +2000,17 @@ class PostBox(list):
 
     def append(self, e):
         """post a request"""
+        self.extend((e,))
+
+    def extend(self, es):
+        """post a bunch of requests at once"""
         self.lever.acquire()
-        if not self.open:
-            raise BoxClosedErr
-        list.append(self, e)
-        self.lever.release()
+        try:
+            if not self.open:
+                raise BoxClosedErr
+            list.extend(self, es)
+        finally:
+            self.lever.release()
 
     def close(self):
         """prohibit the posting of further requests"""
@@ -1483,30 +2031,30 @@ class Syncer(object):
     When a consumer (rsync worker) comes, a new PostBox is
     set up and the old one is passed on to the consumer.
 
-    Instead of the simplistic scheme of having one big lock
-    which synchronizes both the addition of new items and
-    PostBox exchanges, use a separate lock to arbitrate consumers,
-    and rely on PostBox's synchronization mechanisms take
-    care about additions.
-
-    There is a corner case racy situation, producers vs. consumers,
-    which is not handled by this scheme: namely, when the PostBox
-    exchange occurs in between being passed to the producer for posting
-    and the post placement. But that's what Postbox.close is for:
-    such a posting will find the PostBox closed, in which case
-    the producer can re-try posting against the actual PostBox of
-    the queue.
-
-    To aid accumlation of items in the PostBoxen before grabbed
-    by an rsync worker, the worker goes to sleep a bit after
-    each completed syncjob.
+    Both posting and PostBox exchanges happen under a condition
+    variable, which idle workers sleep on until something gets
+    posted, so there is no polling involved.
+
+    To aid accumulation of items in the PostBoxen, a worker holds
+    off grabbing a PostBox with less than sync_batch_min_files
+    items until its first item has been waiting for
+    sync_batch_max_delay seconds.
+
+    A large enough set of files is not staged but split up by
+    size over as many PostBoxen as there are workers, which are
+    then taken on by them right away, so that a single big file
+    does not hold up the transfer of the rest of its batch.
     """
 
     def __init__(self, slave, sync_engine, resilient_errnos=[]):
         """spawn worker threads"""
         self.slave = slave
-        self.lock = Lock()
+        self.cond = Condition()
         self.pb = PostBox()
+        # time of the first posting to self.pb
+        self.since = None
+        # PostBoxen of split up file sets, to be taken as they are
+        self.ready = []
         self.sync_engine = sync_engine
         self.errnos_ok = resilient_errnos
         for i in range(int(gconf.sync_jobs)):
@@ -1515,18 +2063,27 @@ class Syncer(object):
 
     def syncjob(self):
         """the life of a worker"""
+        profile = Profile("syncer-%d" % current_thread().ident, 60)
         while True:
-            pb = None
-            while True:
-                self.lock.acquire()
-                if self.pb:
-                    pb, self.pb = self.pb, PostBox()
-                self.lock.release()
-                if pb:
-                    break
-                time.sleep(0.5)
+            pb = self.grab()
             pb.close()
-            po = self.sync_engine(pb)
+            metrics = gconf.brick_status and gconf.brick_status.metrics
+            if metrics:
+                metrics.add_gauge("syncer_queue", -len(pb))
+                metrics.add_gauge("transfers_running", 1)
+            t0 = time.time()
+            try:
+                with profile:
+                    po = self.sync_engine(pb)
+            finally:
+                if metrics:
+                    metrics.add_gauge("transfers_running", -1)
+            if metrics:
+                metrics.record("data", getattr(po, 'bytes_sent', 0),
+                               time.time() - t0)
+                metrics.incr("transfers")
+                if po.returncode != 0:
+                    metrics.incr("transfer_failures")
             if po.returncode == 0:
                 ret = (True, 0)
             elif po.returncode in self.errnos_ok:
@@ -1535,11 +2092,81 @@ class Syncer(object):
                 po.errfail()
             pb.wakeup(ret)
 
-    def add(self, e):
-        while True:
-            pb = self.pb
-            try:
-                pb.append(e)
+    def grab(self):
+        """wait for posted items and take over the PostBox"""
+        self.cond.acquire()
+        try:
+            while True:
+                if self.ready:
+                    return self.ready.pop(0)
+                if not self.pb:
+                    self.cond.wait()
+                    continue
+                minfiles = int(gconf.sync_batch_min_files)
+                left = self.since + float(gconf.sync_batch_max_delay) - \
+                    time.time()
+                if len(self.pb) < minfiles and left > 0:
+                    self.cond.wait(left)
+                    continue
+                pb, self.pb = self.pb, PostBox()
                 return pb
-            except BoxClosedErr:
-                pass
+        finally:
+            self.cond.release()
+
+    def partition(self, files):
+        """split @files into groups of about the same transfer size
+
+        Return a list of lists of files, one for each sync job at most.
+        Groups are filled largest file first, always adding to the
+        lightest group, so a file much larger than the rest ends up
+        on its own.
+
+        Sizes are only looked up for sets which reach the split size
+        by the per file overhead alone, smaller ones are not worth a
+        stat of each file.
+        """
+        njobs = min(int(gconf.sync_jobs), len(files))
+        if njobs < 2 or \
+           len(files) * SYNC_FILE_OVERHEAD < int(gconf.sync_split_size):
+            return [files]
+        sts = parallel_map(lstat, files, int(gconf.entry_stat_threads))
+        weights = {}
+        for f in files:
+            # vanished files are left to be reported by the transfer
+            st = sts[f]
+            weights[f] = SYNC_FILE_OVERHEAD + \
+                (0 if isinstance(st, int) else st.st_size)
+
+        groups = [(0, i, []) for i in range(njobs)]
+        for f in sorted(files, key=weights.get, reverse=True):
+            w, i, group = heapq.heappop(groups)
+            group.append(f)
+            heapq.heappush(groups, (w + weights[f], i, group))
+        return [group for w, i, group in groups if group]
+
+    def add(self, files):
+        """post @files for syncing
+
+        Return a list of (PostBox, files) pairs, telling which
+        files were posted to which PostBox.
+        """
+        files = list(files)
+        groups = self.partition(files)
+        self.cond.acquire()
+        try:
+            if len(groups) > 1:
+                boxes = [(PostBox(group), group) for group in groups]
+                self.ready.extend(pb for pb, group in boxes)
+            else:
+                pb = self.pb
+                if not pb:
+                    self.since = time.time()
+                pb.extend(files)
+                boxes = [(pb, files)]
+            self.cond.notifyAll()
+            if gconf.brick_status:
+                gconf.brick_status.metrics.add_gauge("syncer_queue",
+                                                     len(files))
+            return boxes
+        finally:
+            self.cond.release()
@@ -27,6 +27,7 @@ from syncdutils import set_term_handler, is_host_local, GsyncdError
 from syncdutils import escape, Thread, finalize, memoize
 
 from gsyncdstatus import GeorepStatus, set_monitor_status
+from openmetrics import MetricsExporter
 
 
 ParseError = XET.ParseError if hasattr(XET, 'ParseError') else SyntaxError
@@ -305,7 +306,26 @@ class Monitor(object):
         self.status[w[0]].set_worker_status(self.ST_INCON)
         return ret
 
+    def collect_metrics(self, bricks):
+        """status and metrics detail of the workers of @bricks"""
+        workers = []
+        monitor_status = None
+        for brick in bricks:
+            status = self.status.get(brick)
+            if not status:
+                status = GeorepStatus(gconf.state_file, brick)
+            monitor_status = status.get_monitor_status()
+            workers.append((brick, status.get_raw_status(),
+                            status.get_detail()))
+        return workers, monitor_status
+
     def multiplex(self, wspx, suuid, slave_vol, slave_host, master):
+        if gconf.metrics_export:
+            bricks = [w[0] for w in wspx]
+            MetricsExporter(gconf.metrics_export,
+                            float(gconf.metrics_export_interval),
+                            lambda: self.collect_metrics(bricks)).start()
+
         argv = sys.argv[:]
         for o in ('-N', '--no-daemon', '--monitor'):
             while o in argv:
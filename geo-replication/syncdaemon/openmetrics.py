@@ -0,0 +1,265 @@
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+"""OpenMetrics text exposition of the status of workers
+
+The monitor renders the status and the metrics detail of its workers
+(as stored by GeorepStatus) and writes them to a file or serves them
+on a unix socket, to be picked up by a scraper.
+"""
+
+import os
+import sys
+import time
+import socket
+import logging
+import tempfile
+from errno import ENOENT
+
+from syncdutils import Thread, errno_wrap
+from gsyncdstatus import STATUS_VALUES, CRAWL_STATUS_VALUES, MONITOR_STATUS
+
+PREFIX = "gsyncd_"
+
+
+def escape_label(value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").\
+        replace("\n", "\\n")
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return value and "1" or "0"
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+
+class Family(object):
+
+    """a metric family with its samples"""
+
+    def __init__(self, name, mtype, doc, unit=None):
+        self.name = PREFIX + name
+        self.mtype = mtype
+        self.doc = doc
+        self.unit = unit
+        self.samples = []
+
+    def add(self, labels, value, suffix=""):
+        self.samples.append((suffix, labels, value))
+
+    def lines(self):
+        if not self.samples:
+            return []
+        out = ["# TYPE %s %s" % (self.name, self.mtype)]
+        if self.unit:
+            out.append("# UNIT %s %s" % (self.name, self.unit))
+        out.append("# HELP %s %s" % (self.name, self.doc))
+        for suffix, labels, value in self.samples:
+            lbl = ",".join('%s="%s"' % (k, escape_label(v))
+                           for k, v in labels)
+            out.append("%s%s{%s} %s" % (self.name, suffix, lbl,
+                                        format_value(value)))
+        return out
+
+
+def number(value):
+    """@value if it is a number, None for N/A and the like"""
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        return None
+    return value
+
+
+def render(workers, monitor_status=None):
+    """OpenMetrics text of @workers
+
+    @workers is a list of (brick, status, detail) triples, status
+    being the unformatted status data, detail the metrics snapshot
+    of the worker (or None if there is none yet).
+    """
+    fam = {}
+
+    def family(name, *a, **kw):
+        if name not in fam:
+            fam[name] = Family(name, *a, **kw)
+        return fam[name]
+
+    if monitor_status:
+        states = list(MONITOR_STATUS)
+        if monitor_status not in states:
+            states.append(monitor_status)
+        f = family("monitor_status", "stateset", "Status of the session.")
+        for st in states:
+            f.add([("gsyncd_monitor_status", st)], st == monitor_status)
+
+    for brick, status, detail in workers:
+        b = ("brick", brick)
+        for key, values, doc in (
+                ("worker_status", STATUS_VALUES, "Status of the worker."),
+                ("crawl_status", CRAWL_STATUS_VALUES,
+                 "Crawl the worker is doing.")):
+            value = status.get(key)
+            states = list(values)
+            if value and value not in states:
+                states.append(value)
+            f = family(key, "stateset", doc)
+            for st in states:
+                f.add([b, (PREFIX + key, st)], st == value)
+
+        if number(status.get("last_synced")) is not None:
+            family("last_synced_timestamp_seconds", "gauge",
+                   "Time up to which the brick is synced.",
+                   "seconds").add([b], status["last_synced"])
+        for kind in ("entry", "data", "meta"):
+            if number(status.get(kind)) is not None:
+                family("pending", "gauge",
+                       "Entries, data and metadata pending to sync.").add(
+                    [b, ("kind", kind)], status[kind])
+        if number(status.get("failures")) is not None:
+            family("failures", "gauge",
+                   "Changes which failed to sync.").add([b],
+                                                        status["failures"])
+
+        if not detail:
+            continue
+        if number(detail.get("lag")) is not None:
+            family("lag_seconds", "gauge",
+                   "Age of the last synced changes.",
+                   "seconds").add([b], detail["lag"])
+        if number(detail.get("catchup_eta")) is not None:
+            family("catchup_eta_seconds", "gauge",
+                   "Estimated time to catch up.",
+                   "seconds").add([b], detail["catchup_eta"])
+
+        for phase, tot in sorted(detail.get("totals", {}).items()):
+            if phase == "batch":
+                f = family("batch_duration_seconds", "summary",
+                           "Time from the start to the end of the sync "
+                           "of changelog batches.", "seconds")
+                f.add([b], tot["count"], "_count")
+                f.add([b], tot["time"], "_sum")
+                continue
+            p = ("phase", phase)
+            family("phase_seconds", "counter",
+                   "Time spent in the phases of syncing.",
+                   "seconds").add([b, p], tot["time"], "_total")
+            family("phase_calls", "counter",
+                   "Times the phases of syncing were run.").add(
+                [b, p], tot["count"], "_total")
+            family("phase_items", "counter",
+                   "Changelogs, entries, metadata and bytes gone through "
+                   "the phases of syncing.").add([b, p], tot["amount"],
+                                                 "_total")
+
+        for peer, calls in sorted(detail.get("calls", {}).items()):
+            for meth, ms in sorted(calls.items()):
+                lbl = [b, ("peer", peer), ("method", meth)]
+                f = family("repce_call_duration_seconds", "summary",
+                           "Round trip time of RPC calls.", "seconds")
+                f.add(lbl, ms["calls"], "_count")
+                f.add(lbl, ms["time"], "_sum")
+
+        gauges = detail.get("gauges", {})
+        counters = detail.get("counters", {})
+        family("syncer_queue_files", "gauge",
+               "Files waiting for a transfer.").add(
+            [b], gauges.get("syncer_queue", 0))
+        family("transfers_running", "gauge",
+               "Transfers (eg. rsync processes) running.").add(
+            [b], gauges.get("transfers_running", 0))
+        family("transfers", "counter", "Transfers done.").add(
+            [b], counters.get("transfers", 0), "_total")
+        family("transfer_failures", "counter",
+               "Transfers which did not succeed.").add(
+            [b], counters.get("transfer_failures", 0), "_total")
+        family("batches_skipped", "counter",
+               "Changelog batches given up after retries.").add(
+            [b], counters.get("batches_skipped", 0), "_total")
+
+    lines = []
+    for name in sorted(fam):
+        lines.extend(fam[name].lines())
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter(object):
+
+    """make the OpenMetrics text of collect() available at @target
+
+    @target is either a file path, which is rewritten every @interval
+    seconds, or unix:<path>, a socket which hands out the current text
+    to every connection.
+    """
+
+    def __init__(self, target, interval, collect):
+        self.target = target
+        self.interval = interval
+        self.collect = collect
+
+    def text(self):
+        return render(*self.collect())
+
+    def start(self):
+        if self.target.startswith("unix:"):
+            t = Thread(target=self.serve, args=(self.target[5:],))
+        else:
+            t = Thread(target=self.write_loop)
+        t.start()
+        return t
+
+    def write(self):
+        text = self.text()
+        with tempfile.NamedTemporaryFile(
+                'w', dir=os.path.dirname(os.path.abspath(self.target)),
+                delete=False) as tf:
+            tf.write(text)
+            tempname = tf.name
+        os.rename(tempname, self.target)
+
+    def write_loop(self):
+        while True:
+            try:
+                self.write()
+            except (IOError, OSError):
+                logging.warn("failed to write metrics to %s: %s" %
+                             (self.target, sys.exc_info()[1]))
+            except Exception:
+                logging.exception("failed to collect metrics")
+            time.sleep(self.interval)
+
+    def serve(self, path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            errno_wrap(os.unlink, [path], [ENOENT])
+            sock.bind(path)
+            sock.listen(5)
+        except (socket.error, OSError):
+            # not worth taking the monitor down for
+            logging.warn("failed to serve metrics on %s: %s" %
+                         (path, sys.exc_info()[1]))
+            sock.close()
+            return
+        while True:
+            conn, _ = sock.accept()
+            try:
+                try:
+                    text = self.text()
+                except Exception:
+                    logging.exception("failed to collect metrics")
+                    continue
+                conn.sendall(text)
+            except socket.error:
+                pass
+            finally:
+                conn.close()
@@ -11,8 +11,12 @@
 import os
 import sys
 import time
+import zlib
+import struct
 import logging
-from threading import Condition
+import binascii
+import itertools
+from threading import Condition, Lock
 try:
     import thread
 except ImportError:
@@ -29,10 +33,19 @@ except ImportError:
     # py 3
     import pickle
 
-from syncdutils import Thread, select
+from syncdutils import Thread, select, Profile
 
 pickle_proto = -1
-repce_version = 1.0
+# 1.1: can be upgraded to the framed protocol, see RepceClient.upgrade()
+repce_version = 1.1
+
+# header of a frame: flags, length of payload
+frame_hdr = struct.Struct('!BI')
+# frame flag: payload is zlib compressed
+FRAME_ZLIB = 1
+
+# sequence to tell apart jobs of the same thread
+job_seq = itertools.count()
 
 
 def ioparse(i, o):
@@ -61,6 +74,125 @@ def recv(inf):
     return pickle.load(inf)
 
 
+def writeall(out, buf):
+    while buf:
+        buf = buf[os.write(out, buf):]
+
+
+def send_frame(out, msgs, zmin=0):
+    """write out a frame carrying a list of messages
+
+    The framed protocol (repce 1.1) prefixes the pickled list
+    of messages with its length, so that it can be read in with
+    plain buffered reads. If @zmin is given, payloads of at
+    least that size are compressed.
+    """
+    payload = pickle.dumps(msgs, pickle_proto)
+    flags = 0
+    if zmin and len(payload) >= zmin:
+        payload = zlib.compress(payload, 1)
+        flags |= FRAME_ZLIB
+    writeall(out, frame_hdr.pack(flags, len(payload)))
+    writeall(out, payload)
+
+
+def recv_frame(inf):
+    """read in a frame, return the list of messages in it"""
+    hdr = inf.read(frame_hdr.size)
+    if len(hdr) < frame_hdr.size:
+        raise EOFError
+    flags, size = frame_hdr.unpack(hdr)
+    payload = inf.read(size)
+    if len(payload) < size:
+        raise EOFError
+    if flags & FRAME_ZLIB:
+        payload = zlib.decompress(payload)
+    return pickle.loads(payload)
+
+
+# The compact codec
+#
+# Lists of dicts as passed to entry_ops() and meta_ops() are
+# sent as rows of values, the key sets of the dicts and the
+# directory part of paths (typically ".gfid/<PARGFID>") go to
+# tables. GFIDs are sent in their 16 byte binary form, stat
+# dicts as tuples.
+
+STAT_KEYS = ('uid', 'gid', 'mode', 'atime', 'mtime')
+STAT_KEYSET = set(STAT_KEYS)
+PATH_KEYS = ('entry', 'entry1', 'go')
+
+
+def gfid_pack(gfid):
+    if len(gfid) != 36:
+        return gfid
+    return binascii.unhexlify(gfid.replace('-', ''))
+
+
+def gfid_unpack(v):
+    if len(v) != 16:
+        return v
+    h = binascii.hexlify(v)
+    return '-'.join((h[:8], h[8:12], h[12:16], h[16:20], h[20:]))
+
+
+def pack_records(recs):
+    """compact form of a list of dicts"""
+    keysets = {}
+    heads = {}
+    rows = []
+    for rec in recs:
+        keys = tuple(rec)
+        row = [keysets.setdefault(keys, len(keysets))]
+        for k in keys:
+            v = rec[k]
+            if k == 'gfid':
+                v = gfid_pack(v)
+            elif k in PATH_KEYS and '/' in v:
+                head, tail = v.rsplit('/', 1)
+                v = (heads.setdefault(head, len(heads)), tail)
+            elif k == 'stat' and set(v) == STAT_KEYSET:
+                v = tuple(v[sk] for sk in STAT_KEYS)
+            row.append(v)
+        rows.append(row)
+    return (sorted(keysets, key=keysets.get),
+            sorted(heads, key=heads.get), rows)
+
+
+def unpack_records(packed):
+    """inverse of pack_records()"""
+    keysets, heads, rows = packed
+    recs = []
+    for row in rows:
+        rec = dict(zip(keysets[row[0]], row[1:]))
+        for k, v in rec.items():
+            if k == 'gfid':
+                rec[k] = gfid_unpack(v)
+            elif k in PATH_KEYS and isinstance(v, tuple):
+                rec[k] = '/'.join((heads[v[0]], v[1]))
+            elif k == 'stat' and isinstance(v, tuple):
+                rec[k] = dict(zip(STAT_KEYS, v))
+        recs.append(rec)
+    return recs
+
+
+# methods taking a list of dicts as only argument, which are
+# sent in compact form if the peers agreed on it
+compact_methods = set(['entry_ops', 'meta_ops'])
+
+
+def encode_msg(msg):
+    if msg[1] in compact_methods:
+        return msg[:2] + (pack_records(msg[2]),)
+    return msg
+
+
+def decode_msg(msg):
+    if msg[1] in compact_methods:
+        return msg[:2] + (unpack_records(msg[2]),)
+    return msg
+
+
 class RepceServer(object):
 
     """RePCe is Hungarian for canola, http://hu.wikipedia.org/wiki/Repce
@@ -71,51 +203,171 @@ class RepceServer(object):
     This is the server component.
     """
 
-    def __init__(self, obj, i, o, wnum=6):
+    def __init__(self, obj, i, o, wnum=6, qlen=0):
         """register a backend object .obj to which incoming messages
            are dispatched, also incoming/outcoming streams
+
+        At most @qlen batches of messages are queued up for the
+        workers (0: no limit); when the queue is full, reading
+        from the input stream stops, which holds back the client.
         """
         self.obj = obj
         self.inf, self.out = ioparse(i, o)
         self.wnum = wnum
-        self.q = Queue()
+        self.q = Queue(qlen)
+        # replies, and the protocol upgrade, to be written out
+        self.rq = Queue()
+        self.framed = False
+        self.features = {}
+        self.slock = Lock()
+        self.stats = {'queue': {'limit': qlen, 'max': 0},
+                      'methods': {}}
 
     def service_loop(self):
-        """fire up worker threads, get messages and dispatch among them"""
+        """fire up worker and writer threads, get messages and
+        dispatch among them
+
+        Messages arriving in one frame are dispatched together.
+        """
         for i in range(self.wnum):
             t = Thread(target=self.worker)
             t.start()
+        t = Thread(target=self.writer)
+        t.start()
         try:
             while True:
-                self.q.put(recv(self.inf))
+                if self.framed:
+                    self.dispatch(recv_frame(self.inf))
+                    continue
+                in_data = recv(self.inf)
+                if in_data[1] == '__repce_upgrade__':
+                    self.upgrade(in_data[0], *in_data[2:])
+                else:
+                    self.dispatch([in_data])
         except EOFError:
             logging.info("terminating on reaching EOF.")
 
+    def dispatch(self, msgs):
+        """queue up @msgs for the workers, blocks if queue is full"""
+        compact = self.features.get('codec') == 'compact'
+        self.q.put((compact, msgs))
+        qsize = self.q.qsize()
+        if qsize > self.stats['queue']['max']:
+            self.stats['queue']['max'] = qsize
+
+    def upgrade(self, rid, features={}):
+        """acknowledge upgrade request and switch to framed protocol
+
+        This has to be done in the reader thread, as anything
+        following the request is already framed. The writer
+        switches over after having sent the acknowledgement.
+
+        @features is a dict of optional features the client asks
+        for, the supported ones are taken on and returned:
+        - 'codec': 'compact' to use the compact codec for requests
+        - 'zlib': minimum size of frames to be compressed
+        """
+        accepted = {}
+        if features.get('codec') == 'compact':
+            accepted['codec'] = 'compact'
+        if features.get('zlib'):
+            accepted['zlib'] = int(features['zlib'])
+        self.features = accepted
+        self.framed = True
+        self.rq.put((rid, '__repce_upgrade__', accepted))
+
+    def writer(self):
+        """life of the writer
+
+        Replies are taken from the reply queue, and with the framed
+        protocol, what has piled up there is written out in one
+        frame. Legacy clients get one message per write, as they
+        select() on the stream before reading each.
+        """
+        framed = False
+        while True:
+            replies = [self.rq.get(True)]
+            while not self.rq.empty():
+                replies.append(self.rq.get(True))
+            msgs = []
+            for rep in replies:
+                if rep[1] != '__repce_upgrade__':
+                    msgs.append(rep)
+                    continue
+                self.flush(msgs, framed)
+                msgs = []
+                send(self.out, rep[0], False, rep[2])
+                framed = True
+            self.flush(msgs, framed)
+
+    def flush(self, msgs, framed):
+        if not msgs:
+            return
+        if framed:
+            send_frame(self.out, msgs, self.features.get('zlib'))
+        else:
+            for msg in msgs:
+                send(self.out, *msg)
+
+    def account(self, meth, elapsed):
+        """record the duration of a call in the stats"""
+        self.slock.acquire()
+        try:
+            ms = self.stats['methods'].setdefault(
+                meth, {'calls': 0, 'time': 0.0, 'max': 0.0})
+            ms['calls'] += 1
+            ms['time'] += elapsed
+            if elapsed > ms['max']:
+                ms['max'] = elapsed
+        finally:
+            self.slock.release()
+
+    def get_stats(self):
+        """call counts and latencies per method, queue depths"""
+        self.slock.acquire()
+        try:
+            stats = {'queue': dict(self.stats['queue'],
+                                   size=self.q.qsize()),
+                     'replies': self.rq.qsize(),
+                     'methods': dict((meth, dict(ms)) for meth, ms in
+                                     self.stats['methods'].items())}
+        finally:
+            self.slock.release()
+        return stats
+
     def worker(self):
         """life of a worker
 
-        Get message, extract its id, method name and arguments
+        Get messages, extract their id, method name and arguments
         (kwargs not supported), call method on .obj.
         Send back message id + return value.
         If method call throws an exception, rescue it, and send
         back the exception as result (with flag marking it as
         exception).
+        Messages of a frame are served one after the other, in order.
         """
         while True:
-            in_data = self.q.get(True)
-            rid = in_data[0]
-            rmeth = in_data[1]
-            exc = False
-            if rmeth == '__repce_version__':
-                res = repce_version
-            else:
-                try:
-                    res = getattr(self.obj, rmeth)(*in_data[2:])
-                except:
-                    res = sys.exc_info()[1]
-                    exc = True
-                    logging.exception("call failed: ")
-            send(self.out, rid, exc, res)
+            compact, msgs = self.q.get(True)
+            for in_data in msgs:
+                if compact:
+                    in_data = decode_msg(in_data)
+                rid = in_data[0]
+                rmeth = in_data[1]
+                exc = False
+                if rmeth == '__repce_version__':
+                    res = repce_version
+                elif rmeth == '__repce_stats__':
+                    res = self.get_stats()
+                else:
+                    t0 = time.time()
+                    try:
+                        res = getattr(self.obj, rmeth)(*in_data[2:])
+                    except:
+                        res = sys.exc_info()[1]
+                        exc = True
+                        logging.exception("call failed: ")
+                    self.account(rmeth, time.time() - t0)
+                self.rq.put((rid, exc, res))
 
 
 class RepceJob(object):
@@ -123,13 +375,16 @@ class RepceJob(object):
     """class representing message status we can use
     for waiting on reply"""
 
-    def __init__(self, cbk):
+    def __init__(self, cbk, meth=None):
         """
         - .rid: (process-wise) unique id
         - .cbk: what we do upon receiving reply
+        - .meth: the method called
         """
-        self.rid = (os.getpid(), thread.get_ident(), time.time())
+        self.rid = (os.getpid(), thread.get_ident(), time.time(),
+                    next(job_seq))
         self.cbk = cbk
+        self.meth = meth
         self.lever = Condition()
         self.done = False
 
@@ -150,6 +405,13 @@ class RepceJob(object):
         self.lever.notify()
         self.lever.release()
 
+    def get(self):
+        """wait for the reply, return result or raise the exception"""
+        exc, res = self.wait()
+        if exc:
+            raise res
+        return res
+
 
 class RepceClient(object):
 
@@ -164,33 +426,146 @@ class RepceClient(object):
     def __init__(self, i, o):
         self.inf, self.out = ioparse(i, o)
         self.jtab = {}
+        # large messages might get interleaved when sent concurrently
+        self.wlock = Lock()
+        self.framed = False
+        self.features = {}
+        # per method number of calls and time of their round trips
+        self.slock = Lock()
+        self.stats = {}
         t = Thread(target=self.listen)
         t.start()
 
     def listen(self):
+        profile = Profile("repce-listener-%d" % thread.get_ident(), 60)
         while True:
-            select((self.inf,), (), ())
-            rid, exc, res = recv(self.inf)
-            rjob = self.jtab.pop(rid)
-            if rjob.cbk:
-                rjob.cbk(rjob, [exc, res])
+            if self.framed:
+                replies = recv_frame(self.inf)
+            else:
+                select((self.inf,), (), ())
+                replies = [recv(self.inf)]
+            now = time.time()
+            with profile:
+                for rid, exc, res in replies:
+                    rjob = self.jtab.pop(rid)
+                    self.account(rjob.meth, now - rjob.rid[2])
+                    if rjob.cbk:
+                        rjob.cbk(rjob, [exc, res])
+
+    def account(self, meth, elapsed):
+        self.slock.acquire()
+        try:
+            ms = self.stats.setdefault(meth, {'calls': 0, 'time': 0.0,
+                                              'max': 0.0})
+            ms['calls'] += 1
+            ms['time'] += elapsed
+            ms['max'] = max(ms['max'], elapsed)
+        finally:
+            self.slock.release()
+
+    def call_stats(self):
+        """calls and round trip times per method, as seen locally"""
+        self.slock.acquire()
+        try:
+            return dict((meth, dict(ms)) for meth, ms in self.stats.items())
+        finally:
+            self.slock.release()
 
-    def push(self, meth, *args, **kw):
-        """wrap arguments in a RepceJob, send them to server
-           and return the RepceJob
+    def upgrade(self, features={}):
+        """switch to the framed protocol
 
-           @cbk to pass on RepceJob can be given as kwarg.
+        Peer has to be of repce 1.1 at least. No other message
+        may be sent until the switch is acknowledged. @features
+        are the optional ones to ask for (see RepceServer.upgrade),
+        return those the peer agreed on.
+        """
+        def cbk(rj, res):
+            # called by the listener, so that it reads framed
+            # right after the acknowledgement
+            if not res[0]:
+                self.features = res[1]
+                self.framed = True
+            rj.wakeup(res)
+        rjob = RepceJob(cbk, '__repce_upgrade__')
+        self.jtab[rjob.rid] = rjob
+        self.wlock.acquire()
+        try:
+            send(self.out, rjob.rid, '__repce_upgrade__', features)
+            rjob.get()
+        finally:
+            self.wlock.release()
+        logging.debug("switched to framed RePCe protocol, features: %s" %
+                      repr(self.features))
+        return self.features
+
+    def push_many(self, calls, cbk=None):
+        """send calls in one go, return their RepceJobs
+
+        @calls is a sequence of (method, args) pairs. Once
+        the protocol is upgraded, they travel in one frame
+        and get served in order; otherwise as separate
+        messages, served in no particular order.
         """
-        cbk = kw.get('cbk')
         if not cbk:
             def cbk(rj, res):
                 if res[0]:
                     raise res[1]
-        rjob = RepceJob(cbk)
-        self.jtab[rjob.rid] = rjob
-        logging.debug("call %s %s%s ..." % (repr(rjob), meth, repr(args)))
-        send(self.out, rjob.rid, meth, *args)
-        return rjob
+        rjobs = []
+        msgs = []
+        for meth, args in calls:
+            rjob = RepceJob(cbk, meth)
+            self.jtab[rjob.rid] = rjob
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                # args can be bulky (eg. file data), don't repr them in vain
+                logging.debug("call %s %s%s ..." %
+                              (repr(rjob), meth, repr(args)))
+            rjobs.append(rjob)
+            msgs.append((rjob.rid, meth) + tuple(args))
+        self.wlock.acquire()
+        try:
+            if self.framed:
+                if self.features.get('codec') == 'compact':
+                    msgs = [encode_msg(msg) for msg in msgs]
+                send_frame(self.out, msgs, self.features.get('zlib'))
+            else:
+                for msg in msgs:
+                    send(self.out, *msg)
+        finally:
+            self.wlock.release()
+        return rjobs
+
+    def push(self, meth, *args, **kw):
+        """wrap arguments in a RepceJob, send them to server
+           and return the RepceJob
+
+           @cbk to pass on RepceJob can be given as kwarg.
+        """
+        return self.push_many([(meth, args)], kw.get('cbk'))[0]
+
+    def futures(self, calls):
+        """perform calls asynchronously, return their RepceJobs
+
+        Results are to be collected by the .get() method of the
+        jobs. @calls is a sequence of (method, args) pairs, which
+        are served in order. If the peer can't guarantee that,
+        they are just done one after the other.
+        """
+        if self.framed:
+            return self.push_many(calls, lambda rj, res: rj.wakeup(res))
+        rjobs = []
+        for meth, args in calls:
+            rjob = RepceJob(None, meth)
+            try:
+                rjob.wakeup([False, self(meth, *args)])
+            except Exception:
+                rjob.wakeup([True, sys.exc_info()[1]])
+            rjobs.append(rjob)
+        return rjobs
+
+    def future(self, meth, *args):
+        """perform a call asynchronously, return its RepceJob"""
+        return self.push(meth, *args, **{'cbk': lambda rj, res:
+                                         rj.wakeup(res)})
 
     def __call__(self, meth, *args):
         """RePCe client is callabe, calling it implements a synchronous
@@ -199,8 +574,7 @@ class RepceClient(object):
         We do a .push with a cbk which does a wakeup upon receiving anwser,
         then wait on the RepceJob.
         """
-        rjob = self.push(
-            meth, *args, **{'cbk': lambda rj, res: rj.wakeup(res)})
+        rjob = self.future(meth, *args)
         exc, res = rjob.wait()
         if exc:
             logging.error('call %s (%s) failed on peer with %s' %
@@ -245,3 +619,13 @@ class RepceClient(object):
         except AttributeError:
             pass
         return d
+
+    def __stats__(self):
+        """call and queue stats of the peer, None if not supported"""
+        if not self.framed:
+            # only peers we could upgrade (repce 1.1) have the stats
+            return None
+        try:
+            return self('__repce_stats__')
+        except AttributeError:
+            return None
@@ -35,10 +35,12 @@ from master import gmaster_builder
 import syncdutils
 from syncdutils import GsyncdError, select, privileged, boolify, funcode
 from syncdutils import umask, entry2pb, gauxpfx, errno_wrap, lstat
+from syncdutils import ordered_parallel_map, parallel_map
 from syncdutils import NoPurgeTimeAvailable, PartialHistoryAvailable
 from syncdutils import ChangelogException
 from syncdutils import CHANGELOG_AGENT_CLIENT_VERSION
 from gsyncdstatus import GeorepStatus
+from dirscan import scandir
 
 
 UrlRX = re.compile('\A(\w+)://([^ *?[]*)\Z')
@@ -269,6 +271,23 @@ class Popen(subprocess.Popen):
             self.errfail()
 
 
+class NativeTransfer(object):
+
+    """outcome of a transfer by the native sync engine
+
+    Quacks like a Popen of rsync(1) as far as Syncer is concerned:
+    .returncode is 1 if some files could not be transferred.
+    """
+
+    def __init__(self, failures, bytes_sent=0):
+        self.failures = failures
+        self.returncode = failures and 1 or 0
+        self.bytes_sent = bytes_sent
+
+    def errfail(self):
+        raise GsyncdError("native transfer failed")
+
+
 class Server(object):
 
     """singleton implemening those filesystem access primitives
@@ -332,6 +351,18 @@ class Server(object):
             raise OSError(ENOTDIR, os.strerror(ENOTDIR))
         return os.listdir(path)
 
+    @classmethod
+    @_pathguard
+    def dentries(cls, path):
+        """directory entries as (name, type, inode) triples
+
+        See dirscan.scandir() for details.
+        """
+        # prevent symlinks being followed
+        if not stat.S_ISDIR(os.lstat(path).st_mode):
+            raise OSError(ENOTDIR, os.strerror(ENOTDIR))
+        return scandir(path)
+
     @classmethod
     @_pathguard
     def lstat(cls, path):
@@ -517,6 +548,14 @@ class Server(object):
             else:
                 raise
 
+    @classmethod
+    def stimes(cls, paths, uuid):
+        """query stimes of @paths in one go
+
+        Return the list of what stime() returns for each of them.
+        """
+        return [cls.stime(path, uuid) for path in paths]
+
     @classmethod
     def node_uuid(cls, path='.'):
         try:
@@ -591,6 +630,22 @@ class Server(object):
                                st['uid'], st['gid'],
                                gf, st['mode'], bn, lnk)
 
+        # GFIDs of paths as looked up during this call; paths changed
+        # by ourselves are dropped, so that they are looked up again
+        gfid_cache = {}
+
+        def disk_gfid_of(path):
+            disk_gfid = gfid_cache.get(path)
+            if disk_gfid is None:
+                disk_gfid = cls.gfid_mnt(path)
+                if isinstance(disk_gfid, basestring) or disk_gfid == ENOENT:
+                    gfid_cache[path] = disk_gfid
+            return disk_gfid
+
+        def forget_gfid(*paths):
+            for path in paths:
+                gfid_cache.pop(path, None)
+
         def entry_purge(entry, gfid):
             # This is an extremely racy code and needs to be fixed ASAP.
             # The GFID check here is to be sure that the pargfid/bname
@@ -607,25 +662,26 @@ class Server(object):
                                                         ENOTEMPTY])
                     if er == ENOTEMPTY:
                         return er
+            forget_gfid(entry)
 
-        def collect_failure(e, cmd_ret):
+        def collect_failure(e, cmd_ret, failures):
             # We do this for failing fops on Slave
             # Master should be logging this
             if cmd_ret is None:
                 return
 
             if cmd_ret == EEXIST:
-                disk_gfid = cls.gfid_mnt(e['entry'])
+                disk_gfid = disk_gfid_of(e['entry'])
                 if isinstance(disk_gfid, basestring):
                     if e['gfid'] != disk_gfid:
                         failures.append((e, cmd_ret, disk_gfid))
             else:
                 failures.append((e, cmd_ret))
 
-        failures = []
-
-        def matching_disk_gfid(gfid, entry):
-            disk_gfid = cls.gfid_mnt(entry)
+        def matching_disk_gfid(gfid, entry, fresh=False):
+            if fresh:
+                forget_gfid(entry)
+            disk_gfid = disk_gfid_of(entry)
             if isinstance(disk_gfid, int):
                 return False
 
@@ -641,7 +697,9 @@ class Server(object):
             with GFID from Changelog, that means other worker
             deleted the directory. Even if the subdir/file present,
             it belongs to different parent. Exit without performing
-            further deletes.
+            further deletes. The checks on the children are answered
+            from the cache, the one before removing the directory
+            itself is not.
             """
             if not matching_disk_gfid(gfid, entry):
                 return
@@ -661,12 +719,28 @@ class Server(object):
                 if er == EISDIR:
                     recursive_rmdir(gfid, entry, fullname)
 
-            if not matching_disk_gfid(gfid, entry):
+            if not matching_disk_gfid(gfid, entry, fresh=True):
                 return
 
             errno_wrap(os.rmdir, [path], [ENOENT, ESTALE])
-
-        for e in entries:
+            forget_gfid(path)
+
+        def entry_keys(e):
+            """what an entry operates on: its GFID and parent(s), and
+            for a rename the GFID of the entry it replaces"""
+            keys = [os.path.join(pfx, e['gfid']), entry2pb(e['entry'])[0]]
+            if e['op'] == 'RENAME':
+                keys.append(entry2pb(e['entry1'])[0])
+                # keys are taken before any entry is applied, so this
+                # is the target as it is prior to the call
+                tgfid = disk_gfid_of(e['entry1'])
+                if isinstance(tgfid, basestring):
+                    keys.append(os.path.join(pfx, tgfid))
+            return keys
+
+        def entry_apply(e):
+            """apply entry @e, return the list of failures"""
+            failures = []
             blob = None
             op = e['op']
             gfid = e['gfid']
@@ -709,7 +783,8 @@ class Server(object):
                     cmd_ret = errno_wrap(os.link,
                                          [slink, entry],
                                          [ENOENT, EEXIST])
-                    collect_failure(e, cmd_ret)
+                    forget_gfid(entry)
+                    collect_failure(e, cmd_ret, failures)
             elif op == 'SYMLINK':
                 blob = entry_pack_symlink(gfid, bname, e['link'], e['stat'])
             elif op == 'RENAME':
@@ -723,38 +798,153 @@ class Server(object):
                     cmd_ret = errno_wrap(os.rename,
                                          [entry, en],
                                          [ENOENT, EEXIST])
-                    collect_failure(e, cmd_ret)
+                    forget_gfid(entry, en)
+                    collect_failure(e, cmd_ret, failures)
             if blob:
                 cmd_ret = errno_wrap(Xattr.lsetxattr,
                                      [pg, 'glusterfs.gfid.newfile', blob],
                                      [EEXIST, ENOENT],
                                      [ESTALE, EINVAL])
-                collect_failure(e, cmd_ret)
+                forget_gfid(os.path.join(pg, bname))
+                collect_failure(e, cmd_ret, failures)
+            return failures
+
+        # Entries on distinct GFIDs and parent directories are applied
+        # concurrently, the others in changelog order.
+        nthreads = int(gconf.entry_op_threads)
+        if nthreads > 1 and len(entries) > 1:
+            # look up rename targets for entry_keys() in parallel
+            parallel_map(disk_gfid_of, set(e['entry1'] for e in entries
+                                           if e['op'] == 'RENAME'),
+                         nthreads)
+        failures = []
+        for fl in ordered_parallel_map(entry_apply, entries, entry_keys,
+                                       nthreads):
+            failures.extend(fl)
         return failures
 
     @classmethod
     def meta_ops(cls, meta_entries):
+        """apply the stat of @meta_entries, return the failures
+
+        Only the attributes which differ from those on the slave
+        are changed. Entries are worked on concurrently.
+        """
         logging.debug('Meta-entries: %s' % repr(meta_entries))
-        failures = []
-        for e in meta_entries:
-            mode = e['stat']['mode']
-            uid = e['stat']['uid']
-            gid = e['stat']['gid']
-            atime = e['stat']['atime']
-            mtime = e['stat']['mtime']
+
+        def meta_apply(e):
+            st = e['stat']
             go = e['go']
-            cmd_ret = errno_wrap(os.chmod, [go, mode],
-                                 [ENOENT], [ESTALE, EINVAL])
+            cur = errno_wrap(os.lstat, [go], [ENOENT], [ESTALE, EINVAL])
             # This is a fail fast mechanism
             # We do this for failing fops on Slave
             # Master should be logging this
-            if isinstance(cmd_ret, int):
-                failures.append((e, cmd_ret))
-                continue
-            errno_wrap(os.chown, [go, uid, gid], [ENOENT], [ESTALE, EINVAL])
-            errno_wrap(os.utime, [go, (atime, mtime)],
-                       [ENOENT], [ESTALE, EINVAL])
-        return failures
+            if isinstance(cur, int):
+                return (e, cur)
+            if stat.S_IMODE(cur.st_mode) != stat.S_IMODE(st['mode']):
+                cmd_ret = errno_wrap(os.chmod, [go, st['mode']],
+                                     [ENOENT], [ESTALE, EINVAL])
+                if isinstance(cmd_ret, int):
+                    return (e, cmd_ret)
+            if (cur.st_uid, cur.st_gid) != (st['uid'], st['gid']):
+                errno_wrap(os.chown, [go, st['uid'], st['gid']],
+                           [ENOENT], [ESTALE, EINVAL])
+            if abs(cur.st_atime - st['atime']) > 1e-6 or \
+               abs(cur.st_mtime - st['mtime']) > 1e-6:
+                errno_wrap(os.utime, [go, (st['atime'], st['mtime'])],
+                           [ENOENT], [ESTALE, EINVAL])
+
+        return [f for f in ordered_parallel_map(
+            meta_apply, meta_entries, lambda e: [e['go']],
+            int(gconf.entry_op_threads)) if f]
+
+    @staticmethod
+    def _data_path(path):
+        if path[0] == '/' or '..' in path.split('/'):
+            raise ValueError('unsafe path')
+        return path
+
+    @classmethod
+    def _data_sums(cls, path, blksize):
+        fd = os.open(cls._data_path(path), os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            sums = []
+            while blksize:
+                data = os.read(fd, blksize)
+                if not data:
+                    break
+                sums.append(syncdutils.md5hex(data))
+            return (size, sums)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def data_info(cls, paths, blksize):
+        """size and block checksums of files to be synced
+
+        For each of @paths, map it to a pair of the file size and the
+        list of the md5s of its consecutive @blksize byte blocks (empty
+        if @blksize is 0), or to an errno if the file is not there.
+        """
+        info = {}
+        for path in paths:
+            info[path] = errno_wrap(cls._data_sums, [path, blksize],
+                                    [ENOENT], [ESTALE])
+        return info
+
+    @classmethod
+    def _data_op(cls, fds, op):
+        path = op[1]
+        if path not in fds:
+            fds[path] = os.open(cls._data_path(path), os.O_WRONLY)
+        fd = fds[path]
+        if op[0] == 'trunc':
+            os.ftruncate(fd, op[2])
+        elif op[0] == 'write':
+            os.lseek(fd, op[2], os.SEEK_SET)
+            data = op[3]
+            while data:
+                data = data[os.write(fd, data):]
+        elif op[0] == 'attr':
+            uid, gid, mode, atime, mtime = op[2:]
+            os.fchown(fd, uid, gid)
+            os.fchmod(fd, stat.S_IMODE(mode))
+            os.close(fds.pop(path))
+            os.utime(path, (atime, mtime))
+        else:
+            raise ValueError('unknown data op %s' % op[0])
+
+    @classmethod
+    def data_ops(cls, ops):
+        """write file contents as sent by the native sync engine
+
+        @ops is a sequence of tuples, applied in order:
+        - ('trunc', path, size): set size of the file
+        - ('write', path, offset, data): write data at offset
+        - ('attr', path, uid, gid, mode, atime, mtime): set ownership,
+          permissions and times, this concludes the file
+
+        Return failures as (path, errno) pairs; operations on a file
+        following a failure are skipped.
+        """
+        failures = {}
+        fds = {}
+        try:
+            for op in ops:
+                path = op[1]
+                if path in failures:
+                    continue
+                ret = errno_wrap(cls._data_op, [fds, op],
+                                 [ENOENT, EINVAL], [ESTALE])
+                if isinstance(ret, int):
+                    failures[path] = ret
+                    if path in fds:
+                        os.close(fds.pop(path))
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+        return failures.items()
 
     @classmethod
     @_pathguard
@@ -837,7 +1027,8 @@ class SlaveLocal(object):
                 "using rsync for extended attributes is not supported")
 
         repce = RepceServer(
-            self.server, sys.stdin, sys.stdout, int(gconf.sync_jobs))
+            self.server, sys.stdin, sys.stdout, int(gconf.sync_jobs),
+            int(gconf.repce_queue_size))
         t = syncdutils.Thread(target=lambda: (repce.service_loop(),
                                               syncdutils.finalize()))
         t.start()
@@ -899,6 +1090,15 @@ class SlaveRemote(object):
             raise GsyncdError(
                 "RePCe major version mismatch: local %s, remote %s" %
                 (exrv, rv))
+        if float(rv['proto']) >= 1.1:
+            # peer can do the framed protocol, which lets us batch
+            # calls and read replies in a buffered manner
+            features = {}
+            if gconf.repce_codec == 'compact':
+                features['codec'] = 'compact'
+            if int(gconf.repce_compress_size):
+                features['zlib'] = int(gconf.repce_compress_size)
+            self.server.upgrade(features)
 
     def rsync(self, files, *args):
         """invoke rsync"""
@@ -913,14 +1113,10 @@ class SlaveRemote(object):
             (boolify(gconf.sync_acls) and ['--acls'] or []) + \
             ['.'] + list(args)
 
-        if gconf.log_rsync_performance:
-            # use stdout=PIPE only when log_rsync_performance enabled
-            # Else rsync will write to stdout and nobody is their
-            # to consume. If PIPE is full rsync hangs.
-            po = Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                       stderr=subprocess.PIPE)
-        else:
-            po = Popen(argv, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        # the --stats output is always consumed, to account the bytes
+        # sent; rsync would hang on a full pipe otherwise
+        po = Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                   stderr=subprocess.PIPE)
 
         for f in files:
             po.stdin.write(f)
@@ -928,8 +1124,16 @@ class SlaveRemote(object):
 
         po.stdin.close()
 
+        out = po.stdout.read()
+        po.bytes_sent = 0
+        for line in out.split("\n"):
+            if line.startswith("Total bytes sent:"):
+                try:
+                    po.bytes_sent = int(line.split(":")[1].strip().
+                                        replace(",", ""))
+                except ValueError:
+                    pass
         if gconf.log_rsync_performance:
-            out = po.stdout.read()
             rsync_msg = []
             for line in out.split("\n"):
                 if line.startswith("Number of files:") or \
@@ -948,6 +1152,73 @@ class SlaveRemote(object):
 
         return po
 
+    def native(self, files):
+        """transfer @files via the RePCe connection to the slave
+
+        File contents are sent in chunks of native_chunk_size bytes,
+        all-zero chunks are left out, to be holes on the slave. With
+        native_append_delta, the slave copy is kept and only the chunks
+        which differ from it (by md5) are sent; all-zero chunks then
+        are left out only beyond the end of the slave copy.
+        """
+        if not files:
+            raise GsyncdError("no files to sync")
+        logging.debug("files: " + ", ".join(files))
+        bsize = int(gconf.native_chunk_size)
+        delta = boolify(gconf.native_append_delta)
+        infos = self.server.data_info(files, delta and bsize or 0)
+        failures = []
+        ops = []
+        opsize = 0
+        sent = 0
+
+        for f in files:
+            if isinstance(infos[f], int):
+                failures.append((f, infos[f]))
+                continue
+            ssize, sums = infos[f]
+            try:
+                fd = os.open(f, os.O_RDONLY)
+            except OSError as e:
+                if e.errno != ENOENT:
+                    raise
+                failures.append((f, e.errno))
+                continue
+            try:
+                st = os.fstat(fd)
+                if not delta:
+                    ops.append(('trunc', f, 0))
+                    ssize = 0
+                pos = 0
+                while pos < st.st_size:
+                    data = os.read(fd, bsize)
+                    if not data:
+                        break
+                    i = pos // bsize
+                    same = i < len(sums) and \
+                        syncdutils.md5hex(data) == sums[i]
+                    if not same and (pos < ssize or
+                                     data.count('\0') != len(data)):
+                        ops.append(('write', f, pos, data))
+                        opsize += len(data)
+                        sent += len(data)
+                    pos += len(data)
+                    if opsize >= bsize:
+                        failures.extend(self.server.data_ops(ops))
+                        ops, opsize = [], 0
+            finally:
+                os.close(fd)
+            # also makes up for trailing holes
+            ops.append(('trunc', f, pos))
+            ops.append(('attr', f, st.st_uid, st.st_gid, st.st_mode,
+                        st.st_atime, st.st_mtime))
+        if ops:
+            failures.extend(self.server.data_ops(ops))
+
+        if failures:
+            logging.debug("native transfer failures: %s" % repr(failures))
+        return NativeTransfer(failures, sent)
+
     def tarssh(self, files, slaveurl):
         """invoke tar+ssh
         -z (compress) can be use if needed, but omitting it now
@@ -960,6 +1231,7 @@ class SlaveRemote(object):
         tar_cmd = ["tar"] + \
             ["-cf", "-", "--files-from", "-"]
         ssh_cmd = gconf.ssh_command_tar.split() + \
+            (gconf.ssh_ctl_args_tar or []) + \
             [host, "tar"] + \
             ["--overwrite", "-xf", "-", "-C", rdir]
         p0 = Popen(tar_cmd, stdout=subprocess.PIPE,
@@ -1342,6 +1614,15 @@ class GLUSTER(AbstractUrl, SlaveLocal, SlaveRemote):
                                 pass
                         return e
 
+                    @classmethod
+                    def dentries(cls, path):
+                        d = super(brickserver, cls).dentries(path)
+                        # on the brick don't mess with /.glusterfs
+                        if path == '.':
+                            d = [de for de in d if de[0] not in
+                                 ('.glusterfs', '.trashcan')]
+                        return d
+
                     @classmethod
                     def lstat(cls, e):
                         """ path based backend stat """
@@ -1371,6 +1652,12 @@ class GLUSTER(AbstractUrl, SlaveLocal, SlaveRemote):
                                               uuid + '.' + gconf.slave_id)
                         ),
                         slave.server)
+                    slave.server.stimes = types.MethodType(
+                        lambda _self, paths, uuid: (
+                            brickserver.stimes(paths,
+                                               uuid + '.' + gconf.slave_id)
+                        ),
+                        slave.server)
                     slave.server.set_stime = types.MethodType(
                         lambda _self, path, uuid, mark: (
                             brickserver.set_stime(path,
@@ -1397,8 +1684,22 @@ class GLUSTER(AbstractUrl, SlaveLocal, SlaveRemote):
             os.close(int(ra))
             os.close(int(wa))
             changelog_agent = RepceClient(int(inf), int(ouf))
-            status = GeorepStatus(gconf.state_file, gconf.local_path)
+            status = GeorepStatus(gconf.state_file, gconf.local_path,
+                                  float(gconf.status_flush_interval),
+                                  float(gconf.metrics_window))
+            gconf.brick_status = status
+            if isinstance(slave.server, RepceClient):
+                status.metrics.sources['slave'] = slave.server.call_stats
+            status.metrics.sources['changelog_agent'] = \
+                changelog_agent.call_stats
             status.reset_on_worker_start()
+            if boolify(gconf.profile):
+                gconf.profile_dir = os.path.join(
+                    gconf.working_dir, syncdutils.md5hex(gconf.local_path),
+                    "profiles")
+                errno_wrap(os.makedirs, [gconf.profile_dir], [EEXIST])
+                logging.info("profiling, profiles go to %s" %
+                             gconf.profile_dir)
             rv = changelog_agent.version()
             if int(rv) != CHANGELOG_AGENT_CLIENT_VERSION:
                 raise GsyncdError(
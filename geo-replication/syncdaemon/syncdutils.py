@@ -16,13 +16,19 @@ import fcntl
 import shutil
 import logging
 import socket
-from threading import Lock, Thread as baseThread
+import cProfile
+from threading import Lock, Event, Condition, Thread as baseThread
 from errno import EACCES, EAGAIN, EPIPE, ENOTCONN, ECONNABORTED
 from errno import EINTR, ENOENT, EPERM, ESTALE, errorcode
 from signal import signal, SIGTERM
 import select as oselect
 from os import waitpid as owaitpid
 
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    # py 3
+    from queue import Queue, Empty
 try:
     from cPickle import PickleError
 except ImportError:
@@ -130,6 +136,15 @@ def setup_ssh_ctl(ctld, remote_addr, resource_url):
     ssh_ctl_path = os.path.join(gconf.ssh_ctl_dir,
                                 "%s.sock" % content_md5)
     gconf.ssh_ctl_args = ["-oControlMaster=auto", "-S", ssh_ctl_path]
+    # tar+ssh authenticates with a key of its own, so it can't share
+    # the connection of the gsyncd peer; have it a master of its own
+    # which is kept around between the transfers
+    ssh_ctl_path_tar = os.path.join(gconf.ssh_ctl_dir,
+                                    "%s-tar.sock" % content_md5)
+    gconf.ssh_ctl_args_tar = ["-oControlMaster=auto",
+                              "-oControlPersist=%d" %
+                              int(gconf.ssh_ctl_persist),
+                              "-S", ssh_ctl_path_tar]
 
 
 def grabfile(fname, content=None):
@@ -216,6 +231,12 @@ def finalize(*a, **kw):
             if sys.exc_info()[0] == OSError:
                 pass
 
+    if gconf.brick_status:
+        try:
+            gconf.brick_status.flush()
+        except (IOError, OSError):
+            pass
+
     if gconf.log_exit:
         logging.info("exiting.")
     sys.stdout.flush()
@@ -499,6 +520,208 @@ def lstat(e):
             raise
 
 
+def parallel_map(func, items, nthreads):
+    """apply @func to each of @items, using up to @nthreads threads
+
+    Return a dict mapping items to the respective results.
+    """
+    res = {}
+    items = list(items)
+    if nthreads < 2 or len(items) < 2:
+        for i in items:
+            res[i] = func(i)
+        return res
+
+    q = Queue()
+    for i in items:
+        q.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = q.get_nowait()
+            except Empty:
+                return
+            res[i] = func(i)
+
+    threads = [Thread(target=worker)
+               for _ in range(min(nthreads, len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return res
+
+
+def ordered_parallel_map(func, items, keys, nthreads):
+    """apply @func to each of @items, using up to @nthreads threads
+
+    @keys maps an item to the keys of what it operates on. Items
+    sharing a key are applied in their order in @items, the rest
+    concurrently. Return the list of results, in order of @items.
+    If @func raises, no further items are started and the first
+    exception is re-raised.
+    """
+    items = list(items)
+    if nthreads < 2 or len(items) < 2:
+        return [func(i) for i in items]
+
+    # an item depends on the previous one of each of its keys
+    deps = []
+    last = {}
+    for n, i in enumerate(items):
+        d = set()
+        for k in keys(i):
+            if k in last:
+                d.add(last[k])
+            last[k] = n
+        deps.append(d)
+
+    res = [None] * len(items)
+    done = [Event() for _ in items]
+    errors = []
+    q = Queue()
+    for n in range(len(items)):
+        q.put(n)
+
+    # items are taken in order, so whatever is waited for has
+    # already been taken by another worker
+    def worker():
+        while not errors:
+            try:
+                n = q.get_nowait()
+            except Empty:
+                return
+            try:
+                for d in deps[n]:
+                    done[d].wait()
+                if not errors:
+                    res[n] = func(items[n])
+            except:
+                errors.append(sys.exc_info()[1])
+            finally:
+                done[n].set()
+
+    threads = [Thread(target=worker)
+               for _ in range(min(nthreads, len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return res
+
+
+class Prefetcher(object):
+
+    """compute results of a function ahead of them being asked for
+
+    Keys are queued up with push(), and the worker threads take
+    the most recently pushed one first, which suits depth first
+    walks. get() returns the result for a pushed key, computing
+    it on the spot if no worker has started on it yet. At most
+    @ahead results are computed, or being computed, ahead of
+    being asked for, and at most @depth keys are kept queued up:
+    the ones pushed the earliest are dropped beyond that, and left
+    for get() to compute.
+    """
+
+    def __init__(self, func, nthreads, ahead, depth):
+        self.func = func
+        self.ahead = ahead
+        self.depth = depth
+        self.stack = []
+        self.pending = set()
+        self.running = set()
+        self.results = {}
+        self.closed = False
+        self.lever = Condition()
+        self.threads = []
+        for i in range(nthreads):
+            t = Thread(target=self.worker)
+            t.start()
+            self.threads.append(t)
+
+    def push(self, keys):
+        """queue up @keys, the last one is to be taken first"""
+        self.lever.acquire()
+        try:
+            self.stack.extend(keys)
+            self.pending.update(keys)
+            if len(self.stack) > self.depth:
+                self.pending.difference_update(self.stack[:-self.depth])
+                del self.stack[:-self.depth]
+            self.lever.notifyAll()
+        finally:
+            self.lever.release()
+
+    def compute(self, key):
+        try:
+            return (False, self.func(key))
+        except:
+            return (True, sys.exc_info()[1])
+
+    def worker(self):
+        self.lever.acquire()
+        try:
+            while True:
+                while not self.closed and \
+                    (not self.stack or len(self.results) +
+                     len(self.running) >= self.ahead):
+                    self.lever.wait()
+                if self.closed:
+                    return
+                key = self.stack.pop()
+                if key not in self.pending:
+                    # taken by get() meanwhile
+                    continue
+                self.pending.remove(key)
+                self.running.add(key)
+                self.lever.release()
+                try:
+                    res = self.compute(key)
+                finally:
+                    self.lever.acquire()
+                self.running.remove(key)
+                self.results[key] = res
+                self.lever.notifyAll()
+        finally:
+            self.lever.release()
+
+    def get(self, key):
+        """return the result of @key, raise what it raised"""
+        self.lever.acquire()
+        try:
+            if key in self.pending:
+                self.pending.remove(key)
+                res = None
+            elif key not in self.running and key not in self.results:
+                # dropped, or never pushed
+                res = None
+            else:
+                while key not in self.results:
+                    self.lever.wait()
+                res = self.results.pop(key)
+                self.lever.notifyAll()
+        finally:
+            self.lever.release()
+        if not res:
+            res = self.compute(key)
+        if res[0]:
+            raise res[1]
+        return res[1]
+
+    def close(self):
+        """let the workers go"""
+        self.lever.acquire()
+        try:
+            self.closed = True
+            self.lever.notifyAll()
+        finally:
+            self.lever.release()
+
+
 class NoPurgeTimeAvailable(Exception):
     pass
 
@@ -509,3 +732,57 @@ class PartialHistoryAvailable(Exception):
 
 class ChangelogException(OSError):
     pass
+
+
+class Profile(object):
+
+    """cProfile-ing of units of work done by a thread
+
+    Used as a context manager around a unit of work, which is profiled
+    only if profiling is enabled (gconf.profile_dir is set). Profiles
+    are accumulated and written to <name>.<tag>.prof in the profile
+    dir on .dump(), or when leaving a unit if @interval seconds passed
+    since the last dump. Units may nest, the outermost one counts. The
+    Profile of a thread is not to be entered by others while it is
+    entered.
+    """
+
+    def __init__(self, name, interval=None):
+        self.name = name
+        self.interval = interval
+        self.prof = None
+        self.last = time.time()
+        self.depth = 0
+
+    def __enter__(self):
+        self.depth += 1
+        if self.depth == 1 and gconf.profile_dir:
+            if not self.prof:
+                self.prof = cProfile.Profile()
+            self.prof.enable()
+        return self
+
+    def __exit__(self, *_):
+        self.depth -= 1
+        if self.depth or not self.prof:
+            return
+        self.prof.disable()
+        if self.interval is not None and \
+           time.time() - self.last >= self.interval:
+            self.dump()
+
+    def dump(self, tag=None):
+        """write out the profile collected so far, and start anew"""
+        prof, self.prof = self.prof, None
+        self.last = time.time()
+        if not prof or not gconf.profile_dir:
+            return
+        if not tag:
+            tag = "%d" % (self.last * 1000)
+        path = os.path.join(gconf.profile_dir,
+                            "%s.%s.prof" % (self.name, tag))
+        try:
+            prof.dump_stats(path)
+        except (IOError, OSError):
+            logging.warn("failed to write profile %s: %s" %
+                         (path, sys.exc_info()[1]))
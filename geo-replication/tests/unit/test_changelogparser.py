@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+import unittest
+
+from syncdaemon.changelogparser import parse_records
+from syncdaemon.changelogparser import TYPE_ENTRY, TYPE_DATA, TYPE_META
+
+GFID = "4e2f4dc2-8a3b-4ef5-9f3a-0f7b4c4e7d10"
+PGFID = "00000000-0000-0000-0000-000000000001"
+
+
+class ChangelogParserTestCase(unittest.TestCase):
+    def test_entry_record(self):
+        recs = list(parse_records(
+            ["E %s CREATE 33188 0 0 %s%%2Ff1\n" % (GFID, PGFID)]))
+        self.assertEqual(len(recs), 1)
+        self.assertEqual(recs[0].type, TYPE_ENTRY)
+        self.assertEqual(recs[0].gfid, GFID)
+        self.assertEqual(recs[0].op, "CREATE")
+        self.assertEqual(recs[0].fields,
+                         ("33188", "0", "0", "%s%%2Ff1" % PGFID))
+
+    def test_data_record(self):
+        recs = list(parse_records(["D %s\n" % GFID]))
+        self.assertEqual(recs[0].type, TYPE_DATA)
+        self.assertEqual(recs[0].gfid, GFID)
+        self.assertEqual(recs[0].op, None)
+        self.assertEqual(recs[0].fields, ())
+
+    def test_meta_record(self):
+        recs = list(parse_records(["M %s SETATTR\n" % GFID]))
+        self.assertEqual(recs[0].type, TYPE_META)
+        self.assertEqual(recs[0].op, "SETATTR")
+        self.assertEqual(recs[0].fields, ())
+
+    def test_skip_empty_lines(self):
+        recs = list(parse_records(["\n", "D %s\n" % GFID, ""]))
+        self.assertEqual(len(recs), 1)
+
+    def test_repr(self):
+        line = "E %s RENAME %s%%2Fa %s%%2Fb" % (GFID, PGFID, PGFID)
+        self.assertEqual(repr(list(parse_records([line]))[0]), line)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from syncdaemon import dirscan
+
+
+class DirscanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, 'd'))
+        open(os.path.join(self.dir, 'f'), 'w').close()
+        os.symlink('d', os.path.join(self.dir, 'l'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_scandir(self):
+        ents = sorted(dirscan.scandir(self.dir))
+        self.assertEqual([(name, dtype) for name, dtype, _ in ents],
+                         [('d', dirscan.DT_DIR), ('f', dirscan.DT_REG),
+                          ('l', dirscan.DT_LNK)])
+        for name, _, ino in ents:
+            self.assertEqual(ino, os.lstat(os.path.join(self.dir,
+                                                        name)).st_ino)
+
+    def test_missing(self):
+        self.assertRaises(OSError, dirscan.scandir,
+                          os.path.join(self.dir, 'nonexistent'))
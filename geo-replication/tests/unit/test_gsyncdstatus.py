@@ -11,13 +11,17 @@
 
 import unittest
 import os
+import json
+import time
 import urllib
 
-from syncdaemon.gstatus import GeorepStatus, set_monitor_status
-from syncdaemon.gstatus import get_default_values
-from syncdaemon.gstatus import MONITOR_STATUS, DEFAULT_STATUS
-from syncdaemon.gstatus import STATUS_VALUES, CRAWL_STATUS_VALUES
-from syncdaemon.gstatus import human_time, human_time_utc
+from syncdaemon.gsyncdstatus import GeorepStatus, set_monitor_status
+from syncdaemon.gsyncdstatus import get_default_values
+from syncdaemon.gsyncdstatus import MONITOR_STATUS, DEFAULT_STATUS
+from syncdaemon.gsyncdstatus import STATUS_VALUES, CRAWL_STATUS_VALUES
+from syncdaemon.gsyncdstatus import human_time, human_time_utc
+from syncdaemon.gsyncdstatus import status_region, REGION_FILE
+from syncdaemon.gsyncdstatus import Metrics, METRICS_FIELDS
 
 
 class GeorepStatusTestCase(unittest.TestCase):
@@ -35,6 +39,9 @@ class GeorepStatusTestCase(unittest.TestCase):
     def tearDownClass(cls):
         os.remove(cls.statusfile)
         os.remove(cls.monitor_status_file)
+        os.remove(os.path.join(cls.work_dir, REGION_FILE))
+        if os.path.exists(cls.status.detail_file):
+            os.remove(cls.status.detail_file)
 
     def _filter_dict(self, inp, keys):
         op = {}
@@ -188,6 +195,106 @@ class GeorepStatusTestCase(unittest.TestCase):
         set_monitor_status(self.monitor_status_file, "Started")
         self.status.set_active()
 
+    def test_deferred_flush(self):
+        set_monitor_status(self.monitor_status_file, "Started")
+        status = GeorepStatus(self.monitor_status_file, self.brick, 3600)
+        status.set_active()
+        status.set_field("entry", 0)
+        status.inc_value("entry", 3)
+        status.dec_value("entry", 1)
+        self.assertEqual(status.get_status()["entry"], 2)
+        with open(self.statusfile) as f:
+            self.assertEqual(json.load(f)["entry"], 0)
+        status.set_worker_crawl_status("Changelog Crawl")
+        with open(self.statusfile) as f:
+            self.assertEqual(json.load(f)["entry"], 2)
+
+    def test_checkpoint_flush(self):
+        set_monitor_status(self.monitor_status_file, "Started")
+        status = GeorepStatus(self.monitor_status_file, self.brick, 3600)
+        status.set_last_synced((100, 0), 200)
+        status.set_last_synced((150, 0), 200)
+        with open(self.statusfile) as f:
+            data = json.load(f)
+        self.assertEqual(data["last_synced"], 100)
+        self.assertEqual(data["checkpoint_completed"], "No")
+        # the checkpoint completion is not held back
+        status.set_last_synced((250, 0), 200)
+        with open(self.statusfile) as f:
+            data = json.load(f)
+        self.assertEqual(data["last_synced"], 250)
+        self.assertEqual(data["checkpoint_completed"], "Yes")
+        self.assertEqual(data["checkpoint_time"], 200)
+
+    def test_status_region(self):
+        set_monitor_status(self.monitor_status_file, "Started")
+        self.status.set_active()
+        self.status.set_slave_node("fvm2")
+        self.status.set_field("meta", 7)
+        region = status_region(self.work_dir)
+        self.assertEqual(region.get_monitor_status(), "Started")
+        data = region.get_all()[self.brick]
+        self.assertEqual(data["worker_status"], "Active")
+        self.assertEqual(data["slave_node"], "fvm2")
+        self.assertEqual(data["meta"], 7)
+
+        # the status files are not read while the region is there
+        with open(self.monitor_status_file, "w") as f:
+            f.write("Paused")
+        with open(self.statusfile, "w") as f:
+            f.write("{}")
+        status = self.status.get_status()
+        self.assertEqual(status["worker_status"], "Active")
+        self.assertEqual(status["meta"], 7)
+
+    def test_metrics(self):
+        metrics = Metrics(60)
+        metrics.start -= 10
+        metrics.record("changelog_parse", 5, 0.5)
+        metrics.record("entry_ops", 100, 2)
+        metrics.record("data", 4096, 1)
+        metrics.record("data", 6144, 3)
+        now = time.time()
+        metrics.stimes.append((now - 8, int(now) - 100))
+        metrics.set_synced(int(now) - 60)
+        snap = metrics.snapshot()
+        self.assertAlmostEqual(snap["phases"]["changelog_parse"]["rate"],
+                               0.5, 1)
+        self.assertAlmostEqual(snap["phases"]["entry_ops"]["rate"], 10, 0)
+        self.assertEqual(snap["phases"]["data"]["amount"], 10240)
+        self.assertEqual(snap["phases"]["data"]["max"], 3)
+        self.assertEqual(snap["phases"]["meta_ops"]["count"], 0)
+        self.assertTrue(60 <= snap["lag"] < 62)
+        # 40 seconds of stime in 8 seconds: 5x the clock
+        self.assertTrue(14 < snap["catchup_eta"] < 16)
+
+        # stime not advancing faster than the clock
+        metrics = Metrics(60)
+        metrics.stimes.append((now - 10, int(now) - 100))
+        metrics.set_synced(int(now) - 95)
+        snap = metrics.snapshot()
+        self.assertTrue(snap["lag"] >= 95)
+        self.assertEqual(snap["catchup_eta"], None)
+
+    def test_metrics_status(self):
+        set_monitor_status(self.monitor_status_file, "Started")
+        self.status.set_active()
+        self.status.metrics.record("entry_ops", 30, 1.5)
+        self.status.publish_metrics()
+        status = self.status.get_status()
+        self.assertTrue(status["entries_per_sec"] > 0)
+        self.assertEqual(status["entry_ops_time"], 1.5)
+        self.assertEqual(status["lag"], DEFAULT_STATUS)
+        self.assertEqual(status["catchup_eta"], DEFAULT_STATUS)
+        with open(self.status.detail_file) as f:
+            detail = json.load(f)
+        self.assertEqual(detail["phases"]["entry_ops"]["amount"], 30)
+
+        self.status.set_passive()
+        status = self.status.get_status()
+        for key in METRICS_FIELDS:
+            self.assertEqual(status[key], DEFAULT_STATUS)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+import unittest
+
+from syncdaemon.master import coalesce_records
+from syncdaemon.changelogparser import parse_records
+
+F = "4e2f4dc2-8a3b-4ef5-9f3a-0f7b4c4e7d10"
+G = "9c1e3a1b-2d4f-4a6b-8c0d-1e2f3a4b5c6d"
+D = "5a6b7c8d-9e0f-4a1b-8c2d-3e4f5a6b7c8d"
+P = "00000000-0000-0000-0000-000000000001"
+
+
+def coalesce(lines):
+    return [repr(rec) for rec in coalesce_records(parse_records(lines))]
+
+
+class CoalesceTestCase(unittest.TestCase):
+    def test_create_unlink(self):
+        self.assertEqual(coalesce([
+            "E %s CREATE 33188 0 0 %s%%2Ftmp" % (F, P),
+            "D %s" % F,
+            "M %s SETATTR" % F,
+            "D %s" % F,
+            "E %s UNLINK %s%%2Ftmp" % (F, P),
+        ]), [])
+
+    def test_create_link_unlink(self):
+        lines = [
+            "E %s CREATE 33188 0 0 %s%%2Fa" % (F, P),
+            "E %s LINK %s%%2Fb" % (F, P),
+            "E %s UNLINK %s%%2Fa" % (F, P),
+        ]
+        self.assertEqual(coalesce(lines), lines)
+
+    def test_rename_chain(self):
+        lines = [
+            "E %s RENAME %s%%2Fa %s%%2Fb" % (F, P, P),
+            "E %s MKDIR 16877 0 0 %s%%2Fd" % (D, P),
+            "E %s RENAME %s%%2Fb %s%%2Fc" % (F, P, D),
+        ]
+        # b might exist on the slave, and is replaced by the first rename
+        self.assertEqual(coalesce(lines), lines)
+
+    def test_rename_chain_name_freed(self):
+        self.assertEqual(coalesce([
+            "E %s UNLINK %s%%2Fb" % (G, P),
+            "E %s RENAME %s%%2Fa %s%%2Fb" % (F, P, P),
+            "E %s MKDIR 16877 0 0 %s%%2Fd" % (D, P),
+            "E %s RENAME %s%%2Fb %s%%2Fc" % (F, P, D),
+        ]), [
+            "E %s UNLINK %s%%2Fb" % (G, P),
+            "E %s MKDIR 16877 0 0 %s%%2Fd" % (D, P),
+            "E %s RENAME %s%%2Fa %s%%2Fc" % (F, P, D),
+        ])
+
+    def test_rename_back_and_forth(self):
+        lines = [
+            "E %s RENAME %s%%2Fa %s%%2Fb" % (F, P, P),
+            "E %s RENAME %s%%2Fb %s%%2Fa" % (F, P, P),
+        ]
+        self.assertEqual(coalesce(lines), lines)
+
+    def test_rename_back_and_forth_name_freed(self):
+        self.assertEqual(coalesce([
+            "E %s UNLINK %s%%2Fb" % (G, P),
+            "E %s RENAME %s%%2Fa %s%%2Fb" % (F, P, P),
+            "E %s RENAME %s%%2Fb %s%%2Fa" % (F, P, P),
+        ]), [
+            "E %s UNLINK %s%%2Fb" % (G, P),
+        ])
+
+    def test_rename_chain_name_reused(self):
+        lines = [
+            "E %s RENAME %s%%2Fa %s%%2Fb" % (F, P, P),
+            "E %s CREATE 33188 0 0 %s%%2Fa" % (G, P),
+            "E %s RENAME %s%%2Fb %s%%2Fc" % (F, P, P),
+        ]
+        self.assertEqual(coalesce(lines), lines)
+
+    def test_rename_chain_parent_removed(self):
+        lines = [
+            "E %s RENAME %s%%2Fa %s%%2Fb" % (F, D, P),
+            "E %s RMDIR %s%%2Fd" % (D, P),
+            "E %s RENAME %s%%2Fb %s%%2Fc" % (F, P, P),
+        ]
+        self.assertEqual(coalesce(lines), lines)
+
+    def test_data_meta(self):
+        self.assertEqual(coalesce([
+            "D %s" % F,
+            "M %s SETATTR" % F,
+            "E %s CREATE 33188 0 0 %s%%2Fg" % (G, P),
+            "D %s" % G,
+            "M %s SETATTR" % F,
+            "D %s" % F,
+            "E %s RENAME %s%%2Fg %s%%2Fh" % (G, P, P),
+            "E %s UNLINK %s%%2Fh" % (G, P),
+        ]), [
+            "E %s CREATE 33188 0 0 %s%%2Fg" % (G, P),
+            "M %s SETATTR" % F,
+            "D %s" % F,
+            "E %s RENAME %s%%2Fg %s%%2Fh" % (G, P, P),
+            "E %s UNLINK %s%%2Fh" % (G, P),
+        ])
+
+    def test_data_unlink_other_links(self):
+        # G may have further links on the slave, or be hardlinked here
+        for lines in ([
+            "D %s" % G,
+            "E %s UNLINK %s%%2Fg" % (G, P),
+        ], [
+            "E %s CREATE 33188 0 0 %s%%2Fg" % (G, P),
+            "E %s LINK %s%%2Fh" % (G, P),
+            "D %s" % G,
+            "E %s UNLINK %s%%2Fg" % (G, P),
+        ]):
+            self.assertEqual(coalesce(lines), lines)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from syncdaemon.gsyncdstatus import get_default_values
+from syncdaemon.openmetrics import render, MetricsExporter
+
+
+def worker():
+    status = get_default_values()
+    status.update(worker_status="Active", crawl_status="Changelog Crawl",
+                  last_synced=1500000000, entry=3, failures=1)
+    detail = {"lag": 12.5, "catchup_eta": None,
+              "totals": {"entry_ops": {"count": 2, "amount": 40,
+                                       "time": 1.5},
+                         "batch": {"count": 2, "amount": 4, "time": 6.0}},
+              "calls": {"slave": {"entry_ops": {"calls": 2, "time": 1.25,
+                                                "max": 1.0}}},
+              "gauges": {"syncer_queue": 7, "transfers_running": 1},
+              "counters": {"transfers": 5, "transfer_failures": 2}}
+    return ('/bricks/b"1', status, detail)
+
+
+def fetch(sockpath):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sockpath)
+    text = ""
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        text += data
+    sock.close()
+    return text
+
+
+class OpenMetricsTestCase(unittest.TestCase):
+    def test_render(self):
+        text = render([worker()], "Started")
+        lines = text.splitlines()
+        self.assertEqual(lines[-1], "# EOF")
+        for line in [
+                'gsyncd_monitor_status{gsyncd_monitor_status="Started"} 1',
+                'gsyncd_monitor_status{gsyncd_monitor_status="Paused"} 0',
+                'gsyncd_worker_status{brick="/bricks/b\\"1",'
+                'gsyncd_worker_status="Active"} 1',
+                'gsyncd_crawl_status{brick="/bricks/b\\"1",'
+                'gsyncd_crawl_status="Changelog Crawl"} 1',
+                'gsyncd_pending{brick="/bricks/b\\"1",kind="entry"} 3',
+                'gsyncd_last_synced_timestamp_seconds{brick="/bricks/b'
+                '\\"1"} 1500000000',
+                'gsyncd_lag_seconds{brick="/bricks/b\\"1"} 12.5',
+                'gsyncd_phase_seconds_total{brick="/bricks/b\\"1",'
+                'phase="entry_ops"} 1.5',
+                'gsyncd_batch_duration_seconds_count{brick="/bricks/b\\"1"}'
+                ' 2',
+                'gsyncd_repce_call_duration_seconds_sum{brick="/bricks/b'
+                '\\"1",peer="slave",method="entry_ops"} 1.25',
+                'gsyncd_syncer_queue_files{brick="/bricks/b\\"1"} 7',
+                'gsyncd_transfer_failures_total{brick="/bricks/b\\"1"} 2',
+                "# TYPE gsyncd_transfers counter",
+                "# UNIT gsyncd_lag_seconds seconds"]:
+            self.assertTrue(line in lines, line)
+        # unknown values are left out
+        self.assertFalse("gsyncd_catchup_eta_seconds" in text)
+        # one family is not split up
+        types = [line for line in lines if line.startswith("# TYPE")]
+        self.assertEqual(len(types), len(set(types)))
+
+    def test_render_without_detail(self):
+        brick, status, _ = worker()
+        status["worker_status"] = "Passive"
+        text = render([(brick, status, None)])
+        self.assertTrue('gsyncd_worker_status{brick="/bricks/b\\"1",'
+                        'gsyncd_worker_status="Passive"} 1' in text)
+        self.assertFalse("gsyncd_lag_seconds" in text)
+
+    def test_render_zero(self):
+        brick, status, _ = worker()
+        status.update(last_synced=0, entry=0)
+        lines = render([(brick, status, None)]).splitlines()
+        # zeros are values like any other
+        self.assertTrue('gsyncd_last_synced_timestamp_seconds{brick='
+                        '"/bricks/b\\"1"} 0' in lines)
+        self.assertTrue('gsyncd_pending{brick="/bricks/b\\"1",'
+                        'kind="entry"} 0' in lines)
+
+    def test_export(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            def collect():
+                return ([worker()], "Started")
+
+            path = os.path.join(tmpdir, "metrics.prom")
+            MetricsExporter(path, 60, collect).start()
+            for _ in range(100):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.05)
+            with open(path) as f:
+                self.assertEqual(f.read(), render(*collect()))
+
+            # a collection failing does not stop the serving
+            fails = [ValueError("bad status")]
+
+            def flaky():
+                if fails:
+                    raise fails.pop()
+                return collect()
+
+            sockpath = os.path.join(tmpdir, "metrics.sock")
+            MetricsExporter("unix:" + sockpath, 0, flaky).start()
+            for _ in range(100):
+                if os.path.exists(sockpath):
+                    break
+                time.sleep(0.05)
+            time.sleep(0.05)
+            self.assertEqual(fetch(sockpath), "")
+            self.assertEqual(fetch(sockpath), render(*collect()))
+
+            # failing to listen stops the exporter alone
+            t = MetricsExporter("unix:" + os.path.join(tmpdir, "none", "s"),
+                                0, collect).start()
+            t.join(5)
+            self.assertFalse(t.isAlive())
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+import os
+import time
+import unittest
+
+from syncdaemon import repce
+from syncdaemon.syncdutils import Thread
+
+
+class Backend(object):
+    def __init__(self):
+        self.log = []
+
+    def entry_ops(self, entries):
+        self.log.extend(entries)
+        return [e['gfid'] for e in entries]
+
+    def append(self, x, delay=0):
+        time.sleep(delay)
+        self.log.append(x)
+        return len(self.log)
+
+    def fail(self):
+        raise ValueError("failed")
+
+
+class RepceTestCase(unittest.TestCase):
+    def setUp(self):
+        ci, so = os.pipe()
+        si, co = os.pipe()
+        self.backend = Backend()
+        self.server = repce.RepceServer(self.backend, si, so, 4, 2)
+        Thread(target=self.server.service_loop).start()
+        self.client = repce.RepceClient(ci, co)
+
+    def check_calls(self):
+        self.assertEqual(self.client.append('a'), 1)
+        self.assertRaises(ValueError, self.client.fail)
+
+    def test_legacy(self):
+        self.assertEqual(self.client.__version__()['proto'],
+                         repce.repce_version)
+        self.check_calls()
+
+    def test_framed(self):
+        self.client.upgrade()
+        self.assertTrue(self.client.framed)
+        self.check_calls()
+
+    def test_futures_in_order(self):
+        self.client.upgrade()
+        jobs = self.client.futures([('append', (1, 0.05)),
+                                    ('append', (2,)),
+                                    ('fail', ()),
+                                    ('append', (3,))])
+        self.assertEqual(jobs[3].get(), 3)
+        self.assertRaises(ValueError, jobs[2].get)
+        self.assertEqual(self.backend.log, [1, 2, 3])
+
+    def test_compact_zlib(self):
+        self.assertEqual(self.client.upgrade({'codec': 'compact',
+                                              'zlib': 64}),
+                         {'codec': 'compact', 'zlib': 64})
+        gfid = "4e2f4dc2-8a3b-4ef5-9f3a-0f7b4c4e7d10"
+        entries = [{'op': 'CREATE', 'gfid': gfid, 'mode': 33188,
+                    'uid': 0, 'gid': 0,
+                    'entry': '.gfid/%s/f%d' % (gfid, i)} for i in range(50)]
+        entries.append({'op': 'RENAME', 'gfid': gfid, 'entry': 'a',
+                        'entry1': '.gfid/%s/b' % gfid,
+                        'stat': {'uid': 0, 'gid': 0, 'mode': 33188,
+                                 'atime': 1.5, 'mtime': 2.5}})
+        self.assertEqual(self.client.entry_ops(entries), [gfid] * 51)
+        self.assertEqual(self.backend.log, entries)
+        del self.backend.log[:]
+        self.check_calls()
+
+    def test_stats(self):
+        self.assertEqual(self.client.__stats__(), None)
+        self.client.upgrade()
+        self.check_calls()
+        self.client.append('b')
+        stats = self.client.__stats__()
+        self.assertEqual(stats['queue']['limit'], 2)
+        self.assertEqual(stats['methods']['append']['calls'], 2)
+        self.assertEqual(stats['methods']['fail']['calls'], 1)
+        calls = self.client.call_stats()
+        self.assertEqual(calls['append']['calls'], 2)
+        self.assertTrue(calls['append']['max'] <= calls['append']['time'])
+
+    def test_backpressure(self):
+        self.client.upgrade()
+        jobs = [self.client.future('append', i, 0.02) for i in range(20)]
+        self.assertEqual(sorted(job.get() for job in jobs), range(1, 21))
+        self.assertTrue(self.server.get_stats()['queue']['max'] <= 2)
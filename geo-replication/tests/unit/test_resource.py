@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+from errno import ENOENT
+
+from syncdaemon.gconf import gconf
+from syncdaemon.resource import Server, SlaveRemote
+from syncdaemon.syncdutils import md5hex
+
+BSIZE = 4096
+
+
+class SlaveServer(object):
+    """Server data calls done in the slave dir, as on the slave"""
+
+    def __init__(self, path):
+        self.path = path
+        self.calls = []
+
+    def _call(self, meth, *a):
+        self.calls.append((meth, a))
+        cwd = os.getcwd()
+        os.chdir(self.path)
+        try:
+            return getattr(Server, meth)(*a)
+        finally:
+            os.chdir(cwd)
+
+    def data_info(self, paths, blksize):
+        return self._call('data_info', paths, blksize)
+
+    def data_ops(self, ops):
+        return self._call('data_ops', ops)
+
+    def writes(self):
+        return [op for meth, a in self.calls if meth == 'data_ops'
+                for op in a[0] if op[0] == 'write']
+
+
+class DataOpsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        self.master = os.path.join(self.tmpdir, "master")
+        self.slave = os.path.join(self.tmpdir, "slave")
+        os.mkdir(self.master)
+        os.mkdir(self.slave)
+        os.chdir(self.master)
+        self.server = SlaveServer(self.slave)
+        self.engine = SlaveRemote()
+        self.engine.server = self.server
+        gconf.native_chunk_size = BSIZE
+        gconf.native_append_delta = False
+
+    def tearDown(self):
+        del gconf.native_chunk_size, gconf.native_append_delta
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, side, name, chunks, size=None):
+        """write (offset, data) @chunks to a fresh file of @side"""
+        path = os.path.join(side, name)
+        with open(path, "w") as f:
+            for off, data in chunks:
+                f.seek(off)
+                f.write(data)
+            if size is not None:
+                f.truncate(size)
+        return path
+
+    def content(self, side, name):
+        with open(os.path.join(side, name)) as f:
+            return f.read()
+
+    def assertSynced(self, name):
+        self.assertEqual(self.content(self.slave, name),
+                         self.content(self.master, name))
+        mst = os.stat(os.path.join(self.master, name))
+        sst = os.stat(os.path.join(self.slave, name))
+        self.assertEqual(sst.st_mode, mst.st_mode)
+        self.assertEqual(int(sst.st_mtime), int(mst.st_mtime))
+
+    def test_data_info(self):
+        self.write(self.slave, "f", [(0, "a" * BSIZE), (BSIZE, "b" * 10)])
+        # a hole reads as zeros
+        self.write(self.slave, "h", [(2 * BSIZE, "c")])
+        self.write(self.slave, "e", [])
+        os.chdir(self.slave)
+        info = Server.data_info(["f", "h", "e", "missing"], BSIZE)
+        self.assertEqual(info["f"], (BSIZE + 10, [md5hex("a" * BSIZE),
+                                                  md5hex("b" * 10)]))
+        self.assertEqual(info["h"], (2 * BSIZE + 1,
+                                     [md5hex("\0" * BSIZE)] * 2 +
+                                     [md5hex("c")]))
+        self.assertEqual(info["e"], (0, []))
+        self.assertEqual(info["missing"], ENOENT)
+        self.assertEqual(Server.data_info(["f"], 0), {"f": (BSIZE + 10, [])})
+
+    def test_data_op(self):
+        self.write(self.slave, "f", [(0, "0123456789")])
+        os.chdir(self.slave)
+        fds = {}
+        Server._data_op(fds, ("write", "f", 2, "ab"))
+        Server._data_op(fds, ("trunc", "f", 6))
+        Server._data_op(fds, ("attr", "f", os.getuid(), os.getgid(),
+                              0100600, 1000, 2000))
+        self.assertEqual(fds, {})
+        st = os.stat("f")
+        self.assertEqual(st.st_mode & 0777, 0600)
+        self.assertEqual((st.st_atime, st.st_mtime), (1000, 2000))
+        self.assertEqual(self.content(self.slave, "f"), "01ab45")
+        self.assertRaises(ValueError, Server._data_op, fds,
+                          ("frob", "f"))
+        for fd in fds.values():
+            os.close(fd)
+        self.assertRaises(ValueError, Server._data_op, {},
+                          ("trunc", "../f", 0))
+        self.assertRaises(ValueError, Server._data_op, {},
+                          ("trunc", "/f", 0))
+
+    def test_data_ops(self):
+        self.write(self.slave, "f", [(0, "xxxx")])
+        self.write(self.slave, "g", [(0, "yyyy")])
+        os.chdir(self.slave)
+        failures = Server.data_ops([
+            ("trunc", "f", 0),
+            ("write", "missing", 0, "a"),
+            ("write", "f", 0, "ab"),
+            # a write extends the file, leaving a hole
+            ("write", "f", 10, "c"),
+            ("trunc", "missing", 3),
+            ("trunc", "g", 2),
+        ])
+        self.assertEqual(failures, [("missing", ENOENT)])
+        self.assertEqual(self.content(self.slave, "f"),
+                         "ab" + "\0" * 8 + "c")
+        self.assertEqual(self.content(self.slave, "g"), "yy")
+        self.assertFalse(os.path.exists("missing"))
+
+    def test_native_full(self):
+        # sparse, with a hole in the middle and at the end
+        self.write(self.master, "s", [(0, "a" * 10),
+                                      (3 * BSIZE, "b" * BSIZE)],
+                   6 * BSIZE)
+        self.write(self.master, "t", [(0, "new")])
+        self.write(self.slave, "s", [(0, "z" * 9 * BSIZE)])
+        self.write(self.slave, "t", [(0, "old content")])
+        po = self.engine.native(["s", "t"])
+        self.assertEqual(po.returncode, 0)
+        self.assertSynced("s")
+        self.assertSynced("t")
+        # zero chunks are not sent
+        self.assertEqual(po.bytes_sent, BSIZE + BSIZE + 3)
+
+    def test_native_delta(self):
+        gconf.native_append_delta = True
+        chunks = [(i * BSIZE, chr(ord("a") + i) * BSIZE) for i in range(4)]
+        self.write(self.slave, "f", chunks)
+        # overwritten in place before the tail, and appended to
+        chunks[1] = (BSIZE, "X" * BSIZE)
+        self.write(self.master, "f", chunks + [(4 * BSIZE, "tail")])
+        po = self.engine.native(["f"])
+        self.assertEqual(po.returncode, 0)
+        self.assertSynced("f")
+        self.assertEqual([op[2] for op in self.server.writes()],
+                         [BSIZE, 4 * BSIZE])
+        self.assertEqual(po.bytes_sent, BSIZE + 4)
+
+    def test_native_delta_same_size(self):
+        gconf.native_append_delta = True
+        self.write(self.slave, "f", [(0, "a" * 3 * BSIZE)])
+        self.write(self.master, "f", [(0, "a" * 3 * BSIZE), (BSIZE, "b")])
+        po = self.engine.native(["f"])
+        self.assertSynced("f")
+        self.assertEqual([op[2] for op in self.server.writes()], [BSIZE])
+        self.assertEqual(po.bytes_sent, BSIZE)
+
+    def test_native_delta_truncated(self):
+        gconf.native_append_delta = True
+        self.write(self.slave, "f", [(0, "a" * 3 * BSIZE)])
+        self.write(self.master, "f", [(0, "a" * (BSIZE + 5))])
+        po = self.engine.native(["f"])
+        self.assertSynced("f")
+        # only the partial last chunk differs
+        self.assertEqual([op[2] for op in self.server.writes()], [BSIZE])
+        self.assertEqual(po.bytes_sent, 5)
+
+    def test_native_delta_holes(self):
+        gconf.native_append_delta = True
+        # data on the slave where the master has a hole now
+        self.write(self.slave, "f", [(0, "a" * 2 * BSIZE)])
+        self.write(self.master, "f", [(0, "a" * BSIZE)], 4 * BSIZE)
+        po = self.engine.native(["f"])
+        self.assertSynced("f")
+        # zeros beyond the end of the slave copy are not sent
+        self.assertEqual([op[2] for op in self.server.writes()], [BSIZE])
+        self.assertEqual(po.bytes_sent, BSIZE)
+
+    def test_native_failures(self):
+        self.write(self.master, "f", [(0, "data")])
+        self.write(self.master, "noslave", [(0, "data")])
+        self.write(self.slave, "f", [])
+        self.write(self.slave, "nomaster", [])
+        po = self.engine.native(["nomaster", "f", "noslave"])
+        self.assertEqual(po.returncode, 1)
+        self.assertEqual(sorted(po.failures), [("nomaster", ENOENT),
+                                               ("noslave", ENOENT)])
+        self.assertSynced("f")
+
+
+if __name__ == "__main__":
+    unittest.main()
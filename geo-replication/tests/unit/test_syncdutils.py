@@ -9,6 +9,12 @@
 # cases as published by the Free Software Foundation.
 #
 
+import os
+import time
+import pstats
+import shutil
+import tempfile
+import threading
 import unittest
 
 from syncdaemon import syncdutils
@@ -28,3 +34,136 @@ class SyncdutilsTestCase(unittest.TestCase):
     def test_unescape(self):
         self.assertEqual(syncdutils.unescape("http%3A%2F%2Fgluster.org"),
                          "http://gluster.org")
+
+    def test_parallel_map(self):
+        items = range(20)
+        expected = dict((i, i * i) for i in items)
+        self.assertEqual(syncdutils.parallel_map(lambda i: i * i, items, 4),
+                         expected)
+        self.assertEqual(syncdutils.parallel_map(lambda i: i * i, items, 1),
+                         expected)
+
+    def test_ordered_parallel_map(self):
+        log = []
+
+        def apply(item):
+            key, n = item
+            # make later items of a key overtake earlier ones, if allowed
+            time.sleep(0.01 * (3 - n))
+            log.append(item)
+            return n
+
+        items = [(k, n) for n in range(3) for k in 'abcd']
+        self.assertEqual(syncdutils.ordered_parallel_map(
+            apply, items, lambda item: [item[0]], 4),
+            [n for _, n in items])
+        for k in 'abcd':
+            self.assertEqual([n for key, n in log if key == k], [0, 1, 2])
+
+    def test_ordered_parallel_map_error(self):
+        def apply(i):
+            if i == 3:
+                raise ValueError(i)
+            return i
+
+        self.assertRaises(ValueError, syncdutils.ordered_parallel_map,
+                          apply, range(10), lambda i: [i], 4)
+
+    def prefetcher(self, depth):
+        """a Prefetcher with one worker, held up on the key 0"""
+        log = []
+        started = threading.Event()
+        go = threading.Event()
+
+        def func(key):
+            log.append((key, threading.current_thread().name))
+            if key == 0:
+                started.set()
+                go.wait()
+            return key * key
+
+        pf = syncdutils.Prefetcher(func, 1, 4, depth)
+        pf.push([0])
+        started.wait()
+        return pf, log, go
+
+    def test_prefetcher_order(self):
+        pf, log, go = self.prefetcher(8)
+        pf.push([1, 2])
+        pf.push([3])
+        go.set()
+        self.assertEqual([pf.get(k) for k in [0, 3, 2, 1]], [0, 9, 4, 1])
+        pf.close()
+        # the most recently pushed first
+        self.assertEqual([k for k, _ in log], [0, 3, 2, 1])
+
+    def test_prefetcher_depth(self):
+        pf, log, go = self.prefetcher(2)
+        pf.push([1, 2, 3, 4])
+        self.assertEqual(pf.stack, [3, 4])
+        self.assertEqual(pf.pending, set([3, 4]))
+        # dropped, so computed on the spot
+        self.assertEqual(pf.get(1), 1)
+        self.assertEqual(log[-1], (1, threading.current_thread().name))
+        go.set()
+        self.assertEqual([pf.get(k) for k in [0, 4, 3, 2]], [0, 16, 9, 4])
+        pf.close()
+        self.assertEqual([k for k, _ in log], [0, 1, 4, 3, 2])
+
+    def test_prefetcher_close(self):
+        pf, log, go = self.prefetcher(8)
+        pf.push([1])
+        pf.close()
+        go.set()
+        for t in pf.threads:
+            t.join(5)
+            self.assertFalse(t.isAlive())
+        # not taken by a worker, so computed on the spot
+        self.assertEqual(pf.get(1), 1)
+        self.assertEqual(pf.get(0), 0)
+        self.assertEqual([k for k, _ in log], [0, 1])
+
+    def test_prefetcher_error(self):
+        def func(key):
+            raise ValueError(key)
+
+        pf = syncdutils.Prefetcher(func, 2, 4, 8)
+        pf.push([1, 2])
+        self.assertRaises(ValueError, pf.get, 2)
+        self.assertRaises(ValueError, pf.get, 1)
+        pf.close()
+
+    def test_profile(self):
+        def work():
+            return sum(i * i for i in range(1000))
+
+        tmpdir = tempfile.mkdtemp()
+        gconf = syncdutils.gconf
+        try:
+            profile = syncdutils.Profile("unit")
+            with profile:
+                work()
+            self.assertEqual(profile.prof, None)
+
+            gconf.profile_dir = tmpdir
+            with profile:
+                with profile:
+                    work()
+                work()
+            with profile:
+                work()
+            profile.dump("x")
+            path = os.path.join(tmpdir, "unit.x.prof")
+            calls = [cnt for (fn, _, name), (cnt, _, _, _, _) in
+                     pstats.Stats(path).stats.items() if name == "work"]
+            self.assertEqual(calls, [3])
+
+            # dumped when leaving after the interval
+            profile = syncdutils.Profile("periodic", 0)
+            with profile:
+                work()
+            self.assertEqual(len([f for f in os.listdir(tmpdir)
+                                  if f.startswith("periodic.")]), 1)
+        finally:
+            gconf.profile_dir = None
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2011-2014 Red Hat, Inc. <http://www.redhat.com>
+# This file is part of GlusterFS.
+
+# This file is licensed to you under your choice of the GNU Lesser
+# General Public License, version 3 or any later version (LGPLv3 or
+# later), or the GNU General Public License, version 2 (GPLv2), in all
+# cases as published by the Free Software Foundation.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+from errno import ENOENT
+
+from syncdaemon import dirscan
+from syncdaemon import master
+from syncdaemon.gconf import gconf
+from syncdaemon.syncdutils import unescape
+
+OPTS = {
+    'change_detector': 'xsync',
+    'special_sync_mode': None,
+    'ignore_deletes': 'false',
+    'use_rsync_xattrs': 'false',
+    'use_tarssh': 'false',
+    'sync_engine': None,
+    'sync_jobs': 1,
+    'sync_batch_min_files': 1,
+    'sync_batch_max_delay': 0.5,
+    'turns': 0,
+    'xsync_crawl_threads': 1,
+    'xsync_resume': 'true',
+    'local_path': '/bricks/b1',
+}
+
+
+class BrickServer(object):
+    """the master brick: a local directory, xtimes all the same"""
+
+    def __init__(self):
+        self.xtimes = {}
+
+        class aggregated(object):
+            @staticmethod
+            def set_xtime(path, uuid, mark):
+                pass
+        self.aggregated = aggregated
+
+    def dentries(self, path):
+        return dirscan.scandir(path)
+
+    def gfid(self, path):
+        # the path itself, for readable changelogs
+        return os.path.normpath(path)
+
+    def lstat(self, path):
+        return os.lstat(path)
+
+    def linkto_check(self, path):
+        return False
+
+    def xtime(self, path, uuid):
+        return self.xtimes.get(os.path.normpath(path), (100, 0))
+
+
+class SlaveServer(object):
+    """a slave with stimes as given, which speaks the framed protocol"""
+
+    framed = True
+
+    def __init__(self):
+        self.stimes_set = {}
+        self.calls = []
+
+    def stime(self, path, uuid):
+        self.calls.append(('stime', path))
+        return self.stimes_set.get(os.path.normpath(path), ENOENT)
+
+    def stimes(self, paths, uuid):
+        self.calls.append(('stimes', paths))
+        return [self.stimes_set.get(os.path.normpath(p), ENOENT)
+                for p in paths]
+
+    def xtime(self, path, uuid):
+        return ENOENT
+
+
+class Resource(object):
+    def __init__(self, server):
+        self.server = server
+
+    def rsync(self, files):
+        pass
+
+
+class XsyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, "brick")
+        os.mkdir(self.root)
+        for d in ("a", "a/x", "a/y", "b", "c"):
+            os.mkdir(os.path.join(self.root, d))
+        for f in ("f", "a/f", "a/x/f", "a/y/f", "b/f", "c/f"):
+            open(os.path.join(self.root, f), "w").close()
+        os.chdir(self.root)
+        for k, v in OPTS.items():
+            setattr(gconf, k, v)
+        gconf.working_dir = os.path.join(self.tmpdir, "work")
+        self.gmaster = self.make()
+
+    def tearDown(self):
+        for k in OPTS.keys() + ['working_dir']:
+            delattr(gconf, k)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def make(self):
+        g = master.gmaster_builder('xsync')(Resource(BrickServer()),
+                                            Resource(SlaveServer()))
+        g.volinfo = {'volume_mark': (1, 0), 'uuid': 'u'}
+        # as set up by crawlwrap()
+        g.live_changelog_start_time = None
+        g.register()
+        return g
+
+    def entries(self, changelog):
+        """paths of the entries of @changelog"""
+        names = []
+        with open(changelog) as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] == 'E':
+                    names.append(os.path.normpath(unescape(fields[-1])))
+        return names
+
+    def changelog(self, g=None):
+        """paths of the entries of the xsync changelogs written"""
+        names = []
+        for mark, item in (g or self.gmaster).comlist:
+            if mark == 'xsync':
+                names.extend(self.entries(item))
+        return names
+
+    def test_slave_stimes_per_directory(self):
+        g = self.gmaster
+        g.slave.server.stimes_set['a'] = (100, 0)
+        g.Xcrawl()
+        calls = g.slave.server.calls
+        # the root for the crawl and for its scan, then the children
+        # of each directory entered in one go
+        self.assertEqual(calls, [('stime', '.'), ('stime', '.'),
+                                 ('stimes', ['./a', './b', './c'])])
+        # ./a is in sync, so it is not entered
+        self.assertEqual(self.changelog(),
+                         ['a', 'b', 'b/f', 'c', 'c/f', 'f'])
+
+    def full(self):
+        return ['a', 'a/f', 'a/x', 'a/x/f', 'a/y', 'a/y/f',
+                'b', 'b/f', 'c', 'c/f', 'f']
+
+    def checkpoint(self, frames, xtr_root=None):
+        g = self.gmaster
+        if xtr_root is None:
+            xtr_root = g.minus_infinity
+        g.xcrawl_checkpoint({'xtr_root': xtr_root, 'frames': frames})
+
+    def test_resume_after(self):
+        # interrupted in ./a, with ./a/x done
+        self.checkpoint([('.', (100, 0), 'a'), ('./a', (100, 0), 'x')])
+        g = self.make()
+        g.Xcrawl()
+        self.assertEqual(self.changelog(g),
+                         ['a/y', 'a/y/f', 'b', 'b/f', 'c', 'c/f', 'f'])
+        # stimes of the directories walked, ./a and the root as well
+        self.assertEqual([st[1][0] for st in g.comlist if st[0] == 'stime'],
+                         ['./a/y', './a', './b', './c', '.'])
+
+    def test_resume_interrupted(self):
+        g = self.gmaster
+        g.XSYNC_MAX_ENTRIES = 6
+        g.Xcrawl()
+        n = [mark for mark, item in g.comlist].index('checkpoint')
+        ckpt = g.comlist[n][1]
+        self.assertEqual(ckpt['frames'], [('.', (100, 0), 'a'),
+                                          ('./a', (100, 0), 'y'),
+                                          ('./a/y', (100, 0), None)])
+        g.comlist = g.comlist[:n]
+        done = self.changelog(g)
+        self.assertEqual(done, self.full()[:5])
+        # crashed once the first changelog was processed
+        g.xcrawl_checkpoint(ckpt)
+        g = self.make()
+        g.Xcrawl()
+        self.assertEqual(done + self.changelog(g), self.full())
+
+    def test_resume_stale(self):
+        # another crawl finished since
+        self.checkpoint([('.', (100, 0), 'a')], (50, 0))
+        g = self.make()
+        g.Xcrawl()
+        self.assertEqual(self.changelog(g), self.full())
+        # not for this root
+        self.checkpoint([('./b', (100, 0), None)])
+        g = self.make()
+        g.Xcrawl()
+        self.assertEqual(self.changelog(g), self.full())
+        # the directory is gone
+        self.checkpoint([('.', (100, 0), 'a'), ('./d', (100, 0), None)])
+        g = self.make()
+        g.Xcrawl()
+        self.assertEqual(self.changelog(g), self.full())
+        # resuming is off
+        self.checkpoint([('.', (100, 0), 'a')])
+        gconf.xsync_resume = 'false'
+        g = self.make()
+        g.Xcrawl()
+        self.assertEqual(self.changelog(g), self.full())
+
+    def test_resume_corrupt(self):
+        for data in ("", "garbage"):
+            with open(self.gmaster.xcrawl_ckpt_file(), "w") as f:
+                f.write(data)
+            g = self.make()
+            g.Xcrawl()
+            self.assertEqual(self.changelog(g), self.full())
+
+    def test_crawl_finale(self):
+        self.checkpoint([('.', (100, 0), 'c')])
+        g = self.make()
+        done = []
+
+        class status(object):
+            @staticmethod
+            def set_worker_crawl_status(status):
+                pass
+        g.status = status
+        g.process = lambda changes, n: done.extend(
+            self.entries(c) for c in changes)
+        g.archive_and_purge_changelogs = lambda changes: None
+        g.upd_stime = lambda stime, path: done.append(path)
+        g.crawl()
+        # resumed after ./c, and done with
+        self.assertEqual(done, [['f'], '.'])
+        self.assertFalse(os.path.exists(g.xcrawl_ckpt_file()))
+
+
+if __name__ == "__main__":
+    unittest.main()
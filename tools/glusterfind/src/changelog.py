@@ -22,6 +22,8 @@ from utils import mkdirp, symlink_gfid_to_path
 from utils import fail, setup_logger, find
 from utils import get_changelog_rollover_time
 from changelogdata import ChangelogData
+from changelogparser import parse_changelog
+from changelogparser import TYPE_ENTRY, TYPE_DATA, TYPE_META
 import conf
 
 
@@ -133,16 +135,17 @@ def gfid_to_path_using_pgfid(brick, changelog_data, args):
     if not changelog_data.inodegfid_exists({"converted": 0}):
         return
 
-    def inode_filter(path):
+    def inode_filter(path, ino):
         # Looks in inodegfid table, if exists returns
         # inode number else None
-        try:
-            st = os.lstat(path)
-        except (OSError, IOError):
-            st = None
+        if ino is None:
+            try:
+                ino = os.lstat(path).st_ino
+            except (OSError, IOError):
+                return None
 
-        if st and changelog_data.inodegfid_exists({"inode": st.st_ino}):
-            return st.st_ino
+        if changelog_data.inodegfid_exists({"inode": ino}):
+            return ino
 
         return None
 
@@ -171,7 +174,8 @@ def gfid_to_path_using_pgfid(brick, changelog_data, args):
                 callback_func=output_callback,
                 filter_func=inode_filter,
                 ignore_dirs=ignore_dirs,
-                subdirs_crawl=False)
+                subdirs_crawl=False,
+                with_inode=True)
         except (IOError, OSError) as e:
             logger.warn("Error converting to path: %s" % e)
             continue
@@ -182,16 +186,17 @@ def gfid_to_path_using_batchfind(brick, changelog_data):
     if not changelog_data.inodegfid_exists({"converted": 0}):
         return
 
-    def inode_filter(path):
+    def inode_filter(path, ino):
         # Looks in inodegfid table, if exists returns
         # inode number else None
-        try:
-            st = os.lstat(path)
-        except (OSError, IOError):
-            st = None
+        if ino is None:
+            try:
+                ino = os.lstat(path).st_ino
+            except (OSError, IOError):
+                return None
 
-        if st and changelog_data.inodegfid_exists({"inode": st.st_ino}):
-            return st.st_ino
+        if changelog_data.inodegfid_exists({"inode": ino}):
+            return ino
 
         return None
 
@@ -214,33 +219,34 @@ def gfid_to_path_using_batchfind(brick, changelog_data):
     # Full Namespace Crawl
     find(brick, callback_func=output_callback,
          filter_func=inode_filter,
-         ignore_dirs=ignore_dirs)
+         ignore_dirs=ignore_dirs,
+         with_inode=True)
 
 
 def parse_changelog_to_db(changelog_data, filename):
     """
     Parses a Changelog file and populates data in gfidpath table
     """
-    with open(filename) as f:
-        changelogfile = os.path.basename(filename)
-        for line in f:
-            data = line.strip().split(" ")
-            if data[0] == "E" and data[2] in ["CREATE", "MKNOD", "MKDIR"]:
-                # CREATE/MKDIR/MKNOD
-                changelog_data.when_create_mknod_mkdir(changelogfile, data)
-            elif data[0] in ["D", "M"]:
-                # DATA/META
-                if not args.only_namespace_changes:
-                    changelog_data.when_data_meta(changelogfile, data)
-            elif data[0] == "E" and data[2] in ["LINK", "SYMLINK"]:
-                # LINK/SYMLINK
-                changelog_data.when_link_symlink(changelogfile, data)
-            elif data[0] == "E" and data[2] == "RENAME":
-                # RENAME
-                changelog_data.when_rename(changelogfile, data)
-            elif data[0] == "E" and data[2] in ["UNLINK", "RMDIR"]:
-                # UNLINK/RMDIR
-                changelog_data.when_unlink_rmdir(changelogfile, data)
+    changelogfile = os.path.basename(filename)
+    for rec in parse_changelog(filename):
+        if rec.type in [TYPE_DATA, TYPE_META]:
+            # DATA/META
+            if not args.only_namespace_changes:
+                changelog_data.when_data_meta(changelogfile, rec)
+        elif rec.type != TYPE_ENTRY:
+            continue
+        elif rec.op in ["CREATE", "MKNOD", "MKDIR"]:
+            # CREATE/MKDIR/MKNOD
+            changelog_data.when_create_mknod_mkdir(changelogfile, rec)
+        elif rec.op in ["LINK", "SYMLINK"]:
+            # LINK/SYMLINK
+            changelog_data.when_link_symlink(changelogfile, rec)
+        elif rec.op == "RENAME":
+            # RENAME
+            changelog_data.when_rename(changelogfile, rec)
+        elif rec.op in ["UNLINK", "RMDIR"]:
+            # UNLINK/RMDIR
+            changelog_data.when_unlink_rmdir(changelogfile, rec)
 
 
 def get_changes(brick, hash_dir, log_file, start, end, args):
@@ -316,97 +316,99 @@ class ChangelogData(object):
         WHERE pgfid2 = ?""" % update_str
         self.cursor.execute(query, (path2, pgfid2))
 
-    def when_create_mknod_mkdir(self, changelogfile, data):
+    def when_create_mknod_mkdir(self, changelogfile, rec):
         # E <GFID> <MKNOD|CREATE|MKDIR> <MODE> <USER> <GRP> <PGFID>/<BNAME>
         # Add the Entry to DB
-        pgfid1, bn1 = urllib.unquote_plus(data[6]).split("/", 1)
+        pgfid1, bn1 = urllib.unquote_plus(rec.fields[3]).split("/", 1)
 
         # Quote again the basename
         bn1 = urllib.quote_plus(bn1.strip())
 
-        self.gfidpath_add(changelogfile, RecordType.NEW, data[1], pgfid1, bn1)
+        self.gfidpath_add(changelogfile, RecordType.NEW, rec.gfid,
+                          pgfid1, bn1)
 
-    def when_rename(self, changelogfile, data):
+    def when_rename(self, changelogfile, rec):
         # E <GFID> RENAME <OLD_PGFID>/<BNAME> <PGFID>/<BNAME>
-        pgfid1, bn1 = urllib.unquote_plus(data[3]).split("/", 1)
-        pgfid2, bn2 = urllib.unquote_plus(data[4]).split("/", 1)
+        pgfid1, bn1 = urllib.unquote_plus(rec.fields[0]).split("/", 1)
+        pgfid2, bn2 = urllib.unquote_plus(rec.fields[1]).split("/", 1)
 
         # Quote again the basename
         bn1 = urllib.quote_plus(bn1.strip())
         bn2 = urllib.quote_plus(bn2.strip())
 
-        if self.gfidpath_exists({"gfid": data[1], "type": "NEW",
+        if self.gfidpath_exists({"gfid": rec.gfid, "type": "NEW",
                                  "pgfid1": pgfid1, "bn1": bn1}):
             # If <OLD_PGFID>/<BNAME> is same as CREATE, Update
             # <NEW_PGFID>/<BNAME> in NEW.
             self.gfidpath_update({"pgfid1": pgfid2, "bn1": bn2},
-                                 {"gfid": data[1], "type": "NEW",
+                                 {"gfid": rec.gfid, "type": "NEW",
                                   "pgfid1": pgfid1, "bn1": bn1})
-        elif self.gfidpath_exists({"gfid": data[1], "type": "RENAME",
+        elif self.gfidpath_exists({"gfid": rec.gfid, "type": "RENAME",
                                    "pgfid2": pgfid1, "bn2": bn1}):
             # If <OLD_PGFID>/<BNAME> is same as <PGFID2>/<BN2>(may be previous
             # RENAME) then UPDATE <NEW_PGFID>/<BNAME> as <PGFID2>/<BN2>
             self.gfidpath_update({"pgfid2": pgfid2, "bn2": bn2},
-                                 {"gfid": data[1], "type": "RENAME",
+                                 {"gfid": rec.gfid, "type": "RENAME",
                                  "pgfid2": pgfid1, "bn2": bn1})
         else:
             # Else insert as RENAME
-            self.gfidpath_add(changelogfile, RecordType.RENAME, data[1],
+            self.gfidpath_add(changelogfile, RecordType.RENAME, rec.gfid,
                               pgfid1, bn1, pgfid2, bn2)
 
-    def when_link_symlink(self, changelogfile, data):
+    def when_link_symlink(self, changelogfile, rec):
         # E <GFID> <LINK|SYMLINK> <PGFID>/<BASENAME>
         # Add as New record in Db as Type NEW
-        pgfid1, bn1 = urllib.unquote_plus(data[3]).split("/", 1)
+        pgfid1, bn1 = urllib.unquote_plus(rec.fields[0]).split("/", 1)
 
         # Quote again the basename
         bn1 = urllib.quote_plus(bn1.strip())
 
-        self.gfidpath_add(changelogfile, RecordType.NEW, data[1], pgfid1, bn1)
+        self.gfidpath_add(changelogfile, RecordType.NEW, rec.gfid,
+                          pgfid1, bn1)
 
-    def when_data_meta(self, changelogfile, data):
+    def when_data_meta(self, changelogfile, rec):
         # If GFID row exists, Ignore else Add to Db
-        if not self.gfidpath_exists({"gfid": data[1]}):
-            self.gfidpath_add(changelogfile, RecordType.MODIFY, data[1])
+        if not self.gfidpath_exists({"gfid": rec.gfid}):
+            self.gfidpath_add(changelogfile, RecordType.MODIFY, rec.gfid)
 
-    def when_unlink_rmdir(self, changelogfile, data):
+    def when_unlink_rmdir(self, changelogfile, rec):
         # E <GFID> <UNLINK|RMDIR> <PGFID>/<BASENAME>
-        pgfid1, bn1 = urllib.unquote_plus(data[3]).split("/", 1)
+        pgfid1, bn1 = urllib.unquote_plus(rec.fields[0]).split("/", 1)
         # Quote again the basename
         bn1 = urllib.quote_plus(bn1.strip())
-        deleted_path = data[4] if len(data) == 5 else ""
+        deleted_path = rec.fields[1] if len(rec.fields) == 2 else ""
 
-        if self.gfidpath_exists({"gfid": data[1], "type": "NEW",
+        if self.gfidpath_exists({"gfid": rec.gfid, "type": "NEW",
                                  "pgfid1": pgfid1, "bn1": bn1}):
             # If path exists in table as NEW with same GFID
             # Delete that row
-            self.gfidpath_delete({"gfid": data[1], "type": "NEW",
+            self.gfidpath_delete({"gfid": rec.gfid, "type": "NEW",
                                   "pgfid1": pgfid1, "bn1": bn1})
         else:
             # Else Record as DELETE
-            self.gfidpath_add(changelogfile, RecordType.DELETE, data[1],
+            self.gfidpath_add(changelogfile, RecordType.DELETE, rec.gfid,
                               pgfid1, bn1, path1=deleted_path)
 
         # Update path1 as deleted_path if pgfid1 and bn1 is same as deleted
-        self.gfidpath_update({"path1": deleted_path}, {"gfid": data[1],
+        self.gfidpath_update({"path1": deleted_path}, {"gfid": rec.gfid,
                                                        "pgfid1": pgfid1,
                                                        "bn1": bn1})
 
         # Update path2 as deleted_path if pgfid2 and bn2 is same as deleted
         self.gfidpath_update({"path2": deleted_path}, {
             "type": RecordType.RENAME,
-            "gfid": data[1],
+            "gfid": rec.gfid,
             "pgfid2": pgfid1,
             "bn2": bn1})
 
         # If deleted directory is parent for somebody
         query1 = """UPDATE gfidpath SET path1 = ? || '%2F' || bn1
         WHERE pgfid1 = ? AND path1 != ''"""
-        self.cursor.execute(query1, (deleted_path, data[1]))
+        self.cursor.execute(query1, (deleted_path, rec.gfid))
 
         query1 = """UPDATE gfidpath SET path2 = ? || '%2F' || bn1
         WHERE pgfid2 = ? AND path2 != ''"""
-        self.cursor.execute(query1, (deleted_path, data[1]))
+        self.cursor.execute(query1, (deleted_path, rec.gfid))
 
     def commit(self):
         self.conn.commit()
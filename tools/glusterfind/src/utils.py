@@ -17,6 +17,8 @@ import os
 from datetime import datetime
 import urllib
 
+from dirscan import scandir, DT_DIR
+
 ROOT_GFID = "00000000-0000-0000-0000-000000000001"
 DEFAULT_CHANGELOG_INTERVAL = 15
 
@@ -49,29 +51,36 @@ def handle_rm_error(func, path, exc_info):
 
 
 def find(path, callback_func=lambda x: True, filter_func=lambda x: True,
-         ignore_dirs=[], subdirs_crawl=True):
+         ignore_dirs=[], subdirs_crawl=True, with_inode=False):
+    """
+    Walk @path, passing paths for which @filter_func does not return
+    None to @callback_func, along with what @filter_func returned.
+    With @with_inode, @filter_func is also given the inode number as
+    read from the directory, or None if not known. Entries are typed
+    by the readdir pass itself, symlinks are not followed.
+    """
     if path in ignore_dirs:
         return
 
-    # Capture filter_func output and pass it to callback function
-    filter_result = filter_func(path)
-    if filter_result is not None:
-        callback_func(path, filter_result)
+    def check(p, ino):
+        # Capture filter_func output and pass it to callback function
+        if with_inode:
+            filter_result = filter_func(p, ino)
+        else:
+            filter_result = filter_func(p)
+        if filter_result is not None:
+            callback_func(p, filter_result)
 
-    for p in os.listdir(path):
-        full_path = os.path.join(path, p)
+    check(path, None)
 
-        if os.path.isdir(full_path):
-            if subdirs_crawl:
-                find(full_path, callback_func, filter_func, ignore_dirs)
-            else:
-                filter_result = filter_func(full_path)
-                if filter_result is not None:
-                    callback_func(full_path, filter_result)
+    for name, dtype, ino in scandir(path):
+        full_path = os.path.join(path, name)
+
+        if dtype == DT_DIR and subdirs_crawl:
+            find(full_path, callback_func, filter_func, ignore_dirs,
+                 with_inode=with_inode)
         else:
-            filter_result = filter_func(full_path)
-            if filter_result is not None:
-                callback_func(full_path, filter_result)
+            check(full_path, ino)
 
 
 def output_write(f, path, prefix=".", encode=False):
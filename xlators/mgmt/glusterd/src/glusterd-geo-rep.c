@@ -47,6 +47,11 @@ struct gsync_config_opt_vals_ gsync_confopt_vals[] = {
          .case_sensitive = _gf_false,
          .values         = {"true", "false", "0", "1", "yes", "no"}
         },
+        {.op_name        = "sync-engine",
+         .no_of_pos_vals = 3,
+         .case_sensitive = _gf_true,
+         .values         = {"rsync", "tarssh", "native"}
+        },
         {.op_name        = "ignore_deletes",
          .no_of_pos_vals = 6,
          .case_sensitive = _gf_false,